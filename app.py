@@ -1,24 +1,21 @@
 import os
-import json
-import pandas as pd
 import tkinter as tk
 from tkinter import ttk, filedialog, messagebox
 from tkinter.scrolledtext import ScrolledText
-import PyPDF2
-from PIL import Image
 import pytesseract
-import io
-import re
-import shutil
-import sys
-import subprocess
-from pathlib import Path
+import threading
+import queue
+import traceback
+from pdf_engine import EXTRACTION_MODES
+from ocr import load_regions
+from sorter import RouteSorter, SplitSettings
+from excel_import import read_excel_mapping
+from mapping_store import open_store
+from search_index import SearchIndex
+from service_client import ServiceClient, run_remote
 
 # Set Tesseract path
 pytesseract.pytesseract.tesseract_cmd = r'C:\Program Files\Tesseract-OCR\tesseract.exe'
-
-# Check if running on Windows
-is_windows = sys.platform.startswith('win')
     
 class DriverPDFSorterApp:
     def __init__(self, root):
@@ -27,10 +24,29 @@ class DriverPDFSorterApp:
         self.root.geometry("800x600")
         self.root.minsize(600, 500)
         
-        # Data storage
+        # Data storage: the mapping is kept in memory and snapshotted to
+        # data/driver_data.sqlite; the JSON file is imported when it changes
         self.data_file = 'data/driver_data.json'
         os.makedirs('data', exist_ok=True)
         os.makedirs('uploads', exist_ok=True)
+        self.store = open_store(self.data_file)
+        
+        # Set by the Cancel button; checked between pages
+        self.cancel_event = threading.Event()
+        
+        # PDF runs happen on a worker thread, which sends log lines and
+        # progress to the UI through this queue; the UI drains it on a timer
+        self.events = queue.Queue()
+        self.worker = None
+        
+        # Splitting pipeline shared with the command line, kept between runs
+        # for its matcher and page cache
+        self.sorter = RouteSorter(
+            self.store,
+            log=lambda message: self.events.put(('log', message)),
+            progress=lambda page_num, total_pages: self.events.put(('progress', page_num, total_pages)),
+            cancel_event=self.cancel_event
+        )
         
         # Create notebook with tabs
         self.notebook = ttk.Notebook(root)
@@ -82,6 +98,9 @@ class DriverPDFSorterApp:
         process_btn = ttk.Button(upload_frame, text="Process File", command=self.process_file)
         process_btn.pack(pady=10)
         
+        import_btn = ttk.Button(upload_frame, text="Import JSON Mapping", command=self.import_json_mapping)
+        import_btn.pack(pady=(0, 10))
+        
         # Results frame
         results_frame = ttk.LabelFrame(main_frame, text="Results", padding=10)
         results_frame.pack(fill=tk.BOTH, expand=True)
@@ -98,6 +117,18 @@ class DriverPDFSorterApp:
         search_entry = ttk.Entry(search_frame, textvariable=self.search_var)
         search_entry.pack(side=tk.LEFT, fill=tk.X, expand=True)
         
+        self.match_count_var = tk.StringVar()
+        match_count_label = ttk.Label(search_frame, textvariable=self.match_count_var)
+        match_count_label.pack(side=tk.LEFT, padx=(10, 0))
+        
+        # The table is virtualized: it only holds Tk items for the rows on
+        # screen and refills them from self.matches as it scrolls
+        self.search_index = SearchIndex({})
+        self.matches = []
+        self.first_row = 0
+        self.visible_rows = 0
+        self.search_after_id = None
+        
         # Treeview for data display
         columns = ("column_c", "column_j")
         self.tree = ttk.Treeview(results_frame, columns=columns, show="headings")
@@ -110,13 +141,16 @@ class DriverPDFSorterApp:
         self.tree.column("column_c", width=100, anchor=tk.W)
         self.tree.column("column_j", width=100, anchor=tk.W)
         
-        # Add scrollbar
-        scrollbar = ttk.Scrollbar(results_frame, orient=tk.VERTICAL, command=self.tree.yview)
-        self.tree.configure(yscrollcommand=scrollbar.set)
+        # Add scrollbar; it scrolls through the matches, not the tree's items
+        self.tree_scrollbar = ttk.Scrollbar(results_frame, orient=tk.VERTICAL, command=self.scroll_treeview)
+        self.tree.bind("<Configure>", self.resize_treeview)
+        self.tree.bind("<MouseWheel>", self.wheel_treeview)
+        self.tree.bind("<Button-4>", lambda event: self.scroll_treeview("scroll", -3, "units"))
+        self.tree.bind("<Button-5>", lambda event: self.scroll_treeview("scroll", 3, "units"))
         
         # Pack tree and scrollbar
         self.tree.pack(side=tk.LEFT, fill=tk.BOTH, expand=True)
-        scrollbar.pack(side=tk.RIGHT, fill=tk.Y)
+        self.tree_scrollbar.pack(side=tk.RIGHT, fill=tk.Y)
         
         # Status bar
         self.status_var = tk.StringVar()
@@ -165,7 +199,7 @@ class DriverPDFSorterApp:
         upload_frame = ttk.LabelFrame(main_frame, text="Upload PDF File", padding=10)
         upload_frame.pack(fill=tk.X, pady=(0, 20))
         
-        upload_pdf_btn = ttk.Button(upload_frame, text="Select PDF File", command=self.select_pdf_file)
+        upload_pdf_btn = ttk.Button(upload_frame, text="Select PDF Files", command=self.select_pdf_file)
         upload_pdf_btn.pack(pady=10)
         
         self.pdf_file_label = ttk.Label(upload_frame, text="No file selected")
@@ -186,8 +220,11 @@ class DriverPDFSorterApp:
         browse_dir_btn.pack(side=tk.RIGHT)
         
         # Process button
-        process_pdf_btn = ttk.Button(upload_frame, text="Process PDF", command=self.process_pdf_file)
-        process_pdf_btn.pack(pady=10)
+        self.process_pdf_btn = ttk.Button(upload_frame, text="Process PDF", command=self.process_pdf_file)
+        self.process_pdf_btn.pack(pady=10)
+        
+        cancel_pdf_btn = ttk.Button(upload_frame, text="Cancel", command=self.cancel_pdf_processing)
+        cancel_pdf_btn.pack(pady=(0, 10))
         
         # Progress frame
         progress_frame = ttk.LabelFrame(main_frame, text="Progress", padding=10)
@@ -225,7 +262,70 @@ class DriverPDFSorterApp:
         account_radio = ttk.Radiobutton(tracking_frame, text="Force Account Number", 
                                       value="account_no", variable=self.pdf_tracking_var)
         account_radio.pack(anchor=tk.W, pady=5)
-        
+
+        # OCR rendering settings
+        ocr_frame = ttk.LabelFrame(main_frame, text="OCR Settings", padding=10)
+        ocr_frame.pack(fill=tk.X, pady=(0, 20))
+
+        mode_row = ttk.Frame(ocr_frame)
+        mode_row.pack(fill=tk.X, pady=(0, 5))
+
+        ttk.Label(mode_row, text="Text source:").pack(side=tk.LEFT, padx=(0, 5))
+        self.extraction_mode_var = tk.StringVar(value="hybrid")
+        ttk.Combobox(mode_row, textvariable=self.extraction_mode_var, values=EXTRACTION_MODES,
+                     state="readonly", width=8).pack(side=tk.LEFT, padx=(0, 5))
+        ttk.Label(mode_row, text="OCR region:").pack(side=tk.LEFT, padx=(10, 5))
+        self.ocr_regions = load_regions()
+        self.ocr_region_var = tk.StringVar(value="auto")
+        ttk.Combobox(mode_row, textvariable=self.ocr_region_var, values=["auto"] + list(self.ocr_regions),
+                     state="readonly", width=10).pack(side=tk.LEFT)
+
+        ttk.Label(mode_row, text="Extra edits for unknown refs:").pack(side=tk.LEFT, padx=(10, 5))
+        self.fuzzy_edits_var = tk.IntVar(value=0)
+        ttk.Spinbox(mode_row, from_=0, to=2, width=3, textvariable=self.fuzzy_edits_var).pack(side=tk.LEFT)
+
+        # Low-DPI binarized pass first, full resolution only for hard pages
+        self.adaptive_ocr_var = tk.BooleanVar(value=False)
+        ttk.Checkbutton(mode_row, text="Adaptive DPI", variable=self.adaptive_ocr_var).pack(side=tk.LEFT, padx=(15, 0))
+
+        render_row = ttk.Frame(ocr_frame)
+        render_row.pack(fill=tk.X)
+
+        ttk.Label(render_row, text="DPI:").pack(side=tk.LEFT, padx=(0, 5))
+        self.ocr_dpi_var = tk.IntVar(value=200)
+        ttk.Spinbox(render_row, from_=72, to=600, increment=50, width=5,
+                    textvariable=self.ocr_dpi_var).pack(side=tk.LEFT, padx=(0, 15))
+
+        ttk.Label(render_row, text="Pages per chunk:").pack(side=tk.LEFT, padx=(0, 5))
+        self.ocr_chunk_var = tk.IntVar(value=10)
+        ttk.Spinbox(render_row, from_=1, to=100, width=4,
+                    textvariable=self.ocr_chunk_var).pack(side=tk.LEFT, padx=(0, 15))
+
+        ttk.Label(render_row, text="Render threads:").pack(side=tk.LEFT, padx=(0, 5))
+        self.ocr_threads_var = tk.IntVar(value=2)
+        ttk.Spinbox(render_row, from_=1, to=16, width=3,
+                    textvariable=self.ocr_threads_var).pack(side=tk.LEFT, padx=(0, 15))
+
+        ttk.Label(render_row, text="OCR workers:").pack(side=tk.LEFT, padx=(0, 5))
+        self.ocr_workers_var = tk.IntVar(value=os.cpu_count() or 1)
+        ttk.Spinbox(render_row, from_=1, to=64, width=3,
+                    textvariable=self.ocr_workers_var).pack(side=tk.LEFT, padx=(0, 15))
+
+        self.ocr_grayscale_var = tk.BooleanVar(value=True)
+        ttk.Checkbutton(render_row, text="Grayscale", variable=self.ocr_grayscale_var).pack(side=tk.LEFT, padx=(0, 15))
+
+        self.use_cache_var = tk.BooleanVar(value=True)
+        ttk.Checkbutton(render_row, text="Cache results", variable=self.use_cache_var).pack(side=tk.LEFT)
+
+        # With a server URL the PDFs are sorted by the split service there
+        # (python cli.py serve) and only the route files come back
+        server_row = ttk.Frame(ocr_frame)
+        server_row.pack(fill=tk.X, pady=(5, 0))
+
+        ttk.Label(server_row, text="Processing server (blank for this PC):").pack(side=tk.LEFT, padx=(0, 5))
+        self.server_url_var = tk.StringVar(value=os.environ.get('TRANSPORT_SORTER_SERVER', ''))
+        ttk.Entry(server_row, textvariable=self.server_url_var, width=35).pack(side=tk.LEFT, fill=tk.X, expand=True)
+
     def select_file(self):
         filetypes = [
             ("Excel files", "*.xlsx;*.xls"),
@@ -253,39 +353,19 @@ class DriverPDFSorterApp:
             self.status_var.set("Processing file...")
             self.root.update()
             
-            # Read Excel file
-            df = pd.read_excel(self.selected_file)
-            
-            # Get selected tracking method
-            tracking_method = self.tracking_var.get()
+            # Stream columns C and J of every sheet
+            data_dict, column_names = read_excel_mapping(self.selected_file, self.tracking_var.get())
             
-            if tracking_method == "customer_ref":
-                # Extract values from columns C and J (indices 2 and 9)
-                # Note: pandas uses 0-based indexing
-                column_c = df.iloc[:, 2].astype(str)
-                column_j = df.iloc[:, 9].astype(str)
-                column_names = ["Customer Ref", "Route"]
-            else:  # account_no
-                # Extract values from columns C and J (indices 2 and 9)
-                # Note: this assumes account numbers are in the same columns
-                # Adjust indices if needed for account numbers
-                column_c = df.iloc[:, 2].astype(str)
-                column_j = df.iloc[:, 9].astype(str)
-                column_names = ["Account Number", "Route"]
-            
-            # Create a dictionary mapping C values to J values
-            data_dict = {c_val: j_val for c_val, j_val in zip(column_c, column_j)}
-            
-            # Save the dictionary to a JSON file
-            os.makedirs(os.path.dirname(self.data_file), exist_ok=True)
-            with open(self.data_file, 'w') as f:
-                json.dump(data_dict, f, indent=4)
+            # Apply only the differences to the stored mapping
+            added, changed, removed = self.store.update(data_dict)
             
             # Update the treeview
-            self.update_treeview(data_dict, column_names)
+            self.update_treeview(self.store.mapping, column_names)
             
-            self.status_var.set(f"Processed {len(data_dict)} entries from {os.path.basename(self.selected_file)}")
-            messagebox.showinfo("Success", f"Successfully processed {len(data_dict)} entries from the Excel file.")
+            changes = f"{len(added)} added, {len(changed)} changed, {len(removed)} removed"
+            self.status_var.set(f"Processed {len(data_dict)} entries from {os.path.basename(self.selected_file)} ({changes})")
+            messagebox.showinfo("Success", f"Successfully processed {len(data_dict)} entries from the Excel file.\n"
+                                           f"Route changes: {changes}.")
             
         except Exception as e:
             messagebox.showerror("Error", f"Error processing file: {str(e)}")
@@ -299,44 +379,100 @@ class DriverPDFSorterApp:
         self.tree.heading("column_c", text=column_names[0])
         self.tree.heading("column_j", text=column_names[1])
         
-        # Clear existing items
-        for item in self.tree.get_children():
-            self.tree.delete(item)
-        
-        # Insert data
-        for c_val, j_val in data_dict.items():
-            self.tree.insert("", tk.END, values=(c_val, j_val))
+        # Index the data once; searches and scrolling work from the index
+        self.search_index = SearchIndex(data_dict)
+        self.apply_search()
     
     def filter_treeview(self, *args):
-        search_term = self.search_var.get().lower()
-        
-        # Clear existing items
-        for item in self.tree.get_children():
-            self.tree.delete(item)
-        
-        # Try to load data
-        try:
-            with open(self.data_file, 'r') as f:
-                data_dict = json.load(f)
-            
-            # Filter and insert data
-            for c_val, j_val in data_dict.items():
-                if search_term in c_val.lower() or search_term in j_val.lower():
-                    self.tree.insert("", tk.END, values=(c_val, j_val))
-        except FileNotFoundError:
-            pass
+        # Debounced: search once typing pauses rather than on every keystroke
+        if self.search_after_id is not None:
+            self.root.after_cancel(self.search_after_id)
+        self.search_after_id = self.root.after(150, self.apply_search)
+    
+    def apply_search(self):
+        self.search_after_id = None
+        self.matches = self.search_index.search(self.search_var.get())
+        self.first_row = 0
+        
+        total = len(self.search_index)
+        if self.search_var.get():
+            self.match_count_var.set(f"{len(self.matches)} of {total} entries")
+        else:
+            self.match_count_var.set(f"{total} entries")
+        self.refresh_treeview()
+    
+    def refresh_treeview(self):
+        # Show the matches from first_row on, reusing the existing items
+        rows = self.search_index.rows
+        first = self.first_row
+        shown = [rows[row] for row in self.matches[first:first + self.visible_rows]]
+        
+        items = self.tree.get_children()
+        for item, values in zip(items, shown):
+            self.tree.item(item, values=values)
+        for values in shown[len(items):]:
+            self.tree.insert("", tk.END, values=values)
+        if len(items) > len(shown):
+            self.tree.delete(*items[len(shown):])
+        
+        if self.matches:
+            self.tree_scrollbar.set(first / len(self.matches), (first + len(shown)) / len(self.matches))
+        else:
+            self.tree_scrollbar.set(0, 1)
+    
+    def scroll_treeview(self, action, amount, unit=None):
+        if action == "moveto":
+            first = int(float(amount) * len(self.matches))
+        elif unit == "pages":
+            first = self.first_row + int(amount) * max(1, self.visible_rows - 1)
+        else:
+            first = self.first_row + int(amount)
+        first = max(0, min(first, len(self.matches) - self.visible_rows))
+        if first != self.first_row:
+            self.first_row = first
+            self.refresh_treeview()
+    
+    def wheel_treeview(self, event):
+        self.scroll_treeview("scroll", -3 if event.delta > 0 else 3, "units")
+        return "break"
+    
+    def resize_treeview(self, event):
+        # Rows that fit below the heading at the current height
+        style = ttk.Style()
+        row_height = int(style.lookup("Treeview", "rowheight") or 20)
+        visible_rows = max(1, (event.height - row_height) // row_height)
+        if visible_rows != self.visible_rows:
+            self.visible_rows = visible_rows
+            self.first_row = max(0, min(self.first_row, len(self.matches) - visible_rows))
+            self.refresh_treeview()
     
     def load_existing_data(self):
         try:
-            with open(self.data_file, 'r') as f:
-                data_dict = json.load(f)
-            self.update_treeview(data_dict)
-            self.status_var.set(f"Loaded {len(data_dict)} entries from existing data")
-        except FileNotFoundError:
-            self.status_var.set("No existing data found")
+            self.store.reload()
+            if not self.store.exists():
+                self.status_var.set("No existing data found")
+                return
+            self.update_treeview(self.store.mapping)
+            self.status_var.set(f"Loaded {len(self.store)} entries from existing data")
         except Exception as e:
             self.status_var.set(f"Error loading data: {str(e)}")
     
+    def import_json_mapping(self):
+        filename = filedialog.askopenfilename(
+            title="Select JSON Mapping",
+            filetypes=[("JSON files", "*.json"), ("All files", "*.*")]
+        )
+        if not filename:
+            return
+        
+        try:
+            count = self.store.import_json(filename)
+            self.update_treeview(self.store.mapping)
+            self.status_var.set(f"Imported {count} entries from {os.path.basename(filename)}")
+        except Exception as e:
+            messagebox.showerror("Error", f"Error importing mapping: {str(e)}")
+            self.status_var.set("Error importing mapping")
+    
     # PDF Processing Methods
     def select_pdf_file(self):
         filetypes = [
@@ -344,18 +480,24 @@ class DriverPDFSorterApp:
             ("All files", "*.*")
         ]
         
-        filename = filedialog.askopenfilename(
-            title="Select PDF File",
+        # Several files are sorted as one batch into shared route files
+        filenames = filedialog.askopenfilenames(
+            title="Select PDF Files",
             filetypes=filetypes
         )
         
-        if filename:
-            self.selected_pdf_file = filename
-            self.pdf_file_label.config(text=os.path.basename(filename))
-            self.pdf_status_var.set(f"PDF file selected: {os.path.basename(filename)}")
-            self.log("PDF file selected: " + os.path.basename(filename))
+        if filenames:
+            self.selected_pdf_files = list(filenames)
+            if len(filenames) == 1:
+                text = os.path.basename(filenames[0])
+            else:
+                text = f"{len(filenames)} files selected"
+            self.pdf_file_label.config(text=text)
+            self.pdf_status_var.set(f"PDF file selected: {text}")
+            for filename in filenames:
+                self.log("PDF file selected: " + os.path.basename(filename))
         else:
-            self.selected_pdf_file = None
+            self.selected_pdf_files = None
     
     def select_output_directory(self):
         directory = filedialog.askdirectory(
@@ -366,137 +508,42 @@ class DriverPDFSorterApp:
             self.output_dir_var.set(directory)
             self.log(f"Output directory set to: {directory}")
     
+    def cancel_pdf_processing(self):
+        if self.worker is not None and self.worker.is_alive():
+            self.cancel_event.set()
+            self.log("Cancelling after the current page...")
+    
     def log(self, message):
+        # Only called on the UI thread; the worker's lines arrive via poll_events
         self.log_area.config(state=tk.NORMAL)
         self.log_area.insert(tk.END, message + "\n")
         self.log_area.see(tk.END)
         self.log_area.config(state=tk.DISABLED)
-        self.root.update()
     
-    def extract_text_from_page(self, pdf_path, page_num):
-        try:
-            # For Windows, we'll use PyPDF2 directly since poppler is harder to set up
-            if is_windows:
-                # Extract text directly from PDF
-                with open(pdf_path, 'rb') as file:
-                    pdf_reader = PyPDF2.PdfReader(file)
-                    if page_num < len(pdf_reader.pages):
-                        page = pdf_reader.pages[page_num]
-                        page_text = page.extract_text()
-                        
-                        # Log a sample of the extracted text for debugging
-                        sample_text = page_text[:200] + "..." if len(page_text) > 200 else page_text
-                        self.log(f"Sample text from page {page_num+1}:\n{sample_text}")
-                        
-                        return page_text
-                    else:
-                        return ""
-            else:
-                # Try to use pdf2image and pytesseract (requires poppler)
-                from pdf2image import convert_from_path
-                images = convert_from_path(pdf_path, first_page=page_num+1, last_page=page_num+1)
-                if not images:
-                    return ""
-                
-                # Perform OCR on the image with improved settings
-                page_text = pytesseract.image_to_string(images[0], config='--psm 6')
-                sample_text = page_text[:200] + "..." if len(page_text) > 200 else page_text
-                self.log(f"Sample text from page {page_num+1}:\n{sample_text}")
-                
-                return page_text
-                
-        except Exception as e:
-            self.log(f"Error extracting text from page {page_num}: {str(e)}")
-            self.log("Falling back to direct PDF text extraction...")
-            
-            # Fallback to direct PDF text extraction
-            try:
-                with open(pdf_path, 'rb') as file:
-                    pdf_reader = PyPDF2.PdfReader(file)
-                    if page_num < len(pdf_reader.pages):
-                        page = pdf_reader.pages[page_num]
-                        page_text = page.extract_text()
-                        
-                        # Log a sample of the extracted text for debugging
-                        sample_text = page_text[:200] + "..." if len(page_text) > 200 else page_text
-                        self.log(f"Sample text (fallback) from page {page_num+1}:\n{sample_text}")
-                        
-                        return page_text
-            except Exception as inner_e:
-                self.log(f"Fallback also failed: {str(inner_e)}")
-            
-            return ""
+    def split_settings(self):
+        return SplitSettings(
+            mode=self.extraction_mode_var.get(),
+            region=self.ocr_region_var.get(),
+            fuzzy_edits=self.fuzzy_edits_var.get(),
+            dpi=self.ocr_dpi_var.get(),
+            chunk_size=self.ocr_chunk_var.get(),
+            render_threads=self.ocr_threads_var.get(),
+            ocr_workers=self.ocr_workers_var.get(),
+            grayscale=self.ocr_grayscale_var.get(),
+            use_cache=self.use_cache_var.get(),
+            tracking=self.pdf_tracking_var.get(),
+            adaptive=self.adaptive_ocr_var.get()
+        )
     
-    def find_customer_ref(self, text):
-        if not text:
-            return None
-            
-        # First try to find Account Number (as seen in the new file format)
-        account_pattern = re.compile(r'Account\s+No:?\s*([A-Z0-9]{4,10})\b', re.IGNORECASE)
-        match = account_pattern.search(text)
-        if match:
-            ref = match.group(1).strip()
-            self.log(f"Found Account Number: {ref}")
-            return ref
-            
-        # Also check for TOPA format as seen in the new screenshot
-        topa_pattern = re.compile(r'\bTOPA\d{3}\b')
-        match = topa_pattern.search(text)
-        if match:
-            ref = match.group(0).strip()
-            self.log(f"Found TOPA Account Number: {ref}")
-            return ref
-            
-        # Look for exact "Customer Ref." followed by value format
-        # Pattern specifically for the Around Noon format seen in the screenshots
-        customer_ref_pattern = re.compile(r'Customer\s+Ref\.?\s*[:.]?\s*([A-Z0-9]{3,10})\b', re.IGNORECASE)
-        match = customer_ref_pattern.search(text)
-        if match:
-            ref = match.group(1).strip()
-            self.log(f"Found exact Customer Ref: {ref}")
-            return ref
-            
-        # Try another pattern - look for Customer Ref followed by uppercase alphanumeric
-        alt_pattern = re.compile(r'(?:Customer|Cust)[\s\.]+Ref[\s\.]*[:.]?\s*([A-Z][A-Z0-9]{2,9})\b', re.IGNORECASE)
-        match = alt_pattern.search(text)
-        if match:
-            ref = match.group(1).strip()
-            self.log(f"Found Customer Ref with alt pattern: {ref}")
-            return ref
-            
-        # Special case for ARAM pattern as seen in screenshot
-        aram_pattern = re.compile(r'\bARAM\d{3}\b')
-        match = aram_pattern.search(text)
-        if match:
-            ref = match.group(0).strip()
-            self.log(f"Found ARAM reference: {ref}")
-            return ref
-            
-        # Special case for KSG pattern as seen in previous screenshot
-        ksg_pattern = re.compile(r'\bKSG[A-Z]?\d{2,4}\b')
-        match = ksg_pattern.search(text)
-        if match:
-            ref = match.group(0).strip()
-            self.log(f"Found KSG reference: {ref}")
-            return ref
-        
-        # Only as a last resort, try to find patterns directly from the database
-        try:
-            with open(self.data_file, 'r') as f:
-                customer_data = json.load(f)
-                
-            # Look for any customer ref from our database directly in the text
-            for db_ref in customer_data.keys():
-                if db_ref and len(db_ref) >= 3 and db_ref in text:
-                    self.log(f"Found direct database match: {db_ref}")
-                    return db_ref
-        except:
-            pass
-            
-        return None
+    def show_pdf_progress(self, page_num, total_pages):
+        self.progress_var.set((page_num / total_pages) * 100)
+        self.pdf_status_var.set(f"Processing page {page_num+1} of {total_pages}")
     
     def process_pdf_file(self):
-        if not hasattr(self, 'selected_pdf_file') or not self.selected_pdf_file:
+        if self.worker is not None and self.worker.is_alive():
+            return
+        
+        if not hasattr(self, 'selected_pdf_files') or not self.selected_pdf_files:
             messagebox.showerror("Error", "No PDF file selected")
             return
         
@@ -505,191 +552,115 @@ class DriverPDFSorterApp:
             messagebox.showerror("Error", "No output directory selected")
             return
         
+        # Settings are read here, since Tk variables belong to the UI thread
+        self.sorter.settings = self.split_settings()
+        server_url = self.server_url_var.get().strip()
+        
+        self.cancel_event.clear()
+        self.progress_var.set(0)
+        self.pdf_status_var.set("Processing PDF...")
+        self.process_pdf_btn.config(state=tk.DISABLED)
+        
+        self.worker = threading.Thread(
+            target=self.run_pdf_worker,
+            args=(self.selected_pdf_files, output_dir, server_url),
+            daemon=True
+        )
+        self.worker.start()
+        self.root.after(100, self.poll_events)
+    
+    def run_pdf_worker(self, pdf_files, output_dir, server_url=None):
+        # Worker thread: never touches widgets, only posts events
         try:
-            # Load customer data (maps customer refs to routes)
+            if server_url:
+                summary = self.run_remote_worker(pdf_files, output_dir, server_url)
+            elif len(pdf_files) == 1:
+                summary = self.sorter.split_pdf(pdf_files[0], output_dir)
+            else:
+                summary = self.sorter.split_batch(pdf_files, output_dir)
+            self.events.put(('done', summary))
+        except FileNotFoundError as e:
+            self.events.put(('missing', str(e)))
+        except Exception as e:
+            self.events.put(('error', str(e), traceback.format_exc()))
+    
+    def run_remote_worker(self, pdf_files, output_dir, server_url):
+        settings = self.sorter.settings
+        summaries = run_remote(
+            ServiceClient(server_url), pdf_files, output_dir,
+            log=self.sorter.log,
+            progress=self.sorter.progress,
+            cancel_event=self.cancel_event,
+            mode=settings.mode,
+            region=settings.region,
+            tracking=settings.tracking,
+            fuzzy_edits=settings.fuzzy_edits,
+            dpi=settings.dpi,
+            grayscale=settings.grayscale,
+            adaptive=settings.adaptive
+        )
+        return {'cancelled': any(summary['cancelled'] for summary in summaries), 'results': summaries}
+    
+    def poll_events(self):
+        # Apply everything queued since the last poll as one batch: the log
+        # lines go in with a single insert and only the latest progress is shown
+        lines = []
+        progress = None
+        finished = None
+        while True:
             try:
-                with open(self.data_file, 'r') as f:
-                    customer_data = json.load(f)
-                    
-                self.log(f"Loaded customer data with {len(customer_data)} entries")
-                self.log("Sample customer data entries:")
-                sample_count = 0
-                for ref, route in customer_data.items():
-                    if sample_count < 5:  # Show first 5 entries
-                        self.log(f"  {ref} -> {route}")
-                        sample_count += 1
-                    else:
-                        break
-                        
-            except FileNotFoundError:
-                messagebox.showerror("Error", "No customer data found. Please process an Excel file first.")
+                event = self.events.get_nowait()
+            except queue.Empty:
+                break
+            if event[0] == 'log':
+                lines.append(event[1])
+            elif event[0] == 'progress':
+                progress = event[1:]
+            else:
+                finished = event
+        
+        if lines:
+            self.log("\n".join(lines))
+        if progress is not None:
+            self.show_pdf_progress(*progress)
+        
+        if finished is None:
+            self.root.after(100, self.poll_events)
+        else:
+            self.finish_pdf_processing(finished)
+    
+    def finish_pdf_processing(self, event):
+        self.process_pdf_btn.config(state=tk.NORMAL)
+        kind = event[0]
+        
+        if kind == 'done':
+            if event[1]['cancelled']:
+                self.pdf_status_var.set("PDF processing cancelled")
                 return
             
-            self.pdf_status_var.set("Processing PDF...")
-            self.log("\nStarting PDF processing...")
-            
-            # Dictionary to store pages by route
-            pages_by_route = {}
-            customer_routes = {}  # Maps customer refs to their routes
-            unassigned_pages = []
-            
-            # Read the PDF
-            with open(self.selected_pdf_file, 'rb') as file:
-                pdf_reader = PyPDF2.PdfReader(file)
-                total_pages = len(pdf_reader.pages)
-                
-                self.log(f"PDF has {total_pages} pages")
-                
-                # Process each page
-                for i in range(total_pages):
-                    self.progress_var.set((i / total_pages) * 100)
-                    self.pdf_status_var.set(f"Processing page {i+1} of {total_pages}")
-                    self.log(f"\nProcessing page {i+1}...")
-                    
-                    # Extract text from the page
-                    page_text = self.extract_text_from_page(self.selected_pdf_file, i)
-                    
-                    # Find customer reference in the text
-                    customer_ref = self.find_customer_ref(page_text)
-                    
-                    if customer_ref:
-                        self.log(f"Found customer reference: {customer_ref} on page {i+1}")
-                        
-                        # Check if customer reference exists in our database
-                        if customer_ref in customer_data:
-                            route = customer_data[customer_ref]
-                            self.log(f"Customer {customer_ref} belongs to route: {route}")
-                            
-                            # Store customer and route mapping
-                            customer_routes[customer_ref] = route
-                            
-                            # Add page to the route
-                            if route not in pages_by_route:
-                                pages_by_route[route] = []
-                            
-                            pages_by_route[route].append(i)
-                        else:
-                            self.log(f"Customer {customer_ref} not found in database, checking for exact matches...")
-                            
-                            # Try to find exact matches only - no more partial matching
-                            found_match = False
-                            for db_ref, route in customer_data.items():
-                                # Only exact match after normalization
-                                clean_customer_ref = customer_ref.replace(" ", "").upper()
-                                clean_db_ref = db_ref.replace(" ", "").upper()
-                                
-                                if clean_customer_ref == clean_db_ref:
-                                    self.log(f"Exact match found: {customer_ref} = {db_ref} -> {route}")
-                                    
-                                    # Store customer and route mapping
-                                    customer_routes[customer_ref] = route
-                                    
-                                    # Add page to the route
-                                    if route not in pages_by_route:
-                                        pages_by_route[route] = []
-                                    
-                                    pages_by_route[route].append(i)
-                                    found_match = True
-                                    break
-                            
-                            if not found_match:
-                                self.log(f"No exact match found for customer {customer_ref}")
-                                unassigned_pages.append(i)
-                    else:
-                        self.log(f"No customer reference found on page {i+1}")
-                        unassigned_pages.append(i)
-                
-                # Create PDF for each route (with route name as filename)
-                self.log("\nCreating output PDFs by route:")
-                
-                for route, pages in pages_by_route.items():
-                    # Create valid filename from route name - preserve exact route name
-                    safe_route_name = route
-                    
-                    # Only replace characters that are invalid in filenames
-                    invalid_chars = ['\\', '/', ':', '*', '?', '"', '<', '>', '|']
-                    for char in invalid_chars:
-                        safe_route_name = safe_route_name.replace(char, '_')
-                    
-                    # Ensure we have a valid filename
-                    if not safe_route_name or safe_route_name.isspace():
-                        safe_route_name = "Unknown_Route"
-                    
-                    output_path = os.path.join(output_dir, f"{safe_route_name}.pdf")
-                    
-                    self.log(f"Creating PDF for route '{route}' with {len(pages)} pages: {output_path}")
-                    
-                    # Create a new PDF
-                    pdf_writer = PyPDF2.PdfWriter()
-                    
-                    # Add pages from the original PDF
-                    with open(self.selected_pdf_file, 'rb') as input_file:
-                        pdf_reader = PyPDF2.PdfReader(input_file)
-                        
-                        for page_num in pages:
-                            pdf_writer.add_page(pdf_reader.pages[page_num])
-                    
-                    # Write the output file
-                    with open(output_path, 'wb') as output_file:
-                        pdf_writer.write(output_file)
-                    
-                    self.log(f"Created: {output_path}")
-                
-                # Create PDF for unassigned pages
-                if unassigned_pages:
-                    output_path = os.path.join(output_dir, "Unassigned_Pages.pdf")
-                    
-                    self.log(f"\nCreating PDF for {len(unassigned_pages)} unassigned pages")
-                    
-                    # Create a new PDF
-                    pdf_writer = PyPDF2.PdfWriter()
-                    
-                    # Add pages from the original PDF
-                    with open(self.selected_pdf_file, 'rb') as input_file:
-                        pdf_reader = PyPDF2.PdfReader(input_file)
-                        
-                        for page_num in unassigned_pages:
-                            pdf_writer.add_page(pdf_reader.pages[page_num])
-                    
-                    # Write the output file
-                    with open(output_path, 'wb') as output_file:
-                        pdf_writer.write(output_file)
-                    
-                    self.log(f"Created: {output_path}")
-                
-                # Create a summary
-                self.log("\nProcessing Summary:")
-                self.log(f"Total pages: {total_pages}")
-                self.log(f"Routes created: {len(pages_by_route)}")
-                self.log(f"Customer references found and matched: {len(customer_routes)}")
-                self.log(f"Pages assigned to routes: {sum(len(pages) for pages in pages_by_route.values())}")
-                self.log(f"Unassigned pages: {len(unassigned_pages)}")
-                
-                if pages_by_route:
-                    self.log("\nRoute details:")
-                    for route, pages in pages_by_route.items():
-                        customer_list = [ref for ref, r in customer_routes.items() if r == route]
-                        self.log(f"  Route '{route}': {len(pages)} pages, {len(customer_list)} customers")
-                        for customer in customer_list[:5]:  # Show max 5 customers per route
-                            self.log(f"    - {customer}")
-                        if len(customer_list) > 5:
-                            self.log(f"    - ... and {len(customer_list)-5} more customers")
-                
-                # Show success message
-                self.progress_var.set(100)
-                self.pdf_status_var.set("PDF processing complete")
-                messagebox.showinfo("Success", "PDF processing complete")
-        
-        except Exception as e:
-            self.log(f"Error processing PDF: {str(e)}")
-            import traceback
-            self.log(traceback.format_exc())
+            # Show success message
+            self.progress_var.set(100)
+            self.pdf_status_var.set("PDF processing complete")
+            messagebox.showinfo("Success", "PDF processing complete")
+        elif kind == 'missing':
             self.pdf_status_var.set("Error processing PDF")
-            messagebox.showerror("Error", f"Error processing PDF: {str(e)}")
+            messagebox.showerror("Error", event[1])
+        else:
+            self.log(f"Error processing PDF: {event[1]}")
+            self.log(event[2])
+            self.pdf_status_var.set("Error processing PDF")
+            messagebox.showerror("Error", f"Error processing PDF: {event[1]}")
+    
+    def on_close(self):
+        # Ask a running worker to stop; it's a daemon thread, so it won't keep
+        # the process alive after the window is gone
+        self.cancel_event.set()
+        self.root.destroy()
 
 def main():
     root = tk.Tk()
     app = DriverPDFSorterApp(root)
+    root.protocol("WM_DELETE_WINDOW", app.on_close)
     root.mainloop()
 
 if __name__ == "__main__":
@@ -0,0 +1,25 @@
+import os
+import uuid
+from contextlib import contextmanager
+
+
+@contextmanager
+def atomic_open(path, mode='w', fsync=False):
+    # Writes path under a temporary name in the same folder and renames it
+    # into place once complete, so readers only ever see a whole file. The
+    # temporary file is created with a plain open() rather than mkstemp(),
+    # whose 0600 mode the rename would keep: the output respects the umask
+    # like any other file written to a shared folder.
+    directory = os.path.dirname(path) or '.'
+    temp_path = os.path.join(directory, f".{os.path.basename(path)}.{uuid.uuid4().hex}.tmp")
+    try:
+        with open(temp_path, mode.replace('w', 'x')) as f:
+            yield f
+            if fsync:
+                f.flush()
+                os.fsync(f.fileno())
+        os.replace(temp_path, path)
+    except BaseException:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+        raise
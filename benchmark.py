@@ -0,0 +1,397 @@
+import os
+import sys
+import json
+import time
+import zlib
+import random
+import shutil
+import argparse
+import tempfile
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from PIL import Image, ImageDraw
+from pdf_engine import PdfDocument, PageRasterizer
+from ocr import OCR_BACKENDS, OcrPool, ocr_pages
+from matching import RefMatcher, RouteIndex
+from mapping_store import MappingStore
+from pdf_output import RouteWriter
+from sorter import RouteSorter, SplitSettings, route_filename
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+# Reference formats the generator can put on a page, as a line of text for a ref
+REF_FORMATS = {
+    'account_no': ("AC{:06d}", "Account No: {}"),
+    'customer_ref': ("CR{:05d}", "Customer Ref. {}"),
+    'aram': ("ARAM{:03d}", "Store: {}"),
+    'ksg': ("KSG{:03d}", "Deliver to {} store"),
+    'topa': ("TOPA{:03d}", "Account {}"),
+}
+
+STAGES = ('parse', 'rasterize', 'ocr', 'match', 'write', 'pipeline')
+
+PAGE_WIDTH, PAGE_HEIGHT = 595, 842
+
+
+def pdf_object(body):
+    return body if isinstance(body, bytes) else body.encode('latin-1')
+
+
+def text_stream(lines):
+    escaped = [line.replace('\\', '\\\\').replace('(', '\\(').replace(')', '\\)') for line in lines]
+    body = " ".join(f"({line}) '" for line in escaped)
+    return f"BT /F1 11 Tf 50 800 Td 14 TL {body} ET".encode('latin-1')
+
+
+def page_image(lines, dpi):
+    # The same lines drawn into a grayscale scan at dpi
+    width, height = PAGE_WIDTH * dpi // 72, PAGE_HEIGHT * dpi // 72
+    image = Image.new('L', (width, height), 255)
+    draw = ImageDraw.Draw(image)
+    scale = dpi / 72
+    y = 42 * scale
+    for line in lines:
+        draw.text((50 * scale, y), line, fill=0)
+        y += 14 * scale
+    return image
+
+
+def write_manifest(path, pages, dpi=150):
+    # Writes a PDF from a list of (lines, image_only) pages. Text pages get a
+    # text layer; image-only pages are a single scan with no text, like a
+    # scanned manifest, so only OCR can read them.
+    objects = []
+
+    def add(body):
+        objects.append(pdf_object(body))
+        return len(objects)
+
+    font = add("<< /Type /Font /Subtype /Type1 /BaseFont /Helvetica >>")
+    pages_id = add(b"")
+    kids = []
+    for lines, image_only in pages:
+        if image_only:
+            image = page_image(lines, dpi)
+            data = zlib.compress(image.tobytes())
+            image_id = add(b"<< /Type /XObject /Subtype /Image /Width %d /Height %d /ColorSpace /DeviceGray "
+                           b"/BitsPerComponent 8 /Filter /FlateDecode /Length %d >>\nstream\n"
+                           % (image.width, image.height, len(data)) + data + b"\nendstream")
+            stream = f"q {PAGE_WIDTH} 0 0 {PAGE_HEIGHT} 0 0 cm /Im0 Do Q".encode('latin-1')
+            resources = f"<< /XObject << /Im0 {image_id} 0 R >> >>"
+        else:
+            stream = text_stream(lines)
+            resources = f"<< /Font << /F1 {font} 0 R >> >>"
+        content_id = add(b"<< /Length %d >>\nstream\n" % len(stream) + stream + b"\nendstream")
+        kids.append(add(f"<< /Type /Page /Parent {pages_id} 0 R /MediaBox [0 0 {PAGE_WIDTH} {PAGE_HEIGHT}] "
+                        f"/Resources {resources} /Contents {content_id} 0 R >>"))
+    objects[pages_id - 1] = pdf_object(
+        f"<< /Type /Pages /Kids [{' '.join(f'{kid} 0 R' for kid in kids)}] /Count {len(kids)} >>"
+    )
+    catalog = add(f"<< /Type /Catalog /Pages {pages_id} 0 R >>")
+
+    with open(path, 'wb') as f:
+        f.write(b"%PDF-1.4\n")
+        offsets = []
+        for number, body in enumerate(objects, 1):
+            offsets.append(f.tell())
+            f.write(b"%d 0 obj\n" % number + body + b"\nendobj\n")
+        xref = f.tell()
+        f.write(b"xref\n0 %d\n0000000000 65535 f \n" % (len(objects) + 1))
+        f.write(b"".join(b"%010d 00000 n \n" % offset for offset in offsets))
+        f.write(b"trailer\n<< /Size %d /Root %d 0 R >>\nstartxref\n%d\n%%%%EOF\n"
+                % (len(objects) + 1, catalog, xref))
+
+
+def generate(output_dir, pages=200, image_ratio=0.2, formats=tuple(REF_FORMATS), routes=40,
+             mapping_size=2000, unassigned_ratio=0.05, seed=1):
+    # Generates manifest.pdf and mapping.json in output_dir. Returns
+    # (pdf_path, mapping_path, expected, image_pages): expected maps page
+    # numbers to their route (None for pages that should stay unassigned)
+    # and image_pages lists the image-only pages.
+    rng = random.Random(seed)
+    route_names = [f"{rng.choice(['DUBLIN', 'CORK', 'NI', 'GALWAY'])} {number}" for number in range(1, routes + 1)]
+
+    # Every format gets an equal share of the mapping, distractors included
+    mapping = {}
+    refs_by_format = {}
+    for name in formats:
+        code, _ = REF_FORMATS[name]
+        limit = 1000 if '{:03d}' in code else 10 ** 5
+        numbers = rng.sample(range(limit), min(limit, max(1, mapping_size // len(formats))))
+        refs_by_format[name] = [code.format(number) for number in numbers]
+        for ref in refs_by_format[name]:
+            mapping[ref] = rng.choice(route_names)
+
+    manifest = []
+    expected = {}
+    for page_num in range(pages):
+        lines = ["DELIVERY MANIFEST", f"Date: 2024-04-{page_num % 28 + 1:02d}"]
+        if rng.random() < unassigned_ratio:
+            lines.append("Collection note - no account")
+            expected[page_num] = None
+        else:
+            name = rng.choice(formats)
+            ref = rng.choice(refs_by_format[name])
+            lines.append(REF_FORMATS[name][1].format(ref))
+            expected[page_num] = mapping[ref]
+        lines += [f"Item {item:02d}  Crate of produce  {rng.randint(1, 40)} x {rng.randint(1, 99)}.00"
+                  for item in range(1, 31)]
+        lines.append(f"Page {page_num + 1}")
+        manifest.append((lines, rng.random() < image_ratio))
+
+    pdf_path = os.path.join(output_dir, 'manifest.pdf')
+    mapping_path = os.path.join(output_dir, 'mapping.json')
+    write_manifest(pdf_path, manifest)
+    with open(mapping_path, 'w') as f:
+        json.dump(mapping, f)
+    image_pages = [page_num for page_num, (_, image_only) in enumerate(manifest) if image_only]
+    return pdf_path, mapping_path, expected, image_pages
+
+
+def peak_memory_mb():
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is in kilobytes on Linux and bytes on macOS
+    return round(peak / (1024 * 1024 if sys.platform == 'darwin' else 1024), 1)
+
+
+def bench_parse(pdf_path, image_pages, options):
+    with PdfDocument(pdf_path) as document:
+        texts = [document.page_text(page_num) for page_num in range(document.page_count)]
+    return len(texts)
+
+
+def bench_rasterize(pdf_path, image_pages, options):
+    rasterizer = PageRasterizer(pdf_path, dpi=options['dpi'], grayscale=True,
+                                thread_count=options['threads'], chunk_size=options['chunk'])
+    rendered = 0
+    for chunk in rasterizer.iter_chunks(image_pages, paths_only=True):
+        rendered += sum(1 for _, path in chunk if path is not None)
+    if image_pages and not rendered:
+        raise RuntimeError("no pages could be rendered (is poppler installed?)")
+    return rendered
+
+
+def bench_ocr(pdf_path, image_pages, options):
+    rasterizer = PageRasterizer(pdf_path, dpi=options['dpi'], grayscale=True,
+                                thread_count=options['threads'], chunk_size=options['chunk'])
+    done = 0
+    with OcrPool(options['workers'], backend=options['ocr_backend']) as pool:
+        for chunk in rasterizer.iter_chunks(image_pages, paths_only=True):
+            paths = [path for _, path in chunk if path is not None]
+            if options['workers'] > 1:
+                results = [job.result() for job in pool.submit_batch(paths)]
+            else:
+                results = ocr_pages(paths, backend=options['ocr_backend'])
+            done += len(results)
+    if image_pages and not done:
+        raise RuntimeError("no pages could be rendered (is poppler installed?)")
+    return done
+
+
+def bench_match(pdf_path, image_pages, options):
+    with PdfDocument(pdf_path) as document:
+        texts = [document.page_text(page_num) for page_num in range(document.page_count)]
+    with open(options['mapping'], 'r') as f:
+        mapping = json.load(f)
+    matcher = RefMatcher(mapping.keys())
+    route_index = RouteIndex(mapping, max_distance=1)
+    # Repeated so the stage runs long enough to time
+    rounds = options['match_rounds']
+    for _ in range(rounds):
+        for text in texts:
+            ref, _ = matcher.find(text)
+            if ref and ref not in mapping:
+                route_index.lookup(ref)
+    return len(texts) * rounds
+
+
+def bench_write(pdf_path, image_pages, options):
+    with open(options['mapping'], 'r') as f:
+        mapping = json.load(f)
+    routes = sorted(set(mapping.values()))
+    with tempfile.TemporaryDirectory(prefix='bench_write_') as output_dir, PdfDocument(pdf_path) as document:
+        with RouteWriter(document, output_dir) as writer:
+            for index, route in enumerate(routes):
+                pages = list(range(index, document.page_count, len(routes)))
+                if pages:
+                    writer.add(route_filename(route), pages)
+        return document.page_count
+
+
+def bench_pipeline(pdf_path, image_pages, options):
+    # The whole split with the page cache and journal off; also reports how many pages
+    # went to the route the generator put them on
+    with tempfile.TemporaryDirectory(prefix='bench_pipeline_') as work_dir:
+        store = MappingStore(os.path.join(work_dir, 'mapping.sqlite'), import_from=options['mapping'])
+        settings = SplitSettings(dpi=options['dpi'], chunk_size=options['chunk'],
+                                 render_threads=options['threads'], ocr_workers=options['workers'],
+                                 ocr_backend=options['ocr_backend'], use_cache=False, journal_name=None)
+        sorter = RouteSorter(store, settings=settings, log=lambda message: None)
+        summary = sorter.split_pdf(pdf_path, os.path.join(work_dir, 'out'))
+
+    routed = {page - 1: None for page in summary['unassigned_pages']}
+    for route, details in summary['routes'].items():
+        routed.update((page - 1, route) for page in details['pages'])
+    expected = options['expected']
+    correct = sum(1 for page_num, route in expected.items() if routed.get(page_num) == route)
+    return summary['total_pages'], {'accuracy': round(correct / len(expected), 4) if expected else None}
+
+
+BENCHMARKS = {
+    'parse': bench_parse,
+    'rasterize': bench_rasterize,
+    'ocr': bench_ocr,
+    'match': bench_match,
+    'write': bench_write,
+    'pipeline': bench_pipeline,
+}
+
+
+def run_stage(name, pdf_path, image_pages, options):
+    # Runs in its own process so peak memory is the stage's alone. The best
+    # of options['repeat'] runs is kept, which is far less noisy than one.
+    seconds = None
+    for _ in range(options['repeat']):
+        start = time.perf_counter()
+        pages = BENCHMARKS[name](pdf_path, image_pages, options)
+        elapsed = time.perf_counter() - start
+        seconds = elapsed if seconds is None else min(seconds, elapsed)
+    extra = {}
+    if isinstance(pages, tuple):
+        pages, extra = pages
+    return {
+        'pages': pages,
+        'seconds': round(seconds, 4),
+        'pages_per_second': round(pages / seconds, 2) if seconds > 0 else None,
+        'peak_memory_mb': peak_memory_mb(),
+        **extra,
+    }
+
+
+def run_benchmarks(pdf_path, image_pages, options, stages, log=print):
+    results = {}
+    for name in stages:
+        with ProcessPoolExecutor(max_workers=1, mp_context=multiprocessing.get_context()) as executor:
+            try:
+                results[name] = executor.submit(run_stage, name, pdf_path, image_pages, options).result()
+            except Exception as e:
+                results[name] = {'skipped': str(e)}
+        result = results[name]
+        if 'skipped' in result:
+            log(f"{name:<10} skipped: {result['skipped']}")
+        else:
+            accuracy = f"  accuracy {result['accuracy']:.1%}" if result.get('accuracy') is not None else ""
+            log(f"{name:<10} {result['pages']:>7} pages  {result['seconds']:>8.3f}s  "
+                f"{result['pages_per_second'] or 0:>10.1f} pages/s  peak {result['peak_memory_mb']} MB{accuracy}")
+    return results
+
+
+def compare(results, baseline, tolerance):
+    # Stages whose throughput fell more than tolerance below the baseline
+    regressions = {}
+    for name, result in results.items():
+        before = baseline.get(name, {}).get('pages_per_second')
+        now = result.get('pages_per_second')
+        if before and now and now < before * (1 - tolerance):
+            regressions[name] = {'baseline': before, 'current': now, 'change': round(now / before - 1, 3)}
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Benchmark the splitter stages on a synthetic manifest and compare against a baseline."
+    )
+    parser.add_argument('--pages', type=int, default=200)
+    parser.add_argument('--image-ratio', type=float, default=0.2, help="fraction of image-only (scanned) pages")
+    parser.add_argument('--formats', default=','.join(REF_FORMATS),
+                        help="ref formats to use, comma separated (default: all)")
+    parser.add_argument('--routes', type=int, default=40)
+    parser.add_argument('--mapping-size', type=int, default=2000, help="refs in the generated mapping")
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--stages', default=','.join(STAGES), help="stages to run, comma separated")
+    parser.add_argument('--dpi', type=int, default=200)
+    parser.add_argument('--chunk', type=int, default=10)
+    parser.add_argument('--threads', type=int, default=2)
+    parser.add_argument('--workers', type=int, default=os.cpu_count() or 1)
+    parser.add_argument('--ocr-backend', choices=OCR_BACKENDS, default='auto')
+    parser.add_argument('--match-rounds', type=int, default=20)
+    parser.add_argument('--repeat', type=int, default=3, help="runs per stage; the fastest is reported")
+    parser.add_argument('--keep', help="generate the inputs into this directory and keep them")
+    parser.add_argument('--baseline', default='benchmark_baseline.json')
+    parser.add_argument('--save-baseline', action='store_true', help="store these results as the new baseline")
+    parser.add_argument('--tolerance', type=float, default=0.15,
+                        help="allowed throughput drop before a stage counts as a regression")
+    parser.add_argument('--report', help="also write the results as JSON to this file")
+    args = parser.parse_args(argv)
+
+    formats = [name.strip() for name in args.formats.split(',') if name.strip()]
+    stages = [name.strip() for name in args.stages.split(',') if name.strip()]
+    unknown = [name for name in formats if name not in REF_FORMATS] + [name for name in stages if name not in STAGES]
+    if unknown:
+        parser.error(f"unknown format or stage: {', '.join(unknown)}")
+
+    work_dir = args.keep or tempfile.mkdtemp(prefix='bench_')
+    os.makedirs(work_dir, exist_ok=True)
+    pdf_path, mapping_path, expected, image_pages = generate(
+        work_dir, args.pages, args.image_ratio, formats, args.routes, args.mapping_size, seed=args.seed
+    )
+    print(f"Generated {args.pages} pages ({len(image_pages)} image-only) in {work_dir}")
+
+    options = {
+        'mapping': mapping_path,
+        'dpi': args.dpi,
+        'chunk': args.chunk,
+        'threads': args.threads,
+        'workers': args.workers,
+        'ocr_backend': args.ocr_backend,
+        'match_rounds': args.match_rounds,
+        'repeat': max(1, args.repeat),
+        'expected': expected,
+    }
+    try:
+        results = run_benchmarks(pdf_path, image_pages, options, stages)
+    finally:
+        if not args.keep:
+            shutil.rmtree(work_dir, ignore_errors=True)
+    report = {
+        'settings': {'pages': args.pages, 'image_pages': len(image_pages), 'formats': formats,
+                     'routes': args.routes, 'mapping_size': args.mapping_size, 'seed': args.seed, **options},
+        'results': results,
+    }
+    report['settings'].pop('mapping')
+    report['settings'].pop('expected')
+
+    status = 0
+    if os.path.exists(args.baseline) and not args.save_baseline:
+        with open(args.baseline, 'r') as f:
+            baseline = json.load(f)
+        if baseline.get('settings') != report['settings']:
+            print(f"Warning: {args.baseline} was recorded with different settings, "
+                  "so throughput may not be comparable")
+        regressions = compare(results, baseline.get('results', {}), args.tolerance)
+        report['regressions'] = regressions
+        for name, regression in regressions.items():
+            print(f"REGRESSION {name}: {regression['current']} pages/s vs baseline {regression['baseline']} "
+                  f"({regression['change']:+.1%})")
+        if regressions:
+            status = 1
+        else:
+            print(f"No regressions against {args.baseline}")
+
+    if args.save_baseline:
+        with open(args.baseline, 'w') as f:
+            json.dump(report, f, indent=2)
+        print(f"Saved baseline to {args.baseline}")
+    if args.report:
+        with open(args.report, 'w') as f:
+            json.dump(report, f, indent=2)
+    return status
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,371 @@
+import os
+import sys
+import glob
+import json
+import argparse
+import pytesseract
+from concurrent.futures import ProcessPoolExecutor
+from pdf_engine import EXTRACTION_MODES
+from ocr import OCR_BACKENDS, load_regions
+from format_detect import TRACKING_MODES
+from sorter import RouteSorter, SplitSettings
+from excel_import import read_excel_mapping
+from mapping_store import open_store
+from metrics import write_prometheus
+from service import JOB_TTL, SplitService, serve
+from service_client import ServiceClient, ServiceError, run_remote
+
+# Exit statuses for scripts and cron jobs
+EXIT_OK = 0
+EXIT_FAILED = 1          # at least one PDF couldn't be processed
+EXIT_USAGE = 2           # bad arguments, no input files or no mapping
+EXIT_UNASSIGNED = 3      # with --fail-on-unassigned, some pages matched no route
+
+
+def expand_inputs(patterns):
+    # Globs are expanded here as well, since cmd.exe and cron entries
+    # pass them through unexpanded. Directories contribute their PDFs.
+    pdf_files = []
+    for pattern in patterns:
+        if os.path.isdir(pattern):
+            matches = sorted(glob.glob(os.path.join(pattern, '*.pdf')))
+        elif glob.has_magic(pattern):
+            matches = sorted(glob.glob(pattern))
+        else:
+            matches = [pattern]
+        for path in matches:
+            if path not in pdf_files:
+                pdf_files.append(path)
+    return pdf_files
+
+
+def stderr_log(prefix=''):
+    def log(message):
+        for line in message.strip('\n').splitlines() or ['']:
+            # One write per line so lines from parallel jobs don't interleave
+            sys.stderr.write(f"{prefix}{line}\n")
+            sys.stderr.flush()
+    return log
+
+
+def split_one(pdf_files, output_dir, mapping_path, settings, quiet, prefix, tesseract_cmd):
+    # Sorts one PDF, or several as a batch with combined route files. Runs
+    # in a worker process when --jobs > 1, so it only takes picklable
+    # arguments and always returns a summary instead of raising.
+    pytesseract.pytesseract.tesseract_cmd = tesseract_cmd
+    log = (lambda message: None) if quiet else stderr_log(prefix)
+    sorter = RouteSorter(open_store(mapping_path), settings=settings, log=log)
+    try:
+        if len(pdf_files) == 1:
+            summary = sorter.split_pdf(pdf_files[0], output_dir)
+        else:
+            summary = sorter.split_batch(pdf_files, output_dir)
+        summary['status'] = 'ok'
+    except Exception as e:
+        log(f"Error processing PDF: {str(e)}")
+        summary = {'pdf': pdf_files[0] if len(pdf_files) == 1 else pdf_files,
+                   'output_dir': output_dir, 'status': 'error', 'error': str(e)}
+    finally:
+        sorter.close()
+    return summary
+
+
+def run_split(args):
+    pdf_files = expand_inputs(args.pdfs)
+    if not pdf_files:
+        print("No PDF files matched", file=sys.stderr)
+        return EXIT_USAGE
+    if not open_store(args.mapping).exists():
+        print(f"Mapping file not found: {args.mapping}", file=sys.stderr)
+        return EXIT_USAGE
+    if args.region != "auto" and args.region not in load_regions():
+        print(f"Unknown OCR region: {args.region}", file=sys.stderr)
+        return EXIT_USAGE
+
+    # A combined batch is one pipeline run, so it doesn't fan out over jobs
+    jobs = 1 if args.combine else max(1, min(args.jobs, len(pdf_files)))
+    # Share the cores between files running at the same time
+    ocr_workers = args.workers or max(1, (os.cpu_count() or 1) // jobs)
+    settings = SplitSettings(
+        mode=args.mode,
+        region=args.region,
+        fuzzy_edits=args.fuzzy_edits,
+        dpi=args.dpi,
+        chunk_size=args.chunk,
+        render_threads=args.threads,
+        ocr_workers=ocr_workers,
+        grayscale=not args.color,
+        use_cache=not args.no_cache,
+        cache_file=args.cache_file,
+        write_workers=args.write_workers,
+        report_name=None if args.no_report else 'run_report.json',
+        resume=not args.no_resume,
+        page_budget=args.page_budget,
+        tracking=args.tracking,
+        ocr_backend=args.ocr_backend,
+        adaptive=args.adaptive,
+        adaptive_dpi=args.adaptive_dpi,
+        escalation_dpi=args.escalation_dpi,
+        min_confidence=args.min_confidence,
+        dedupe=not args.no_dedupe,
+        segment=not args.no_segment,
+        visual_segment=args.visual_segment
+    )
+
+    # With several PDFs each gets its own folder so same-named route files
+    # don't collide, unless --combine merges them into shared route files
+    tasks = []
+    if args.combine:
+        tasks.append((pdf_files, args.output, args.mapping, settings, args.quiet, '',
+                      pytesseract.pytesseract.tesseract_cmd))
+    else:
+        for pdf_file in pdf_files:
+            if len(pdf_files) == 1:
+                output_dir = args.output
+            else:
+                output_dir = os.path.join(args.output, os.path.splitext(os.path.basename(pdf_file))[0])
+            prefix = f"[{os.path.basename(pdf_file)}] " if len(pdf_files) > 1 else ''
+            tasks.append(([pdf_file], output_dir, args.mapping, settings, args.quiet, prefix,
+                          pytesseract.pytesseract.tesseract_cmd))
+
+    if jobs == 1:
+        summaries = [split_one(*task) for task in tasks]
+    else:
+        with ProcessPoolExecutor(max_workers=jobs) as executor:
+            futures = [executor.submit(split_one, *task) for task in tasks]
+            summaries = [future.result() for future in futures]
+
+    # One Prometheus textfile for the whole batch
+    reports = [s['metrics'] for s in summaries if 'metrics' in s]
+    if args.prometheus and reports:
+        write_prometheus(reports, args.prometheus)
+    for report in reports:
+        # Per-page timings stay in each run_report.json
+        report.pop('page_timings', None)
+
+    failed = [s for s in summaries if s['status'] != 'ok']
+    unassigned = sum(len(s.get('unassigned_pages', [])) for s in summaries)
+    report = {
+        'files': len(pdf_files),
+        'failed': len(failed),
+        'total_pages': sum(s.get('total_pages', 0) for s in summaries),
+        'unassigned_pages': unassigned,
+        'results': summaries,
+    }
+    write_report(report, args.summary)
+
+    if failed:
+        return EXIT_FAILED
+    if args.fail_on_unassigned and unassigned:
+        return EXIT_UNASSIGNED
+    return EXIT_OK
+
+
+def run_serve(args):
+    store = open_store(args.mapping)
+    if not store.exists():
+        print(f"Mapping file not found: {args.mapping}", file=sys.stderr)
+        return EXIT_USAGE
+    settings = SplitSettings(
+        ocr_workers=args.workers,
+        ocr_backend=args.ocr_backend,
+        use_cache=not args.no_cache,
+        cache_file=args.cache_file,
+        report_name='run_report.json',
+        journal_name=None
+    )
+    service = SplitService(store, settings, jobs_dir=args.jobs_dir, job_threads=args.job_threads,
+                           log=stderr_log(), job_ttl=args.job_ttl * 3600)
+    serve(service, args.host, args.port)
+    return EXIT_OK
+
+
+def run_submit(args):
+    pdf_files = expand_inputs(args.pdfs)
+    if not pdf_files:
+        print("No PDF files matched", file=sys.stderr)
+        return EXIT_USAGE
+    options = {'mode': args.mode, 'tracking': args.tracking}
+    if args.region:
+        options['region'] = args.region
+    if args.adaptive:
+        options['adaptive'] = True
+    log = (lambda message: None) if args.quiet else stderr_log()
+    try:
+        summaries = run_remote(ServiceClient(args.server), pdf_files, args.output, log,
+                               priority=args.priority, **options)
+    except ServiceError as e:
+        write_report({'server': args.server, 'status': 'error', 'error': str(e)}, args.summary)
+        return EXIT_FAILED
+    unassigned = sum(len(s.get('unassigned_pages', [])) for s in summaries)
+    write_report({'server': args.server, 'files': len(pdf_files), 'unassigned_pages': unassigned,
+                  'results': summaries}, args.summary)
+    if args.fail_on_unassigned and unassigned:
+        return EXIT_UNASSIGNED
+    return EXIT_OK
+
+
+def run_excel(args):
+    if not os.path.exists(args.excel):
+        print(f"Excel file not found: {args.excel}", file=sys.stderr)
+        return EXIT_USAGE
+    try:
+        data_dict, column_names = read_excel_mapping(args.excel, args.tracking, args.ref_column,
+                                                     args.route_column, args.sheet)
+        added, changed, removed = open_store(args.mapping).update(data_dict, not args.keep_missing)
+    except Exception as e:
+        write_report({'excel': args.excel, 'status': 'error', 'error': str(e)}, args.summary)
+        return EXIT_FAILED
+    write_report({'excel': args.excel, 'mapping': args.mapping, 'status': 'ok',
+                  'entries': len(data_dict), 'columns': column_names,
+                  'added': len(added), 'changed': len(changed), 'removed': len(removed)}, args.summary)
+    return EXIT_OK
+
+
+def run_import(args):
+    if not os.path.exists(args.json):
+        print(f"JSON file not found: {args.json}", file=sys.stderr)
+        return EXIT_USAGE
+    try:
+        entries = open_store(args.mapping).import_json(args.json)
+    except Exception as e:
+        write_report({'json': args.json, 'status': 'error', 'error': str(e)}, args.summary)
+        return EXIT_FAILED
+    write_report({'json': args.json, 'mapping': args.mapping, 'status': 'ok', 'entries': entries}, args.summary)
+    return EXIT_OK
+
+
+def run_export(args):
+    store = open_store(args.mapping)
+    if not store.exists():
+        print(f"Mapping file not found: {args.mapping}", file=sys.stderr)
+        return EXIT_USAGE
+    store.export_json(args.json)
+    write_report({'json': args.json, 'mapping': args.mapping, 'status': 'ok', 'entries': len(store)}, args.summary)
+    return EXIT_OK
+
+
+def write_report(report, path):
+    text = json.dumps(report, indent=2)
+    if path:
+        with open(path, 'w') as f:
+            f.write(text + "\n")
+    else:
+        print(text)
+
+
+def build_parser():
+    parser = argparse.ArgumentParser(
+        description="Split driver manifests into one PDF per route without the GUI. "
+                    "A JSON summary is printed to stdout and log lines go to stderr."
+    )
+    parser.add_argument('--mapping', default='data/driver_data.json',
+                        help="mapping snapshot (.sqlite), or a JSON mapping kept in a snapshot "
+                             "next to it (default: %(default)s)")
+    parser.add_argument('--tesseract', help="path to the tesseract executable if it isn't on PATH")
+    parser.add_argument('--summary', help="write the JSON summary to this file instead of stdout")
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    excel = commands.add_parser('excel', help="update the mapping from an Excel workbook")
+    excel.add_argument('excel', help="Excel file with refs in column C and routes in column J")
+    excel.add_argument('--tracking', choices=['customer_ref', 'account_no'], default='customer_ref')
+    excel.add_argument('--ref-column', default='C', help="column holding the refs (default: %(default)s)")
+    excel.add_argument('--route-column', default='J', help="column holding the routes (default: %(default)s)")
+    excel.add_argument('--sheet', action='append', help="only read this sheet (repeatable; default: all sheets)")
+    excel.add_argument('--keep-missing', action='store_true',
+                       help="keep refs that aren't in the workbook instead of removing them")
+    excel.set_defaults(func=run_excel)
+
+    import_json = commands.add_parser('import', help="replace the mapping with a JSON mapping file")
+    import_json.add_argument('json', help="JSON object of customer ref -> route")
+    import_json.set_defaults(func=run_import)
+
+    export_json = commands.add_parser('export', help="write the mapping out as JSON")
+    export_json.add_argument('json', help="output JSON file")
+    export_json.set_defaults(func=run_export)
+
+    split = commands.add_parser('split', help="split PDFs into one PDF per route")
+    split.add_argument('pdfs', nargs='+', help="PDF files, directories or glob patterns")
+    split.add_argument('-o', '--output', required=True,
+                       help="output directory; with several PDFs each gets a subfolder unless --combine")
+    split.add_argument('-j', '--jobs', type=int, default=1, help="PDFs processed in parallel")
+    split.add_argument('--combine', action='store_true',
+                       help="sort all PDFs in one run into shared route files in the output folder")
+    split.add_argument('--mode', choices=EXTRACTION_MODES, default='hybrid')
+    split.add_argument('--region', default='auto', help="OCR region name or 'auto' (default: %(default)s)")
+    split.add_argument('--fuzzy-edits', type=int, default=0, choices=[0, 1, 2])
+    split.add_argument('--tracking', choices=TRACKING_MODES, default='auto_detect',
+                       help="detect each PDF's reference layout, or force customer refs or account numbers")
+    split.add_argument('--dpi', type=int, default=200)
+    split.add_argument('--adaptive', action='store_true',
+                       help="OCR binarized at --adaptive-dpi first and re-OCR only pages with no confident reference")
+    split.add_argument('--adaptive-dpi', type=int, default=150)
+    split.add_argument('--escalation-dpi', type=int, default=300)
+    split.add_argument('--min-confidence', type=int, default=70,
+                       help="Tesseract word confidence (0-100) below which an adaptive run re-OCRs the page")
+    split.add_argument('--chunk', type=int, default=10, help="pages rendered per chunk")
+    split.add_argument('--threads', type=int, default=2, help="render threads per chunk")
+    split.add_argument('--page-budget', type=int, default=30,
+                       help="most pages read or rendered ahead of matching (sets peak memory and temp space)")
+    split.add_argument('--workers', type=int, help="OCR worker processes per PDF (default: cores / jobs)")
+    split.add_argument('--ocr-backend', choices=OCR_BACKENDS, default='auto',
+                       help="tesserocr keeps Tesseract loaded, subprocess runs the executable (default: tesserocr if installed)")
+    split.add_argument('--write-workers', type=int, default=4, help="route PDFs written in parallel")
+    split.add_argument('--color', action='store_true', help="render in colour instead of grayscale")
+    split.add_argument('--no-cache', action='store_true', help="don't read or write the page cache")
+    split.add_argument('--no-dedupe', action='store_true',
+                       help="extract every page, even repeats of an earlier page and blank scans")
+    split.add_argument('--no-segment', action='store_true',
+                       help="classify every page on its own instead of following multi-page documents")
+    split.add_argument('--visual-segment', action='store_true',
+                       help="also treat scanned pages with nothing in the OCR region as later pages of a document")
+    split.add_argument('--cache-file', default='data/page_cache.sqlite')
+    split.add_argument('--no-report', action='store_true', help="don't write run_report.json to the output folders")
+    split.add_argument('--no-resume', action='store_true',
+                       help="start over instead of resuming an interrupted run into the same folder")
+    split.add_argument('--prometheus', help="write run metrics to this Prometheus textfile (e.g. for node_exporter)")
+    split.add_argument('--fail-on-unassigned', action='store_true',
+                       help=f"exit with status {EXIT_UNASSIGNED} if any page matched no route")
+    split.add_argument('-q', '--quiet', action='store_true', help="no log output")
+    split.set_defaults(func=run_split)
+
+    serve_cmd = commands.add_parser('serve', help="run the split service other workstations submit PDFs to")
+    serve_cmd.add_argument('--host', default='127.0.0.1',
+                           help="address to listen on; 0.0.0.0 for the whole network (default: %(default)s)")
+    serve_cmd.add_argument('--port', type=int, default=8765)
+    serve_cmd.add_argument('--jobs-dir', default='data/jobs', help="where uploads and outputs are kept")
+    serve_cmd.add_argument('--job-threads', type=int, default=2, help="jobs run at the same time")
+    serve_cmd.add_argument('--job-ttl', type=float, default=JOB_TTL / 3600,
+                           help="hours a finished job is kept for its client to download (default: %(default)g)")
+    serve_cmd.add_argument('--workers', type=int, help="OCR worker processes shared by all jobs (default: cores)")
+    serve_cmd.add_argument('--ocr-backend', choices=OCR_BACKENDS, default='auto')
+    serve_cmd.add_argument('--no-cache', action='store_true', help="don't read or write the page cache")
+    serve_cmd.add_argument('--cache-file', default='data/page_cache.sqlite')
+    serve_cmd.set_defaults(func=run_serve)
+
+    submit = commands.add_parser('submit', help="split PDFs on a running split service")
+    submit.add_argument('server', help="service URL, e.g. http://depot-server:8765")
+    submit.add_argument('pdfs', nargs='+', help="PDF files, directories or glob patterns")
+    submit.add_argument('-o', '--output', required=True,
+                        help="output directory; with several PDFs each gets a subfolder")
+    submit.add_argument('--priority', type=int, default=0, help="higher runs first (default: %(default)s)")
+    submit.add_argument('--mode', choices=EXTRACTION_MODES, default='hybrid')
+    submit.add_argument('--region', help="OCR region name on the service, or 'auto'")
+    submit.add_argument('--tracking', choices=TRACKING_MODES, default='auto_detect')
+    submit.add_argument('--adaptive', action='store_true', help="adaptive OCR (see split --adaptive)")
+    submit.add_argument('--fail-on-unassigned', action='store_true',
+                        help=f"exit with status {EXIT_UNASSIGNED} if any page matched no route")
+    submit.add_argument('-q', '--quiet', action='store_true', help="no log output")
+    submit.set_defaults(func=run_submit)
+    return parser
+
+
+def main(argv=None):
+    args = build_parser().parse_args(argv)
+    if args.tesseract:
+        pytesseract.pytesseract.tesseract_cmd = args.tesseract
+    return args.func(args)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,74 @@
+import os
+from openpyxl import load_workbook
+from openpyxl.utils import column_index_from_string
+
+# Ref cells that label a column rather than hold a ref
+HEADER_LABELS = {'store code', 'customer ref', 'customer reference', 'cust ref', 'ref',
+                 'account', 'account no', 'account number'}
+
+COLUMN_NAMES = {
+    'customer_ref': ["Customer Ref", "Route"],
+    'account_no': ["Account Number", "Route"],
+}
+
+
+def cell_text(value):
+    # Excel stores codes typed as numbers as floats; 1234.0 should read "1234"
+    if value is None:
+        return ""
+    if isinstance(value, float) and value.is_integer():
+        value = int(value)
+    return str(value)
+
+
+def is_header_row(ref, route):
+    return ref.rstrip('.:').lower() in HEADER_LABELS or route.strip().lower() in ('route', 'routes')
+
+
+def iter_xlsx_rows(path, ref_col, route_col, sheets=None):
+    # Streams (ref, route) cell values from each sheet in read-only mode,
+    # reading only the columns between the two
+    workbook = load_workbook(path, read_only=True, data_only=True)
+    try:
+        first_col = min(ref_col, route_col)
+        for sheet_name in sheets or workbook.sheetnames:
+            worksheet = workbook[sheet_name]
+            for row in worksheet.iter_rows(min_col=first_col, max_col=max(ref_col, route_col), values_only=True):
+                if len(row) > max(ref_col, route_col) - first_col:
+                    yield row[ref_col - first_col], row[route_col - first_col]
+    finally:
+        workbook.close()
+
+
+def iter_xls_rows(path, ref_col, route_col, sheets=None):
+    # openpyxl can't read the old .xls format, so those still go through pandas
+    import pandas as pd
+    frames = pd.read_excel(path, sheet_name=sheets or None, header=None,
+                           usecols=[ref_col - 1, route_col - 1], dtype=object)
+    for frame in frames.values():
+        for ref, route in frame.itertuples(index=False):
+            yield (None if pd.isna(ref) else ref), (None if pd.isna(route) else route)
+
+
+def read_excel_mapping(excel_file, tracking_method='customer_ref', ref_column='C', route_column='J',
+                       sheets=None):
+    # Returns ({ref: route}, column_names) from the ref and route columns of
+    # every sheet (or just the named ones). Blank rows, rows missing either
+    # value and header rows are skipped; a ref listed twice keeps its last route.
+    ref_col = column_index_from_string(ref_column)
+    route_col = column_index_from_string(route_column)
+    if os.path.splitext(excel_file)[1].lower() == '.xls':
+        rows = iter_xls_rows(excel_file, ref_col, route_col, sheets)
+    else:
+        rows = iter_xlsx_rows(excel_file, ref_col, route_col, sheets)
+
+    data_dict = {}
+    for ref, route in rows:
+        ref = cell_text(ref).strip()
+        route = cell_text(route)
+        if not ref or not route.strip() or ref.lower() == 'nan' or route.lower() == 'nan':
+            continue
+        if is_header_row(ref, route):
+            continue
+        data_dict[ref] = route
+    return data_dict, COLUMN_NAMES.get(tracking_method, COLUMN_NAMES['customer_ref'])
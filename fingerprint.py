@@ -0,0 +1,92 @@
+from collections import deque
+from PIL import Image
+
+# Share of dark pixels below which a rendered page counts as blank. A
+# single printed word is a few times this; specks of scanner dust are less.
+BLANK_INK_RATIO = 0.0002
+
+# Grey level below which a pixel counts as ink
+INK_LEVEL = 128
+
+
+def is_blank(image, ink_ratio=BLANK_INK_RATIO):
+    # Judged at full resolution: shrinking the page first would fade thin
+    # strokes below INK_LEVEL
+    histogram = image.convert('L').histogram()
+    width, height = image.size
+    return sum(histogram[:INK_LEVEL]) <= ink_ratio * width * height
+
+
+def dhash(image, size=16):
+    # Difference hash: one bit per horizontally adjacent pair of cells of a
+    # size x size grid, set where brightness drops. Rescans of the same
+    # page land within a few bits of each other.
+    cells = list(image.convert('L').resize((size + 1, size)).getdata())
+    value = 0
+    for row in range(size):
+        for column in range(size):
+            left = cells[row * (size + 1) + column]
+            right = cells[row * (size + 1) + column + 1]
+            value = (value << 1) | (left > right)
+    return value
+
+
+def scan_fingerprint(path):
+    # Perceptual hash of a rendered page, or None if the page is blank
+    with Image.open(path) as image:
+        if is_blank(image):
+            return None
+        return dhash(image)
+
+
+def hamming(a, b):
+    return bin(a ^ b).count('1')
+
+
+def ref_band(customer_ref, lines, margin=0.01):
+    # The OCR region of the line the reference was read from, if known
+    for text, top, bottom in lines or ():
+        if customer_ref in text:
+            return (0.0, max(0.0, top - margin), 1.0, min(1.0, bottom + margin))
+    return None
+
+
+class PageFingerprints:
+    # What one document's pages looked like and where they went, so repeats
+    # skip extraction. Pages with identical content streams (reprints of a
+    # delivery note, repeated separator sheets) reuse the first one's result
+    # outright. Scanned pages are compared by a perceptual hash of the
+    # rendered image, but a template shared by many customers looks the
+    # same at thumbnail size, so a near-duplicate only has the narrow band
+    # its reference was found in OCR'd: it's a copy if that reads the same
+    # reference. max_distance is how many of the hash's bits may differ;
+    # the last `recent` scanned pages are kept for comparison.
+    def __init__(self, max_distance=8, recent=200):
+        self.max_distance = max_distance
+        self.exact = {}
+        self.scans = deque(maxlen=recent)
+
+    def duplicate_of(self, key):
+        # (customer_ref, matched_by) of an earlier page with this content
+        return self.exact.get(key) if key else None
+
+    def remember(self, key, customer_ref, matched_by):
+        if key and key not in self.exact:
+            self.exact[key] = (customer_ref, matched_by)
+
+    def nearest(self, image_hash):
+        # (customer_ref, matched_by, band) of the closest earlier scan within
+        # max_distance, or None
+        best = None
+        best_distance = self.max_distance + 1
+        for scan_hash, customer_ref, matched_by, band in self.scans:
+            distance = hamming(image_hash, scan_hash)
+            if distance < best_distance:
+                best = (customer_ref, matched_by, band)
+                best_distance = distance
+        return best
+
+    def remember_scan(self, image_hash, customer_ref, matched_by, lines):
+        band = ref_band(customer_ref, lines)
+        if band is not None:
+            self.scans.append((image_hash, customer_ref, matched_by, band))
@@ -0,0 +1,98 @@
+from collections import Counter
+
+# PDF tracking methods: detect the layout from the document itself, or
+# force the patterns for one kind of reference
+TRACKING_MODES = ('auto_detect', 'customer_ref', 'account_no')
+
+# Patterns a forced tracking method is limited to (besides the database search)
+FORCED_PATTERNS = {
+    'customer_ref': ('customer_ref', 'customer_ref_alt'),
+    'account_no': ('account_no', 'topa'),
+}
+
+
+def describe_region(region):
+    _, top, _, bottom = region
+    return f"{top:.0%}-{bottom:.0%} of the page height"
+
+
+class FormatDetector:
+    # Picks the layout of one document from its first pages: the pattern
+    # its references match, whether they come from the text layer or OCR,
+    # and the OCR region they were read from. Every page goes through the
+    # full pattern cascade until sample_pages pages with a reference have
+    # been seen; then each part of the layout that at least min_share of
+    # them agree on is locked in for the rest of the document. The winning
+    # pattern is tried first, a document whose references only OCR finds is
+    # OCR'd without reading the text layer first, and OCR uses the winning
+    # region. Pages where the locked layout finds nothing still get the full
+    # cascade. With a forced tracking method only its patterns are tried and
+    # just the source and region are detected.
+    def __init__(self, tracking='auto_detect', sample_pages=5, min_share=0.8, log=None):
+        if tracking not in TRACKING_MODES:
+            raise ValueError(f"Unknown tracking method: {tracking}")
+        self.tracking = tracking
+        self.forced = FORCED_PATTERNS.get(tracking)
+        self.sample_pages = sample_pages
+        self.min_share = min_share
+        self.log = log or (lambda message: None)
+        self.samples = []
+        self.seen = 0
+        self.decided = sample_pages <= 0
+        self.pattern = None
+        self.source = None
+        self.region = None
+
+    def patterns(self):
+        # (patterns to try first, whether they're the only ones) for find()
+        if self.forced:
+            return self.forced, True
+        if self.pattern:
+            return (self.pattern,), False
+        return None, False
+
+    def ocr_first(self):
+        return self.source == 'ocr'
+
+    def observe(self, matched_by, source, region=None):
+        # One page's outcome, in page order. Cached pages and OCR failures
+        # say nothing about the layout. Pages without a reference (cover
+        # sheets, continuation pages) don't count towards the sample, but
+        # a document that has too few references gets no layout.
+        if self.decided or source not in ('text', 'ocr'):
+            return
+        self.seen += 1
+        if matched_by:
+            self.samples.append((matched_by, source, region))
+        if len(self.samples) >= self.sample_pages:
+            self.decide()
+        elif self.seen >= self.sample_pages * 4:
+            self.decided = True
+            self.log(f"Only {len(self.samples)} references in the first {self.seen} pages, "
+                     f"using the full pattern cascade")
+
+    def winner(self, values):
+        value, count = Counter(values).most_common(1)[0]
+        return value if count >= self.min_share * len(values) else None
+
+    def decide(self):
+        self.decided = True
+        pattern = self.winner([matched_by for matched_by, _, _ in self.samples])
+        # The database search already runs last, so there's nothing to lock
+        if not self.forced and pattern != 'database':
+            self.pattern = pattern
+        self.source = self.winner([source for _, source, _ in self.samples])
+        if self.source == 'ocr':
+            self.region = self.winner([region for _, _, region in self.samples])
+
+        parts = []
+        if self.pattern:
+            parts.append(f"'{self.pattern}' references")
+        if self.source:
+            parts.append("from the text layer" if self.source == 'text' else "from OCR")
+        if self.region:
+            parts.append(f"in the band at {describe_region(self.region)}")
+        if parts:
+            self.log(f"Detected document layout from {len(self.samples)} pages: {', '.join(parts)}")
+        else:
+            self.log(f"No consistent layout in the first {self.seen} pages, using the full pattern cascade")
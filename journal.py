@@ -0,0 +1,119 @@
+import os
+import json
+import hashlib
+
+
+def file_digest(path, block_size=1024 * 1024):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(block_size), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+class RunJournal:
+    # Append-only record of a split run, one JSON line per classified page,
+    # so a run that was interrupted (cancelled, crashed, machine rebooted)
+    # can pick up where it stopped. The first line holds the run's key: the
+    # PDF's content hash, the mapping digest and the settings that affect
+    # classification. A journal with a different key is from another run
+    # and is started over. Every line is flushed as it's written and synced
+    # to disk every sync_every pages; a torn last line from a crash is
+    # dropped when the journal is read back.
+    def __init__(self, path, key, sync_every=25):
+        self.path = path
+        self.key = key
+        self.sync_every = sync_every
+        self.entries = {}
+        self.classified = False
+        self.file = None
+        self.unsynced = 0
+        self.valid_end = 0
+
+    def load(self):
+        # Reads back pages recorded by an earlier attempt at the same run.
+        # Returns the number of pages found.
+        self.entries = {}
+        self.classified = False
+        try:
+            f = open(self.path, 'rb')
+        except OSError:
+            return 0
+        valid_end = 0
+        with f:
+            for number, line in enumerate(f):
+                if not line.endswith(b'\n'):
+                    break
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    break
+                if number == 0:
+                    if record.get('key') != self.key:
+                        return 0
+                elif record.get('classified'):
+                    self.classified = True
+                elif 'page' in record:
+                    self.entries[record['page'] - 1] = record
+                valid_end += len(line)
+        self.valid_end = valid_end
+        return len(self.entries)
+
+    def resume_point(self):
+        # First page not yet classified; pages are recorded in order
+        page_num = 0
+        while page_num in self.entries:
+            page_num += 1
+        return page_num
+
+    def start(self, resume=True):
+        # Opens the journal for appending, keeping what load() found if
+        # resume is set and starting a fresh one otherwise
+        os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+        if resume and self.entries:
+            self.file = open(self.path, 'r+b')
+            self.file.truncate(self.valid_end)
+            self.file.seek(self.valid_end)
+        else:
+            self.entries = {}
+            self.classified = False
+            self.file = open(self.path, 'wb')
+            self.write({'key': self.key})
+            self.sync()
+
+    def write(self, record):
+        self.file.write(json.dumps(record).encode('utf-8') + b'\n')
+        self.file.flush()
+
+    def sync(self):
+        os.fsync(self.file.fileno())
+        self.unsynced = 0
+
+    def record(self, page_num, source, customer_ref, route, lookup):
+        entry = {'page': page_num + 1, 'source': source, 'customer_ref': customer_ref,
+                 'route': route, 'lookup': lookup}
+        self.entries[page_num] = entry
+        self.write(entry)
+        self.unsynced += 1
+        if self.unsynced >= self.sync_every:
+            self.sync()
+
+    def mark_classified(self):
+        self.classified = True
+        self.write({'classified': True})
+        self.sync()
+
+    def close(self):
+        if self.file is not None:
+            if not self.file.closed:
+                self.sync()
+                self.file.close()
+            self.file = None
+
+    def discard(self):
+        # Called once the run's output is written; there's nothing left to resume
+        self.close()
+        try:
+            os.remove(self.path)
+        except OSError:
+            pass
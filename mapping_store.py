@@ -0,0 +1,241 @@
+import os
+import sys
+import json
+import hashlib
+import sqlite3
+import threading
+
+
+def mapping_digest(mapping):
+    # Content hash of a mapping, independent of insertion order
+    digest = hashlib.sha256()
+    for ref in sorted(mapping):
+        digest.update(ref.encode('utf-8') + b'\0' + mapping[ref].encode('utf-8') + b'\n')
+    return digest.hexdigest()
+
+
+def diff_mappings(old, new, remove_missing=True):
+    # Returns (added, changed, removed): refs new to the mapping with their
+    # routes, refs whose route changed with the new route, and refs no
+    # longer present (only with remove_missing)
+    added = {}
+    changed = {}
+    for ref, route in new.items():
+        old_route = old.get(ref)
+        if old_route is None:
+            added[ref] = route
+        elif old_route != route:
+            changed[ref] = route
+    removed = [ref for ref in old if ref not in new] if remove_missing else []
+    return added, changed, removed
+
+
+def read_json_mapping(path):
+    with open(path, 'r') as f:
+        return {str(ref): str(route) for ref, route in json.load(f).items()}
+
+
+def open_store(path):
+    # A .json path is taken as a legacy mapping, kept in a snapshot next to it
+    if path.endswith('.json'):
+        return MappingStore(os.path.splitext(path)[0] + '.sqlite', import_from=path)
+    return MappingStore(path)
+
+
+class MappingStore:
+    # The customer ref -> route mapping, loaded once and kept in memory.
+    # Route names are interned, since thousands of refs share a few dozen
+    # routes. The on-disk copy is a SQLite snapshot with the routes stored
+    # once in their own table. reload() is cheap to call often: it only
+    # re-reads the snapshot when its mtime or size has changed, and even
+    # then keeps the loaded mapping if the content hash is the same.
+    # version goes up whenever the mapping changes, so anything built from
+    # it (matchers, indexes) knows when to rebuild.
+    #
+    # import_from names a legacy JSON mapping. It's imported when there's
+    # no snapshot yet, or when the JSON has been modified since its last
+    # import.
+    def __init__(self, path='data/driver_data.sqlite', import_from=None):
+        self.path = path
+        self.import_from = import_from
+        self.lock = threading.Lock()
+        self.mapping = {}
+        self.digest = None
+        self.imported_mtime = None
+        self.version = 0
+        self.signature = None
+        self.reload()
+
+    def connect(self):
+        os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+        conn = sqlite3.connect(self.path)
+        conn.execute("CREATE TABLE IF NOT EXISTS routes (id INTEGER PRIMARY KEY, name TEXT UNIQUE)")
+        conn.execute("CREATE TABLE IF NOT EXISTS refs (ref TEXT PRIMARY KEY, route_id INTEGER)")
+        conn.execute("CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)")
+        return conn
+
+    def file_signature(self):
+        try:
+            stat = os.stat(self.path)
+        except OSError:
+            return None
+        return (stat.st_mtime_ns, stat.st_size)
+
+    def reload(self):
+        # Returns True if the in-memory mapping changed
+        with self.lock:
+            changed = False
+            signature = self.file_signature()
+            if signature is not None and signature != self.signature:
+                changed = self.load_snapshot()
+            if self.json_needs_import():
+                self.save(read_json_mapping(self.import_from), os.path.getmtime(self.import_from))
+                changed = True
+            return changed
+
+    def load_snapshot(self):
+        conn = self.connect()
+        try:
+            return self.read_snapshot(conn)
+        finally:
+            conn.close()
+
+    def read_snapshot(self, conn):
+        # Loads the snapshot through an open connection unless its content
+        # hash matches the loaded mapping. Returns True if the mapping changed.
+        meta = dict(conn.execute("SELECT key, value FROM meta"))
+        self.signature = self.file_signature()
+        if 'imported_mtime' in meta:
+            self.imported_mtime = float(meta['imported_mtime'])
+        if meta.get('digest') is not None and meta['digest'] == self.digest:
+            return False
+        routes = {route_id: sys.intern(name) for route_id, name in conn.execute("SELECT id, name FROM routes")}
+        mapping = {ref: routes[route_id] for ref, route_id in conn.execute("SELECT ref, route_id FROM refs ORDER BY rowid")}
+        self.set_mapping(mapping, meta.get('digest'))
+        return True
+
+    def json_needs_import(self):
+        if not self.import_from:
+            return False
+        try:
+            mtime = os.path.getmtime(self.import_from)
+        except OSError:
+            return False
+        return self.imported_mtime is None or self.imported_mtime < mtime
+
+    def import_json(self, path):
+        # Replace the mapping with the contents of a JSON mapping file
+        mapping = read_json_mapping(path)
+        with self.lock:
+            self.save(mapping)
+        return len(mapping)
+
+    def replace(self, mapping):
+        with self.lock:
+            self.save(mapping)
+
+    def update(self, mapping, remove_missing=True):
+        # Applies mapping to the store as a diff, touching only the rows that
+        # changed. Returns (added, changed, removed) as from diff_mappings().
+        # The diff is taken against the snapshot as it is inside the write
+        # transaction, so changes another process made since this store last
+        # loaded it aren't clobbered or re-inserted.
+        with self.lock:
+            if not self.exists():
+                added, changed, removed = diff_mappings(self.mapping, mapping, remove_missing)
+                if added or changed or removed:
+                    self.save(mapping if remove_missing else {**self.mapping, **mapping})
+                return added, changed, removed
+
+            conn = self.connect()
+            conn.isolation_level = None
+            try:
+                conn.execute("BEGIN IMMEDIATE")
+                try:
+                    self.read_snapshot(conn)
+                    added, changed, removed = diff_mappings(self.mapping, mapping, remove_missing)
+                    if not (added or changed or removed):
+                        conn.execute("COMMIT")
+                        return added, changed, removed
+
+                    route_ids = dict(conn.execute("SELECT name, id FROM routes"))
+                    for route in set(added.values()) | set(changed.values()):
+                        if route not in route_ids:
+                            route_ids[route] = conn.execute(
+                                "INSERT INTO routes (name) VALUES (?)", (route,)
+                            ).lastrowid
+                    conn.executemany("DELETE FROM refs WHERE ref = ?", ((ref,) for ref in removed))
+                    conn.executemany("UPDATE refs SET route_id = ? WHERE ref = ?",
+                                     ((route_ids[route], ref) for ref, route in changed.items()))
+                    conn.executemany("INSERT INTO refs (ref, route_id) VALUES (?, ?)",
+                                     ((ref, route_ids[route]) for ref, route in added.items()))
+                    conn.execute("DELETE FROM routes WHERE id NOT IN (SELECT route_id FROM refs)")
+
+                    # Same order as the snapshot: changed refs keep their place, new ones go last
+                    updated = dict(self.mapping)
+                    for ref in removed:
+                        del updated[ref]
+                    for ref, route in list(changed.items()) + list(added.items()):
+                        updated[str(ref)] = sys.intern(str(route))
+                    digest = mapping_digest(updated)
+                    conn.execute("INSERT OR REPLACE INTO meta (key, value) VALUES ('digest', ?)", (digest,))
+                    conn.execute("COMMIT")
+                except BaseException:
+                    conn.execute("ROLLBACK")
+                    raise
+            finally:
+                conn.close()
+            self.signature = self.file_signature()
+            self.set_mapping(updated, digest)
+            return added, changed, removed
+
+    def save(self, mapping, imported_mtime=None):
+        mapping = {str(ref): sys.intern(str(route)) for ref, route in mapping.items()}
+        digest = mapping_digest(mapping)
+        conn = self.connect()
+        try:
+            with conn:
+                conn.execute("DELETE FROM refs")
+                conn.execute("DELETE FROM routes")
+                route_ids = {route: route_id for route_id, route in enumerate(sorted(set(mapping.values())), 1)}
+                conn.executemany("INSERT INTO routes (id, name) VALUES (?, ?)",
+                                 ((route_id, route) for route, route_id in route_ids.items()))
+                conn.executemany("INSERT INTO refs (ref, route_id) VALUES (?, ?)",
+                                 ((ref, route_ids[route]) for ref, route in mapping.items()))
+                conn.execute("INSERT OR REPLACE INTO meta (key, value) VALUES ('digest', ?)", (digest,))
+                if imported_mtime is not None:
+                    conn.execute("INSERT OR REPLACE INTO meta (key, value) VALUES ('imported_mtime', ?)",
+                                 (repr(imported_mtime),))
+        finally:
+            conn.close()
+        if imported_mtime is not None:
+            self.imported_mtime = imported_mtime
+        self.signature = self.file_signature()
+        self.set_mapping(mapping, digest)
+
+    def set_mapping(self, mapping, digest=None):
+        # Swapped in whole, so readers on other threads see the old or the new mapping
+        digest = digest or mapping_digest(mapping)
+        self.mapping = mapping
+        if digest != self.digest:
+            self.digest = digest
+            self.version += 1
+
+    def exists(self):
+        return self.file_signature() is not None
+
+    def export_json(self, path):
+        with open(path, 'w') as f:
+            json.dump(self.mapping, f, indent=4)
+
+    def __len__(self):
+        return len(self.mapping)
+
+    def __contains__(self, ref):
+        return ref in self.mapping
+
+    def get(self, ref, default=None):
+        return self.mapping.get(ref, default)
+
+    def items(self):
+        return self.mapping.items()
@@ -0,0 +1,199 @@
+import re
+from collections import deque
+
+# Reference patterns in the order they are tried, as (name, pattern, group)
+REF_PATTERNS = [
+    # Account Number (as seen in the new file format)
+    ('account_no', re.compile(r'Account\s+No:?\s*([A-Z0-9]{4,10})\b', re.IGNORECASE), 1),
+    # TOPA format as seen in the new screenshot
+    ('topa', re.compile(r'\bTOPA\d{3}\b'), 0),
+    # Exact "Customer Ref." followed by value, the Around Noon format
+    ('customer_ref', re.compile(r'Customer\s+Ref\.?\s*[:.]?\s*([A-Z0-9]{3,10})\b', re.IGNORECASE), 1),
+    # Customer Ref followed by uppercase alphanumeric
+    ('customer_ref_alt', re.compile(r'(?:Customer|Cust)[\s\.]+Ref[\s\.]*[:.]?\s*([A-Z][A-Z0-9]{2,9})\b', re.IGNORECASE), 1),
+    # Special case for ARAM pattern as seen in screenshot
+    ('aram', re.compile(r'\bARAM\d{3}\b'), 0),
+    # Special case for KSG pattern as seen in previous screenshot
+    ('ksg', re.compile(r'\bKSG[A-Z]?\d{2,4}\b'), 0),
+]
+
+# Log message for each way a reference can be found
+PATTERN_LABELS = {
+    'account_no': "Found Account Number",
+    'topa': "Found TOPA Account Number",
+    'customer_ref': "Found exact Customer Ref",
+    'customer_ref_alt': "Found Customer Ref with alt pattern",
+    'aram': "Found ARAM reference",
+    'ksg': "Found KSG reference",
+    'database': "Found direct database match",
+}
+
+
+class AhoCorasick:
+    # Multi-pattern automaton over a list of keys. find_all() reports every
+    # key occurring anywhere in a text in a single pass over it.
+    def __init__(self, keys):
+        self.goto = [{}]
+        self.fail = [0]
+        self.output = [()]
+        for index, key in enumerate(keys):
+            state = 0
+            for char in key:
+                next_state = self.goto[state].get(char)
+                if next_state is None:
+                    next_state = len(self.goto)
+                    self.goto.append({})
+                    self.fail.append(0)
+                    self.output.append(())
+                    self.goto[state][char] = next_state
+                state = next_state
+            self.output[state] += (index,)
+
+        # Breadth-first pass to fill in failure links
+        queue = deque(self.goto[0].values())
+        while queue:
+            state = queue.popleft()
+            for char, next_state in self.goto[state].items():
+                queue.append(next_state)
+                fail = self.fail[state]
+                while fail and char not in self.goto[fail]:
+                    fail = self.fail[fail]
+                self.fail[next_state] = self.goto[fail].get(char, 0)
+                self.output[next_state] += self.output[self.fail[next_state]]
+
+    def find_all(self, text):
+        goto, fail, output = self.goto, self.fail, self.output
+        found = set()
+        state = 0
+        for char in text:
+            while state and char not in goto[state]:
+                state = fail[state]
+            state = goto[state].get(char, 0)
+            if output[state]:
+                found.update(output[state])
+        return found
+
+
+class RefMatcher:
+    # Finds the customer reference on a page. Built once per mapping: the
+    # patterns are compiled at import and the mapping's refs are loaded into
+    # an AhoCorasick automaton, so the last-resort database search is one
+    # scan of the page instead of one substring search per ref.
+    def __init__(self, refs):
+        self.refs = [ref for ref in refs if ref and len(ref) >= 3]
+        self.automaton = AhoCorasick(self.refs)
+        self.patterns = {name: (pattern, group) for name, pattern, group in REF_PATTERNS}
+
+    def candidates(self, text):
+        # Every mapping ref that occurs in the text, in mapping order
+        return [self.refs[index] for index in sorted(self.automaton.find_all(text))]
+
+    def find(self, text, patterns=None, strict=False):
+        # Returns (ref, how it was found), or (None, None). The named
+        # patterns are tried first, then the rest of the cascade unless
+        # strict is set.
+        if not text:
+            return None, None
+
+        for name in patterns or ():
+            pattern, group = self.patterns[name]
+            match = pattern.search(text)
+            if match:
+                return match.group(group).strip(), name
+        if not strict:
+            for name, pattern, group in REF_PATTERNS:
+                if patterns and name in patterns:
+                    continue
+                match = pattern.search(text)
+                if match:
+                    return match.group(group).strip(), name
+
+        # Only as a last resort, look for any ref from the mapping directly
+        found = self.automaton.find_all(text)
+        if found:
+            return self.refs[min(found)], 'database'
+        return None, None
+
+
+# Characters OCR commonly mistakes for each other, folded to one form
+OCR_CONFUSIONS = str.maketrans({'O': '0', 'I': '1', 'S': '5', 'B': '8'})
+
+
+def normalize_ref(ref):
+    return ref.replace(" ", "").upper()
+
+
+def edit_distance(a, b):
+    previous = list(range(len(b) + 1))
+    for i, char_a in enumerate(a, 1):
+        current = [i]
+        for j, char_b in enumerate(b, 1):
+            current.append(min(previous[j] + 1, current[j - 1] + 1, previous[j - 1] + (char_a != char_b)))
+        previous = current
+    return previous[-1]
+
+
+def deletion_variants(ref, max_distance):
+    # ref plus every string reachable from it by up to max_distance deletions
+    variants = {ref}
+    frontier = {ref}
+    for _ in range(max_distance):
+        frontier = {word[:i] + word[i + 1:] for word in frontier for i in range(len(word))}
+        variants |= frontier
+    return variants
+
+
+class RouteIndex:
+    # Route lookup for detected refs that aren't an exact key of the mapping.
+    # Keys are indexed once after normalisation (spaces removed, upper case),
+    # so those lookups are O(1). Misreads are handled by a deletion index
+    # over keys with OCR confusions (O/0, I/1, S/5, B/8) folded away: it finds
+    # keys within max_distance further edits without comparing against every
+    # key. Lookups that are ambiguous between routes return nothing rather
+    # than guess.
+    def __init__(self, mapping, max_distance=0, min_fuzzy_length=5):
+        self.mapping = mapping
+        self.max_distance = max_distance
+        self.min_fuzzy_length = min_fuzzy_length
+        self.normalized = {}
+        self.folded = {}
+        for db_ref in mapping:
+            normalized = normalize_ref(db_ref)
+            # Like the old linear search, the first key wins
+            self.normalized.setdefault(normalized, db_ref)
+            for variant in deletion_variants(normalized.translate(OCR_CONFUSIONS), max_distance):
+                self.folded.setdefault(variant, []).append(db_ref)
+
+    def lookup(self, ref):
+        # Returns (db_ref, route, edit_distance) or None
+        if ref in self.mapping:
+            return ref, self.mapping[ref], 0
+        normalized = normalize_ref(ref)
+        if normalized in self.normalized:
+            db_ref = self.normalized[normalized]
+            return db_ref, self.mapping[db_ref], 0
+        if len(normalized) < self.min_fuzzy_length:
+            return None
+        return self.fuzzy_lookup(normalized)
+
+    def fuzzy_lookup(self, normalized):
+        folded = normalized.translate(OCR_CONFUSIONS)
+        candidates = set()
+        for variant in deletion_variants(folded, self.max_distance):
+            candidates.update(self.folded.get(variant, ()))
+
+        scored = []
+        for db_ref in candidates:
+            db_normalized = normalize_ref(db_ref)
+            extra_edits = edit_distance(folded, db_normalized.translate(OCR_CONFUSIONS))
+            if extra_edits <= self.max_distance:
+                scored.append((extra_edits, edit_distance(normalized, db_normalized), db_ref))
+        if not scored:
+            return None
+
+        scored.sort()
+        best = [item for item in scored if item[:2] == scored[0][:2]]
+        if len({self.mapping[db_ref] for _, _, db_ref in best}) > 1:
+            return None
+        _, distance, db_ref = scored[0]
+        return db_ref, self.mapping[db_ref], distance
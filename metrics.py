@@ -0,0 +1,133 @@
+import os
+import json
+import time
+import threading
+from contextlib import contextmanager
+from atomic import atomic_open
+
+# Stages a run's time is split into
+STAGES = ('parse', 'rasterize', 'ocr', 'match', 'cache', 'write')
+
+
+class RunMetrics:
+    # Timings and counters for one split run. Stage time is wall-clock time
+    # spent in each stage on the thread running the pipeline (OCR is the
+    # time spent waiting for results, however many workers produce them;
+    # rendering ahead runs on its own thread, so rasterize overlaps the rest).
+    # Per-page entries record how long each page took to come out of the
+    # extractor, where its text came from and how it was routed.
+    def __init__(self):
+        self.started = time.time()
+        self.start_clock = time.perf_counter()
+        self.finished = None
+        self.stage_seconds = dict.fromkeys(STAGES, 0.0)
+        self.counters = {}
+        self.pages = []
+        self.lock = threading.Lock()
+
+    @contextmanager
+    def timer(self, stage):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - start
+            with self.lock:
+                self.stage_seconds[stage] = self.stage_seconds.get(stage, 0.0) + elapsed
+
+    def count(self, name, amount=1):
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + amount
+
+    def page(self, page_num, seconds, source, customer_ref, matched_by, route, lookup, pdf=None):
+        # pdf names the input the page is from in a batch run
+        entry = {
+            'page': page_num + 1,
+            'seconds': round(seconds, 4),
+            'source': source,
+            'customer_ref': customer_ref,
+            'matched_by': matched_by,
+            'route': route,
+            'lookup': lookup,
+        }
+        if pdf:
+            entry['pdf'] = pdf
+        self.pages.append(entry)
+
+    def finish(self):
+        self.finished = time.perf_counter() - self.start_clock
+
+    def report(self, summary):
+        # JSON-serialisable report for the run described by summary
+        seconds = self.finished if self.finished is not None else time.perf_counter() - self.start_clock
+        pages = len(self.pages)
+        return {
+            'pdf': summary['pdf'],
+            'output_dir': summary['output_dir'],
+            'started': time.strftime('%Y-%m-%dT%H:%M:%S%z', time.localtime(self.started)),
+            'seconds': round(seconds, 3),
+            'pages': pages,
+            'pages_per_second': round(pages / seconds, 2) if seconds > 0 else None,
+            'cancelled': summary['cancelled'],
+            'routes': len(summary['routes']),
+            'unassigned_pages': len(summary['unassigned_pages']),
+            'stage_seconds': {stage: round(value, 4) for stage, value in self.stage_seconds.items()},
+            'counters': dict(sorted(self.counters.items())),
+            'page_timings': self.pages,
+        }
+
+
+def write_atomic(path, text):
+    # Readers (and node_exporter) only ever see a complete file
+    directory = os.path.dirname(path) or '.'
+    os.makedirs(directory, exist_ok=True)
+    with atomic_open(path) as f:
+        f.write(text)
+
+
+def write_json_report(report, path):
+    write_atomic(path, json.dumps(report, indent=2) + "\n")
+
+
+def prometheus_text(reports):
+    # Prometheus textfile-collector metrics for the last run, summed over
+    # its reports (one per PDF)
+    def total(key):
+        return sum(report[key] or 0 for report in reports)
+
+    def summed(key):
+        values = {}
+        for report in reports:
+            for name, value in report[key].items():
+                values[name] = values.get(name, 0) + value
+        return values
+
+    seconds = total('seconds')
+    pages = total('pages')
+    lines = []
+
+    def metric(name, help_text, samples, kind='gauge'):
+        lines.append(f"# HELP transport_sorter_{name} {help_text}")
+        lines.append(f"# TYPE transport_sorter_{name} {kind}")
+        for labels, value in samples:
+            label_text = ",".join(f'{key}="{value}"' for key, value in labels.items())
+            lines.append(f"transport_sorter_{name}{{{label_text}}} {value}" if label_text
+                         else f"transport_sorter_{name} {value}")
+
+    metric('last_run_timestamp_seconds', "When the last run finished.", [({}, round(time.time(), 3))])
+    metric('last_run_files', "PDFs processed in the last run.", [({}, len(reports))])
+    metric('last_run_seconds', "Processing time of the last run.", [({}, round(seconds, 3))])
+    metric('last_run_pages', "Pages processed in the last run.", [({}, pages)])
+    metric('last_run_pages_per_second', "Throughput of the last run.",
+           [({}, round(pages / seconds, 3) if seconds > 0 else 0)])
+    metric('last_run_unassigned_pages', "Pages that matched no route in the last run.",
+           [({}, total('unassigned_pages'))])
+    metric('last_run_stage_seconds', "Time spent in each stage in the last run.",
+           [({'stage': stage}, round(value, 4)) for stage, value in summed('stage_seconds').items()])
+    metric('last_run_events', "Pattern matches, page sources, cache and lookup counts in the last run.",
+           [({'event': name}, value) for name, value in sorted(summed('counters').items())])
+    return "\n".join(lines) + "\n"
+
+
+def write_prometheus(reports, path):
+    write_atomic(path, prometheus_text(reports))
@@ -0,0 +1,444 @@
+import os
+import re
+import json
+import tempfile
+import threading
+import multiprocessing
+from concurrent.futures import Future, ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+import pytesseract
+from pytesseract import Output, TesseractNotFoundError
+from PIL import Image
+
+try:
+    import tesserocr
+except ImportError:  # Optional; OCR runs the tesseract executable instead
+    tesserocr = None
+
+# Tesseract settings used for every page
+OCR_CONFIG = '--psm 6'
+
+# Passes an adaptive run tries, in order, on pages whose cheap pass found no
+# reference or only a doubtful one, re-rendered at the higher DPI: the usual
+# block layout, then sparse text for headers scattered across the page
+ESCALATION_CONFIGS = ('--psm 6', '--psm 11')
+
+# Grey level below which a pixel counts as ink when binarizing
+BINARIZE_THRESHOLD = 160
+
+# How Tesseract is run: 'tesserocr' keeps one engine loaded per process,
+# 'subprocess' starts the tesseract executable for each batch of pages and
+# 'auto' uses tesserocr when it's installed
+OCR_BACKENDS = ('auto', 'tesserocr', 'subprocess')
+
+# Crop regions as (left, top, right, bottom) fractions of the page. Account
+# numbers, customer refs and the ARAM/KSG/TOPA codes all sit in the header,
+# so OCR'ing that band is usually enough. 'full' OCRs the whole page.
+OCR_REGIONS = {
+    'full': None,
+    'header': (0.0, 0.0, 1.0, 0.3),
+    'top_half': (0.0, 0.0, 1.0, 0.5),
+}
+
+
+class TesseractMissing(Exception):
+    # Raised in place of pytesseract's TesseractNotFoundError, which takes
+    # no arguments and so can't be unpickled when a worker process raises
+    # it. BatchItem.result() and ocr_page() turn it back into one.
+    pass
+
+
+def load_regions(path='data/ocr_regions.json'):
+    # Extra layouts can be added as {"name": [left, top, right, bottom]}
+    regions = dict(OCR_REGIONS)
+    try:
+        with open(path, 'r') as f:
+            for name, box in json.load(f).items():
+                regions[name] = tuple(box) if box else None
+    except FileNotFoundError:
+        pass
+    return regions
+
+
+def init_worker(tesseract_cmd, backend='auto', config=OCR_CONFIG):
+    # Worker processes don't necessarily inherit the path set by the app.
+    # The engine is loaded here so the first page doesn't wait for it.
+    pytesseract.pytesseract.tesseract_cmd = tesseract_cmd
+    try:
+        get_engine(backend, config)
+    except Exception:
+        pass  # Reported for the first page instead
+
+
+def crop_region(image, region):
+    left, top, right, bottom = region
+    width, height = image.size
+    return image.crop((int(left * width), int(top * height), int(right * width), int(bottom * height)))
+
+
+def prepare_image(image, region=None, binarize=False):
+    # The part of a rendered page to OCR, and the pixel offset of its top
+    offset = 0
+    if region is not None:
+        offset = int(region[1] * image.size[1])
+        image = crop_region(image, region)
+    if binarize:
+        image = image.convert('L').point(lambda value: 255 if value >= BINARIZE_THRESHOLD else 0, '1')
+    return image, offset
+
+
+def ref_confidence(ref, words):
+    # Tesseract confidence (0-100) of the words making up ref: a word that
+    # contains the whole ref, or the lowest of a run of consecutive words
+    # that spell it out ("CR 00001"). None if ref isn't among the words.
+    ref = ref.replace(" ", "").upper()
+    words = [(word.upper(), conf) for word, conf in words]
+    for word, conf in words:
+        if ref in word and conf >= 0:
+            return conf
+    for start in range(len(words)):
+        text = ""
+        for end in range(start, len(words)):
+            text += words[end][0]
+            if text == ref:
+                confidences = [conf for _, conf in words[start:end + 1] if conf >= 0]
+                return min(confidences) if confidences else None
+            if not ref.startswith(text):
+                break
+    return None
+
+
+def lines_from_data(data):
+    # Rebuild text lines from image_to_data output as {page index: ([(text,
+    # top, bottom)], [(word, confidence)])} in pixels of the OCR'd images
+    pages = {}
+    words = {}
+    for i, word in enumerate(data.get('text', [])):
+        if not word.strip():
+            continue
+        page = data['page_num'][i] - 1
+        words.setdefault(page, []).append((word.strip(), float(data['conf'][i])))
+        lines = pages.setdefault(page, {})
+        key = (data['block_num'][i], data['par_num'][i], data['line_num'][i])
+        word_top = data['top'][i]
+        word_bottom = word_top + data['height'][i]
+        entry = lines.setdefault(key, [[], word_top, word_bottom])
+        entry[0].append(word)
+        entry[1] = min(entry[1], word_top)
+        entry[2] = max(entry[2], word_bottom)
+    return {page: ([(" ".join(line_words), top, bottom) for line_words, top, bottom in lines.values()], words[page])
+            for page, lines in pages.items()}
+
+
+def page_output(lines, words, page_height, offset):
+    # (text, lines, words) with line positions as fractions of the page height
+    lines = [(text, (offset + top) / page_height, (offset + bottom) / page_height) for text, top, bottom in lines]
+    return "\n".join(text for text, _, _ in lines), lines, words
+
+
+def split_pages(text, count):
+    # Tesseract separates the pages of a multi-image run with form feeds
+    parts = text.split('\f')
+    if len(parts) == count + 1 and not parts[-1].strip():
+        parts.pop()
+    if len(parts) != count:
+        raise RuntimeError(f"Expected {count} pages of OCR output, got {len(parts)}")
+    return parts
+
+
+def config_option(config, option, default=None):
+    match = re.search(rf'{option}\s+(\S+)', config)
+    return match.group(1) if match else default
+
+
+class SubprocessEngine:
+    # Runs the tesseract executable through pytesseract. Starting it and
+    # loading the language model costs more than reading a header crop, so
+    # a batch of pages is OCR'd in one run: tesseract reads the image paths
+    # from a list file and separates the pages' text with form feeds. Whole
+    # pages are read straight from the rendered files; only crops are saved.
+    name = 'subprocess'
+
+    def __init__(self, config=OCR_CONFIG):
+        self.config = config
+
+    def ocr_pages(self, paths, region=None, want_lines=False, binarize=False):
+        with tempfile.TemporaryDirectory(prefix='ocr_') as temp_dir:
+            inputs = []
+            layout = []
+            for index, path in enumerate(paths):
+                with Image.open(path) as image:
+                    page_height = image.size[1]
+                    if region is None and not binarize:
+                        inputs.append(path)
+                        layout.append((page_height, 0))
+                        continue
+                    image, offset = prepare_image(image, region, binarize)
+                    crop_path = os.path.join(temp_dir, f"page_{index}.pnm")
+                    image.save(crop_path, format='PPM')
+                    inputs.append(crop_path)
+                    layout.append((page_height, offset))
+
+            source = inputs[0]
+            if len(inputs) > 1:
+                source = os.path.join(temp_dir, 'pages.txt')
+                with open(source, 'w') as f:
+                    f.write("\n".join(inputs) + "\n")
+
+            if not want_lines:
+                texts = split_pages(pytesseract.image_to_string(source, config=self.config), len(inputs))
+                return [(text, None, None) for text in texts]
+            data = pytesseract.image_to_data(source, config=self.config, output_type=Output.DICT)
+            pages = lines_from_data(data)
+            return [page_output(*pages.get(index, ([], [])), page_height, offset)
+                    for index, (page_height, offset) in enumerate(layout)]
+
+
+class TesserocrEngine:
+    # Keeps one Tesseract instance (and its language model) loaded for the
+    # life of the process, so each page only costs the recognition itself
+    name = 'tesserocr'
+
+    def __init__(self, config=OCR_CONFIG):
+        self.config = config
+        self.api = tesserocr.PyTessBaseAPI(lang=config_option(config, '-l', 'eng'),
+                                           psm=int(config_option(config, '--psm', tesserocr.PSM.AUTO)))
+
+    def ocr(self, image, want_lines):
+        self.api.SetImage(image)
+        if not want_lines:
+            return self.api.GetUTF8Text(), None, None
+        self.api.Recognize()
+        lines = []
+        for line in tesserocr.iterate_level(self.api.GetIterator(), tesserocr.RIL.TEXTLINE):
+            text = (line.GetUTF8Text(tesserocr.RIL.TEXTLINE) or '').strip()
+            box = line.BoundingBox(tesserocr.RIL.TEXTLINE)
+            if text and box:
+                lines.append((text, box[1], box[3]))
+        words = []
+        for word in tesserocr.iterate_level(self.api.GetIterator(), tesserocr.RIL.WORD):
+            text = (word.GetUTF8Text(tesserocr.RIL.WORD) or '').strip()
+            if text:
+                words.append((text, word.Confidence(tesserocr.RIL.WORD)))
+        return lines, words
+
+    def ocr_pages(self, paths, region=None, want_lines=False, binarize=False):
+        outputs = []
+        for path in paths:
+            try:
+                with Image.open(path) as image:
+                    page_height = image.size[1]
+                    image, offset = prepare_image(image, region, binarize)
+                    output = self.ocr(image, want_lines)
+                outputs.append(page_output(*output, page_height, offset) if want_lines else output)
+            except Exception as e:
+                outputs.append(RuntimeError(str(e)))
+        return outputs
+
+
+# Engines loaded in this process, by (backend, config)
+ENGINES = {}
+
+
+def resolve_backend(backend):
+    if backend == 'auto':
+        return 'tesserocr' if tesserocr is not None else 'subprocess'
+    if backend == 'tesserocr' and tesserocr is None:
+        raise RuntimeError("The tesserocr OCR backend is not installed")
+    return backend
+
+
+def get_engine(backend='auto', config=OCR_CONFIG):
+    engine = ENGINES.get((backend, config))
+    if engine is None:
+        if resolve_backend(backend) == 'tesserocr':
+            try:
+                engine = TesserocrEngine(config)
+            except RuntimeError:
+                # tesserocr is installed but can't find its language data
+                if backend != 'auto':
+                    raise
+                engine = SubprocessEngine(config)
+        else:
+            engine = SubprocessEngine(config)
+        ENGINES[(backend, config)] = engine
+    return engine
+
+
+def ocr_pages(paths, config=OCR_CONFIG, region=None, want_lines=False, backend='auto', binarize=False):
+    # OCR a batch of rendered page images, or just the given region of
+    # each, optionally binarized first. Returns one (text, lines, words)
+    # per page, or the exception if that page failed; with want_lines,
+    # lines is a list of (text, top, bottom) with positions as fractions of
+    # the page height and words a list of (word, confidence), otherwise
+    # both are None.
+    if not paths:
+        return []
+    try:
+        return get_engine(backend, config).ocr_pages(paths, region, want_lines, binarize)
+    except TesseractNotFoundError as e:
+        raise TesseractMissing(str(e)) from None
+    except TesseractMissing:
+        raise
+    except Exception as e:
+        if len(paths) == 1:
+            return [RuntimeError(str(e))]
+    # Something in the batch spoiled the run; go page by page to find it
+    return [ocr_pages([path], config, region, want_lines, backend, binarize)[0] for path in paths]
+
+
+def ocr_page(path, config=OCR_CONFIG, region=None, want_lines=False, backend='auto', binarize=False):
+    try:
+        output = ocr_pages([path], config, region, want_lines, backend, binarize)[0]
+    except TesseractMissing:
+        raise TesseractNotFoundError() from None
+    if isinstance(output, Exception):
+        raise output
+    return output
+
+
+class BatchItem:
+    # One page of a batch job, with the result() and cancel() of a Future
+    def __init__(self, future, index):
+        self.future = future
+        self.index = index
+
+    def result(self):
+        try:
+            output = self.future.result()[self.index]
+        except TesseractMissing:
+            raise TesseractNotFoundError() from None
+        if isinstance(output, Exception):
+            raise output
+        return output
+
+    def cancel(self):
+        return self.future.cancel()
+
+
+def batch_items(future, count):
+    return [BatchItem(future, index) for index in range(count)]
+
+
+class RegionLearner:
+    # Learns the band of the page holding the reference from the line
+    # positions of earlier full-page matches. Until min_samples matches have
+    # been seen, or if the band would cover most of the page, region()
+    # returns None and whole pages are OCR'd.
+    def __init__(self, min_samples=3, margin=0.03, max_height=0.5):
+        self.min_samples = min_samples
+        self.margin = margin
+        self.max_height = max_height
+        self.top = None
+        self.bottom = None
+        self.samples = 0
+
+    def observe(self, top, bottom):
+        self.top = top if self.top is None else min(self.top, top)
+        self.bottom = bottom if self.bottom is None else max(self.bottom, bottom)
+        self.samples += 1
+
+    def region(self):
+        if self.samples < self.min_samples:
+            return None
+        top = max(0.0, self.top - self.margin)
+        bottom = min(1.0, self.bottom + self.margin)
+        if bottom - top > self.max_height:
+            return None
+        return (0.0, top, 1.0, bottom)
+
+
+class InlineOcr:
+    # Runs OCR in this process behind the same interface as OcrPool
+    def __init__(self, config=OCR_CONFIG, backend='auto'):
+        self.config = config
+        self.backend = backend
+
+    def submit(self, path, region=None, want_lines=False):
+        return self.submit_batch([path], region, want_lines)[0]
+
+    def submit_batch(self, paths, region=None, want_lines=False, binarize=False, config=None):
+        # One job per page, all OCR'd in a single engine call. config
+        # overrides the pool's Tesseract settings for this batch.
+        future = Future()
+        try:
+            future.set_result(ocr_pages(paths, config or self.config, region, want_lines, self.backend, binarize))
+        except Exception as e:
+            future.set_exception(e)
+        return batch_items(future, len(paths))
+
+
+class OcrPool:
+    # Pool of worker processes running Tesseract so a run can use every core.
+    # Page images are handed over as file paths, so only a short string is
+    # pickled per page and each worker loads and releases its own image.
+    # Workers are spawned rather than forked (as they are on Windows anyway):
+    # pages are rendered on another thread meanwhile, and a fork taken while
+    # that thread holds a lock can leave the worker hung. Each worker loads
+    # its OCR engine once and keeps it for every page it gets. Several runs
+    # on different threads may share one pool. If a worker dies the pool is
+    # broken for good, so the next batch gets a fresh one.
+    def __init__(self, workers=None, config=OCR_CONFIG, backend='auto'):
+        self.workers = max(1, workers or os.cpu_count() or 1)
+        self.config = config
+        self.backend = backend
+        self.executor = None
+        self.lock = threading.Lock()
+
+    def start(self):
+        # Worker processes are only started once there is OCR work to do
+        with self.lock:
+            if self.executor is None:
+                self.executor = ProcessPoolExecutor(
+                    max_workers=self.workers,
+                    mp_context=multiprocessing.get_context('spawn'),
+                    initializer=init_worker,
+                    initargs=(pytesseract.pytesseract.tesseract_cmd, self.backend, self.config)
+                )
+            return self.executor
+
+    def submit(self, path, region=None, want_lines=False):
+        return self.submit_batch([path], region, want_lines)[0]
+
+    def submit_batch(self, paths, region=None, want_lines=False, binarize=False, config=None):
+        # One job per page. The pages are split into one batch per worker,
+        # so every worker is busy and each batch is a single engine call.
+        # config overrides the pool's Tesseract settings for this batch.
+        if not paths:
+            return []
+        executor = self.start()
+        size = -(-len(paths) // self.workers)
+        jobs = []
+        for start in range(0, len(paths), size):
+            batch = paths[start:start + size]
+            try:
+                future = executor.submit(ocr_pages, batch, config or self.config, region, want_lines,
+                                         self.backend, binarize)
+            except BrokenProcessPool:
+                if jobs:
+                    raise
+                executor = self.restart(executor)
+                future = executor.submit(ocr_pages, batch, config or self.config, region, want_lines,
+                                         self.backend, binarize)
+            jobs.extend(batch_items(future, len(batch)))
+        return jobs
+
+    def restart(self, broken):
+        # Replaces a broken executor (unless another thread already has)
+        with self.lock:
+            if self.executor is broken:
+                self.executor = None
+        broken.shutdown(wait=False)
+        return self.start()
+
+    def shutdown(self):
+        with self.lock:
+            if self.executor is not None:
+                self.executor.shutdown(wait=True)
+                self.executor = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.shutdown()
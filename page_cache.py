@@ -0,0 +1,109 @@
+import os
+import time
+import hashlib
+import sqlite3
+import threading
+
+
+def page_content_hash(page, settings=''):
+    # Content-addressed key for a PDF page: its content stream plus the data
+    # of every image or form it draws, so two scans with the same layout but
+    # different pixels get different keys. settings is mixed in so results
+    # from different extraction settings never collide. Streams are hashed
+    # as stored rather than decoded, so hashing an image page doesn't leave
+    # its decoded bitmap cached on the reader.
+    digest = hashlib.sha256(settings.encode('utf-8'))
+
+    def stream_data(stream):
+        data = getattr(stream, '_data', None)
+        return data if data is not None else stream.get_data()
+
+    def add_stream(obj, depth=0):
+        contents = obj.get_contents() if hasattr(obj, 'get_contents') else obj
+        if isinstance(contents, list):
+            for part in contents:
+                digest.update(stream_data(part.get_object()))
+        elif contents is not None:
+            digest.update(stream_data(contents))
+        resources = obj.get('/Resources')
+        if resources is None or depth > 3:
+            return
+        xobjects = resources.get_object().get('/XObject')
+        if xobjects is None:
+            return
+        for name, ref in sorted(xobjects.get_object().items()):
+            xobject = ref.get_object()
+            digest.update(name.encode('utf-8'))
+            if xobject.get('/Subtype') == '/Form':
+                add_stream(xobject, depth + 1)
+            else:
+                digest.update(stream_data(xobject))
+
+    add_stream(page)
+    return digest.hexdigest()
+
+
+class PageCache:
+    # Persistent cache of per-page extraction results (text, detected
+    # reference and how the text was obtained), stored in SQLite. The total
+    # size of cached text is bounded; once it goes over max_bytes the least
+    # recently used entries are evicted.
+    def __init__(self, path='data/page_cache.sqlite', max_bytes=200 * 1024 * 1024):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS pages ("
+            "key TEXT PRIMARY KEY, text TEXT, customer_ref TEXT, source TEXT, "
+            "size INTEGER, last_used REAL)"
+        )
+        self.conn.execute("CREATE INDEX IF NOT EXISTS pages_last_used ON pages (last_used)")
+        self.conn.commit()
+        self.total_bytes = self.conn.execute("SELECT COALESCE(SUM(size), 0) FROM pages").fetchone()[0]
+
+    def get(self, key):
+        # Returns (text, customer_ref, source) or None
+        with self.lock:
+            row = self.conn.execute(
+                "SELECT text, customer_ref, source FROM pages WHERE key = ?", (key,)
+            ).fetchone()
+            if row is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self.conn.execute("UPDATE pages SET last_used = ? WHERE key = ?", (time.time(), key))
+            self.conn.commit()
+            return row
+
+    def put(self, key, text, customer_ref, source):
+        size = len(text.encode('utf-8')) + len(key)
+        with self.lock:
+            old = self.conn.execute("SELECT size FROM pages WHERE key = ?", (key,)).fetchone()
+            self.conn.execute(
+                "INSERT OR REPLACE INTO pages (key, text, customer_ref, source, size, last_used) "
+                "VALUES (?, ?, ?, ?, ?, ?)",
+                (key, text, customer_ref, source, size, time.time())
+            )
+            self.total_bytes += size - (old[0] if old else 0)
+            if self.total_bytes > self.max_bytes:
+                self.evict()
+            self.conn.commit()
+
+    def evict(self):
+        # Drop least recently used entries until the cache is back to 90% of its limit
+        target = self.max_bytes * 0.9
+        doomed = []
+        for key, size in self.conn.execute("SELECT key, size FROM pages ORDER BY last_used"):
+            if self.total_bytes <= target:
+                break
+            doomed.append((key,))
+            self.total_bytes -= size
+        self.conn.executemany("DELETE FROM pages WHERE key = ?", doomed)
+
+    def close(self):
+        with self.lock:
+            self.conn.close()
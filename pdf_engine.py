@@ -0,0 +1,841 @@
+import sys
+import queue
+import tempfile
+import threading
+from contextlib import nullcontext
+import PyPDF2
+from PyPDF2.generic import IndirectObject
+from pdf2image import convert_from_path
+from pdf2image.exceptions import PDFInfoNotInstalledError, PopplerNotInstalledError
+from ocr import ESCALATION_CONFIGS, BrokenProcessPool, InlineOcr, TesseractNotFoundError, ref_confidence
+from format_detect import FormatDetector
+from fingerprint import PageFingerprints, scan_fingerprint
+from segment import DocumentSegmenter, band_is_empty, is_continuation
+from page_cache import page_content_hash
+
+# Check if running on Windows
+is_windows = sys.platform.startswith('win')
+
+
+def sample_text(text, limit=200):
+    # Short preview of extracted text for the log
+    return text[:limit] + "..." if len(text) > limit else text
+
+
+class PdfDocument:
+    # Opens and parses a PDF once. The text extraction, the OCR fallback and
+    # the output stage all share this reader instead of re-parsing the file
+    # (and its xref table) for every page.
+    def __init__(self, path):
+        self.path = path
+        self.file = open(path, 'rb')
+        try:
+            self.reader = PyPDF2.PdfReader(self.file)
+            self.page_count = len(self.reader.pages)
+        except Exception:
+            self.file.close()
+            raise
+
+    def page(self, page_num):
+        return self.reader.pages[page_num]
+
+    def page_text(self, page_num):
+        if page_num >= self.page_count:
+            return ""
+        return self.page(page_num).extract_text() or ""
+
+    def release(self, page_num):
+        # Drops the page's content and image streams from the reader's object
+        # cache once the page has been extracted, so what the reader holds
+        # doesn't grow with every page read. They're read back from the file
+        # if the output stage needs them again.
+        cache = self.reader.resolved_objects
+        try:
+            page = self.page(page_num)
+            streams = []
+            contents = page.raw_get('/Contents') if '/Contents' in page else None
+            if isinstance(contents, IndirectObject):
+                streams.append(contents)
+                contents = contents.get_object()
+            if isinstance(contents, list):
+                streams.extend(contents)
+
+            def add_xobjects(obj, depth=0):
+                resources = obj.get('/Resources')
+                if resources is None or depth > 3:
+                    return
+                xobjects = resources.get_object().get('/XObject')
+                if xobjects is None:
+                    return
+                xobjects = xobjects.get_object()
+                for name in xobjects:
+                    ref = xobjects.raw_get(name)
+                    streams.append(ref)
+                    xobject = ref.get_object()
+                    if xobject.get('/Subtype') == '/Form':
+                        add_xobjects(xobject, depth + 1)
+
+            add_xobjects(page)
+            for ref in streams:
+                if isinstance(ref, IndirectObject):
+                    cache.pop((ref.generation, ref.idnum), None)
+        except Exception:
+            # Only memory is at stake; the page is still readable either way
+            pass
+
+    def close(self):
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+def timer(metrics, stage):
+    # Times a stage into a RunMetrics, if there is one
+    return metrics.timer(stage) if metrics is not None else nullcontext()
+
+
+def chunk_pages(page_nums, chunk_size):
+    # Split page numbers into runs of consecutive pages no longer than chunk_size
+    chunk = []
+    for page_num in page_nums:
+        if chunk and (page_num != chunk[-1] + 1 or len(chunk) >= chunk_size):
+            yield chunk
+            chunk = []
+        chunk.append(page_num)
+    if chunk:
+        yield chunk
+
+
+class PageRasterizer:
+    # Renders pages to images a chunk at a time. Each pdf2image call starts
+    # pdftoppm and re-reads the whole PDF, so doing it once per chunk instead
+    # of once per page pays that cost far less often. Images are yielded
+    # lazily; with use_temp_dir they are written to a temporary directory and
+    # only loaded when the OCR stage touches them.
+    def __init__(self, pdf_path, dpi=200, grayscale=False, thread_count=1, chunk_size=10,
+                 use_temp_dir=True, log=None, metrics=None):
+        self.pdf_path = pdf_path
+        self.dpi = dpi
+        self.grayscale = grayscale
+        self.thread_count = max(1, thread_count)
+        self.chunk_size = max(1, chunk_size)
+        self.use_temp_dir = use_temp_dir
+        self.log = log or (lambda message: None)
+        self.metrics = metrics
+        # Cleared when poppler turns out not to be installed
+        self.available = True
+
+    def render(self, chunk, output_folder=None, paths_only=False):
+        with timer(self.metrics, 'rasterize'):
+            images = convert_from_path(
+                self.pdf_path,
+                dpi=self.dpi,
+                first_page=chunk[0] + 1,
+                last_page=chunk[-1] + 1,
+                grayscale=self.grayscale,
+                thread_count=min(self.thread_count, len(chunk)),
+                output_folder=output_folder,
+                paths_only=paths_only,
+            )
+        return list(zip(chunk, images))
+
+    def render_chunk(self, chunk, paths_only=False):
+        # Returns (rendered, temp_dir). If the chunk fails to render its pages
+        # come back with None so the caller can fall back.
+        temp_dir = tempfile.TemporaryDirectory() if self.use_temp_dir or paths_only else None
+        rendered = [(page_num, None) for page_num in chunk]
+        if self.available:
+            try:
+                rendered = self.render(chunk, temp_dir.name if temp_dir else None, paths_only)
+            except (PDFInfoNotInstalledError, PopplerNotInstalledError) as e:
+                self.log(f"Page rendering is not available: {str(e)}")
+                self.available = False
+            except Exception as e:
+                self.log(f"Error rendering pages {chunk[0]+1}-{chunk[-1]+1}: {str(e)}")
+        return rendered, temp_dir
+
+    def release_chunk(self, rendered, temp_dir, paths_only=False):
+        if not paths_only:
+            for _, image in rendered:
+                if image is not None:
+                    image.close()
+        if temp_dir:
+            temp_dir.cleanup()
+
+    def iter_chunks(self, page_nums, paths_only=False, prefetch=0):
+        # Yields one list of (page_num, image) per chunk, or (page_num, path)
+        # with paths_only. Rendered files live until the next chunk is
+        # requested. With prefetch, up to that many chunks are rendered ahead
+        # on a background thread while the caller works on the current one;
+        # the renderer waits once that many are ready, so it never gets
+        # further ahead of the caller than that however long the document.
+        if prefetch <= 0:
+            for chunk in chunk_pages(page_nums, self.chunk_size):
+                rendered, temp_dir = self.render_chunk(chunk, paths_only)
+                try:
+                    yield rendered
+                finally:
+                    self.release_chunk(rendered, temp_dir, paths_only)
+            return
+
+        ready = queue.Queue(maxsize=prefetch)
+        stop = threading.Event()
+
+        def offer(item):
+            # Blocks while the queue is full, unless the caller has gone away
+            while not stop.is_set():
+                try:
+                    ready.put(item, timeout=0.1)
+                    return True
+                except queue.Full:
+                    pass
+            return False
+
+        def render_ahead():
+            try:
+                for chunk in chunk_pages(page_nums, self.chunk_size):
+                    if stop.is_set():
+                        return
+                    item = self.render_chunk(chunk, paths_only)
+                    if not offer(item):
+                        self.release_chunk(*item, paths_only)
+                        return
+            finally:
+                offer(None)
+
+        renderer = threading.Thread(target=render_ahead, daemon=True)
+        renderer.start()
+        try:
+            while True:
+                item = ready.get()
+                if item is None:
+                    break
+                rendered, temp_dir = item
+                try:
+                    yield rendered
+                finally:
+                    self.release_chunk(rendered, temp_dir, paths_only)
+        finally:
+            stop.set()
+            renderer.join()
+            # Chunks rendered ahead that the caller never asked for
+            while True:
+                try:
+                    item = ready.get_nowait()
+                except queue.Empty:
+                    break
+                if item is not None:
+                    self.release_chunk(*item, paths_only)
+
+    def iter_images(self, page_nums):
+        # Yields (page_num, image) in page order, releasing each image once
+        # the caller is done with it
+        for rendered in self.iter_chunks(page_nums):
+            for page_num, image in rendered:
+                try:
+                    yield page_num, image
+                finally:
+                    if image is not None:
+                        image.close()
+
+
+# How page text is obtained:
+#   hybrid - embedded text layer first, OCR only pages where no reference is found
+#   text   - embedded text layer only
+#   ocr    - OCR every page, falling back to the text layer if that fails
+EXTRACTION_MODES = ('hybrid', 'text', 'ocr')
+
+# Counters kept by PageTextExtractor.stats
+EXTRACTION_STATS = ('text_layer', 'ocr', 'region', 'full_page', 'escalated', 'duplicate', 'blank',
+                    'continuation', 'fallback', 'cache')
+
+
+class PageResult:
+    # Text of one page, the customer reference found in it (if any) and the
+    # path that produced it: 'text', 'ocr', 'cache', 'duplicate' (a copy of
+    # an earlier page), 'blank', 'continuation' (a later page of a
+    # multi-page document) or 'fallback' (OCR failed or was unavailable, so
+    # the text layer was used). matched_by is the
+    # pattern that found the reference ('cache' if it was cached) and region
+    # the OCR region it was read from (None for the whole page).
+    def __init__(self, page_num, text, customer_ref=None, source='text', matched_by=None, region=None):
+        self.page_num = page_num
+        self.text = text
+        self.customer_ref = customer_ref
+        self.source = source
+        self.matched_by = matched_by
+        self.region = region
+
+
+class PageTextExtractor:
+    # Streams PageResults for the pages of an open PdfDocument. Text comes
+    # from the document's own reader and, where needed, from pages rendered
+    # by a PageRasterizer and OCR'd either in this process or on an OcrPool.
+    # find_ref(text, patterns, strict) is called on each page's text to pick
+    # up its customer reference, returning (ref, how it was found); the
+    # FormatDetector's layout says which patterns to try first and, once it
+    # knows a document is scanned, hybrid mode OCRs its pages before reading
+    # their text layer. OCR can be limited to a fixed region of the page, or to one
+    # learnt by a RegionLearner, with a full-page OCR only for pages where
+    # the region has no reference. Results can be kept in a PageCache so
+    # re-runs of the same document skip extraction. Setting cancel_event
+    # stops the stream between pages. stats counts how many pages took each
+    # path; with a RunMetrics, time spent parsing, waiting on OCR and in the
+    # cache is recorded too.
+    #
+    # page_budget caps how many pages are held between reading and matching:
+    # pages whose text layer was read but are still waiting for OCR, and
+    # pages rendered ahead of the OCR stage. Each page's streams are dropped
+    # from the document once its result has been handed on, so memory stays
+    # flat however many pages the document has.
+    #
+    # With an escalation rasterizer OCR is adaptive: pages are rendered by
+    # the main rasterizer at a low DPI and OCR'd binarized, and only pages
+    # where that finds no reference, or one Tesseract is less than
+    # min_confidence sure of, are re-rendered by the escalation rasterizer
+    # and OCR'd again with each of ESCALATION_CONFIGS until one finds a
+    # confident reference.
+    #
+    # With dedupe, repeated pages reuse the result of the first copy (see
+    # PageFingerprints) and rendered pages with no ink are routed as blank
+    # without being OCR'd.
+    #
+    # With segment, later pages of a multi-page document take the reference
+    # of its first page (see DocumentSegmenter). Pages whose text layer has
+    # a "Page x of y" marker with x > 1 are taken as continuations without
+    # being OCR'd. With visual_segment, so are scanned pages with nothing in
+    # the OCR region; that's off by default, as a new document with its
+    # reference outside the region looks the same.
+    def __init__(self, document, mode='hybrid', find_ref=None, rasterizer=None, ocr_pool=None,
+                 region=None, region_learner=None, cache=None, cancel_event=None, log=None,
+                 metrics=None, page_budget=30, detector=None, escalation=None, min_confidence=70,
+                 dedupe=False, segment=False, visual_segment=False):
+        if mode not in EXTRACTION_MODES:
+            raise ValueError(f"Unknown extraction mode: {mode}")
+        self.document = document
+        self.mode = mode
+        self.find_ref = find_ref or (lambda text, patterns=None, strict=False: (None, None))
+        self.log = log or (lambda message: None)
+        self.detector = detector or FormatDetector(log=self.log)
+        self.rasterizer = rasterizer or PageRasterizer(document.path, log=self.log)
+        self.ocr_engine = ocr_pool or InlineOcr()
+        self.region = region
+        self.region_learner = region_learner
+        self.cache = cache
+        self.cancel_event = cancel_event
+        self.metrics = metrics
+        self.escalation = escalation
+        self.min_confidence = min_confidence
+        self.fingerprints = PageFingerprints() if dedupe else None
+        self.segmenter = DocumentSegmenter() if segment else None
+        self.visual_segment = segment and visual_segment
+        chunk_size = self.rasterizer.chunk_size
+        self.window = max(chunk_size, page_budget)
+        # Chunks rendered ahead, besides the one being OCR'd
+        self.prefetch = max(0, self.window // chunk_size - 1)
+        self.ocr_available = True
+        self.stats = dict.fromkeys(EXTRACTION_STATS, 0)
+
+    def cancelled(self):
+        return self.cancel_event is not None and self.cancel_event.is_set()
+
+    def search(self, text):
+        # (ref, how it was found), trying the detected layout's patterns first
+        patterns, strict = self.detector.patterns()
+        return self.find_ref(text, patterns, strict)
+
+    def text_layer(self, page_num):
+        try:
+            with timer(self.metrics, 'parse'):
+                page_text = self.document.page_text(page_num)
+            self.log(f"Sample text from page {page_num+1}:\n{sample_text(page_text)}")
+            return page_text
+        except Exception as e:
+            self.log(f"Error extracting text from page {page_num}: {str(e)}")
+            return ""
+
+    def fallback_text(self, page_num):
+        # Direct text extraction reusing the already parsed document
+        try:
+            with timer(self.metrics, 'parse'):
+                page_text = self.document.page_text(page_num)
+            self.log(f"Sample text (fallback) from page {page_num+1}:\n{sample_text(page_text)}")
+            return page_text
+        except Exception as e:
+            self.log(f"Fallback also failed: {str(e)}")
+            return ""
+
+    def fallback(self, page_num, known_text):
+        # Result for a page whose OCR failed. In hybrid mode the text layer
+        # was already read and searched, so it is reused as is.
+        self.stats['fallback'] += 1
+        if page_num in known_text:
+            return PageResult(page_num, known_text[page_num], None, 'fallback')
+        self.log("Falling back to direct PDF text extraction...")
+        page_text = self.fallback_text(page_num)
+        customer_ref, matched_by = self.search(page_text)
+        return PageResult(page_num, page_text, customer_ref, 'fallback', matched_by)
+
+    def current_region(self):
+        if self.region is not None:
+            return self.region
+        if self.detector.region is not None:
+            return self.detector.region
+        return self.region_learner.region() if self.region_learner else None
+
+    def submit(self, pages, region, config=None):
+        # Submits (page_num, path) pairs as one batch, returning (page_num,
+        # path, job) for each. Full-page passes also report line positions
+        # while learning the region or to find a reference's band for
+        # spotting copies, and adaptive runs need every page's word
+        # confidences. The cheap adaptive pass is binarized.
+        adaptive = self.escalation is not None
+        want_lines = adaptive or self.fingerprints is not None or (region is None and self.region_learner is not None)
+        binarize = adaptive and config is None
+        paths = [path for _, path in pages if path]
+        try:
+            jobs = iter(self.ocr_engine.submit_batch(paths, region, want_lines, binarize, config) if paths else ())
+        except BrokenProcessPool as e:
+            self.ocr_unavailable(e)
+            return [(page_num, path, None) for page_num, path in pages]
+        return [(page_num, path, next(jobs) if path else None) for page_num, path in pages]
+
+    def ocr_unavailable(self, e):
+        # The remaining pages fall back to their text layer
+        if self.ocr_available:
+            self.log(f"OCR is not available, using the text layer only: {str(e) or type(e).__name__}")
+        self.ocr_available = False
+
+    def run_ocr(self, page_num, job):
+        # Wait for a submitted page. Returns (text, lines, words), or None if
+        # the page could not be OCR'd.
+        if job is None or not self.ocr_available:
+            return None
+        try:
+            output = job.result()
+            self.log(f"Sample text from page {page_num+1}:\n{sample_text(output[0])}")
+            return output
+        except TesseractNotFoundError as e:
+            self.log(f"Tesseract is not available, using the text layer only: {str(e)}")
+            self.ocr_available = False
+        except BrokenProcessPool as e:
+            self.ocr_unavailable(e)
+        except Exception as e:
+            self.log(f"Error extracting text from page {page_num}: {str(e)}")
+        return None
+
+    def collect(self, jobs):
+        # Results of (page_num, path, job) submissions in submission order,
+        # or None if the run was cancelled meanwhile
+        outputs = {}
+        for page_num, _, job in jobs:
+            if self.cancelled():
+                return None
+            with timer(self.metrics, 'ocr'):
+                outputs[page_num] = self.run_ocr(page_num, job)
+        return outputs
+
+    def learn(self, customer_ref, lines):
+        if self.region_learner is None:
+            return
+        for line_text, top, bottom in lines:
+            if customer_ref in line_text:
+                self.region_learner.observe(top, bottom)
+                return
+
+    def confidence(self, output, customer_ref):
+        # How sure Tesseract was of the reference (100 if it can't be told)
+        if not customer_ref:
+            return None
+        words = output[2]
+        confidence = ref_confidence(customer_ref, words) if words else None
+        return 100 if confidence is None else confidence
+
+    def escalate(self, jobs, outputs, found):
+        # Re-renders the chunk's pages whose cheap pass found no reference, or
+        # a doubtful one, at the escalation DPI and OCRs them with each of
+        # ESCALATION_CONFIGS in turn until a pass finds a confident one. The
+        # most confident reference seen wins; outputs and found are updated
+        # in place. Returns False if the run was cancelled meanwhile.
+        best = {}
+        for page_num, _, _ in jobs:
+            if page_num not in found:
+                continue
+            customer_ref = found[page_num][0]
+            confidence = self.confidence(outputs[page_num], customer_ref)
+            if customer_ref is None or confidence < self.min_confidence:
+                best[page_num] = confidence if customer_ref else -1
+        if not best:
+            return True
+
+        self.log(f"Escalating {len(best)} page(s) to {self.escalation.dpi} DPI OCR")
+        self.stats['escalated'] += len(best)
+        # The pages are scattered, so each run of consecutive ones is rendered on its own
+        pending = []
+        temp_dirs = []
+        try:
+            for run in chunk_pages(sorted(best), self.escalation.chunk_size):
+                rendered, temp_dir = self.escalation.render_chunk(run, paths_only=True)
+                temp_dirs.append(temp_dir)
+                pending += [(page_num, path) for page_num, path in rendered if path]
+            for config in ESCALATION_CONFIGS:
+                if not pending:
+                    break
+                passes = self.submit(pending, None, config)
+                try:
+                    results = self.collect(passes)
+                finally:
+                    for _, _, job in passes:
+                        if job is not None:
+                            job.cancel()
+                if results is None:
+                    return False
+
+                remaining = []
+                for page_num, path in pending:
+                    output = results[page_num]
+                    if output is None:
+                        continue
+                    customer_ref, matched_by = self.search(output[0])
+                    confidence = self.confidence(output, customer_ref)
+                    if customer_ref and confidence > best[page_num]:
+                        best[page_num] = confidence
+                        outputs[page_num] = output
+                        found[page_num] = (customer_ref, matched_by, None)
+                    if customer_ref is None or confidence < self.min_confidence:
+                        remaining.append((page_num, path))
+                pending = remaining
+        finally:
+            for temp_dir in temp_dirs:
+                self.escalation.release_chunk([], temp_dir, True)
+        return True
+
+    def screen(self, rendered, region):
+        # Rendered pages with no ink, and continuation pages with nothing in
+        # the OCR region, are settled without OCR. Pages that look like an
+        # earlier scan are only OCR'd in the band its reference was read
+        # from. Returns ({page_num: source} of settled pages, {page_num:
+        # band}, {page_num: (customer_ref, matched_by) of the earlier scan},
+        # {page_num: hash}).
+        settled, bands, copies, hashes = {}, {}, {}, {}
+        if self.fingerprints is None and not self.visual_segment:
+            return settled, bands, copies, hashes
+        with timer(self.metrics, 'ocr'):
+            for page_num, path in rendered:
+                if path is None:
+                    continue
+                try:
+                    if self.fingerprints is not None:
+                        image_hash = scan_fingerprint(path)
+                        if image_hash is None:
+                            settled[page_num] = 'blank'
+                            continue
+                    if self.visual_segment and region is not None and band_is_empty(path, region):
+                        settled[page_num] = 'continuation'
+                        continue
+                except Exception as e:
+                    self.log(f"Could not fingerprint page {page_num+1}: {str(e)}")
+                    continue
+                if self.fingerprints is None:
+                    continue
+                hashes[page_num] = image_hash
+                nearest = self.fingerprints.nearest(image_hash)
+                if nearest is not None:
+                    copies[page_num] = nearest[:2]
+                    bands[page_num] = nearest[2]
+        if settled:
+            self.log(f"{len(settled)} blank or continuation page(s), skipping OCR")
+        return settled, bands, copies, hashes
+
+    def iter_ocr(self, pages, known_text=None):
+        # OCR the given pages chunk by chunk, yielding PageResults in order.
+        # Every page of a chunk is submitted at once and results are
+        # collected in submission order, while the next chunks are rendered
+        # ahead within the page budget. Once OCR turns out to be unavailable
+        # the remaining pages fall back to their text layer.
+        known_text = known_text or {}
+        pages = list(pages)
+        done = 0
+        if self.ocr_available and self.rasterizer.available:
+            chunks = self.rasterizer.iter_chunks(pages, paths_only=True, prefetch=self.prefetch)
+            try:
+                for rendered in chunks:
+                    region = self.current_region()
+                    settled, bands, copies, hashes = self.screen(rendered, region)
+                    # Pages are submitted in one batch per OCR region
+                    groups = {}
+                    for page_num, path in rendered:
+                        if page_num not in settled:
+                            groups.setdefault(bands.get(page_num, region), []).append((page_num, path))
+                    jobs = [job for group_region, group in groups.items() for job in self.submit(group, group_region)]
+                    retries = []
+                    try:
+                        outputs = self.collect(jobs)
+                        if outputs is None:
+                            return
+
+                        # Pages with no reference in their OCR region get a
+                        # full-page pass. A near-duplicate whose band reads
+                        # the earlier scan's reference is a copy of it.
+                        refs = {}
+                        duplicates = set()
+                        missing = []
+                        for page_num, path, _ in jobs:
+                            if bands.get(page_num, region) is None or outputs[page_num] is None:
+                                continue
+                            refs[page_num] = self.search(outputs[page_num][0])
+                            if not refs[page_num][0]:
+                                missing.append((page_num, path))
+                            elif page_num in copies and refs[page_num][0] == copies[page_num][0]:
+                                duplicates.add(page_num)
+                                refs[page_num] = copies[page_num]
+                            else:
+                                self.stats['region'] += 1
+                        if missing:
+                            retries = self.submit(missing, None)
+                            if retries:
+                                self.log(f"No reference in the OCR region of {len(retries)} page(s), OCR'ing the full page")
+                                retried = self.collect(retries)
+                                if retried is None:
+                                    return
+                                for page_num, output in retried.items():
+                                    outputs[page_num] = output
+                                    del refs[page_num]
+                                    if output is not None:
+                                        self.stats['full_page'] += 1
+
+                        found = {}
+                        for page_num, _, _ in jobs:
+                            if outputs[page_num] is None:
+                                continue
+                            if page_num in refs:
+                                found[page_num] = refs[page_num] + (bands.get(page_num, region),)
+                            else:
+                                found[page_num] = self.search(outputs[page_num][0]) + (None,)
+
+                        if self.escalation is not None:
+                            if not self.escalate(jobs, outputs, found):
+                                return
+
+                        for page_num, _ in rendered:
+                            if page_num in settled:
+                                if settled[page_num] == 'blank':
+                                    self.stats['blank'] += 1
+                                yield PageResult(page_num, '', None, settled[page_num])
+                                continue
+                            output = outputs[page_num]
+                            if output is None:
+                                yield self.fallback(page_num, known_text)
+                                continue
+                            page_text, lines, _ = output
+                            customer_ref, matched_by, found_in = found[page_num]
+                            if page_num in duplicates and customer_ref == copies[page_num][0]:
+                                # Counted with the other duplicates in iter_results
+                                yield PageResult(page_num, page_text, customer_ref, 'duplicate', matched_by, found_in)
+                                continue
+                            if customer_ref and lines is not None:
+                                self.learn(customer_ref, lines)
+                                if page_num in hashes:
+                                    self.fingerprints.remember_scan(hashes[page_num], customer_ref, matched_by, lines)
+                            self.stats['ocr'] += 1
+                            yield PageResult(page_num, page_text, customer_ref, 'ocr', matched_by, found_in)
+                    finally:
+                        for _, _, job in jobs + retries:
+                            if job is not None:
+                                job.cancel()
+
+                    done += len(rendered)
+                    if not self.ocr_available:
+                        break
+            finally:
+                chunks.close()
+
+        for page_num in pages[done:]:
+            if self.cancelled():
+                return
+            yield self.fallback(page_num, known_text)
+
+    def extract_pages(self, pages):
+        # PageResults for the given pages, in order, according to the mode
+        if self.mode == 'ocr':
+            yield from self.iter_ocr(pages)
+            return
+
+        for window in chunk_pages(pages, self.window):
+            if self.mode == 'hybrid' and self.detector.ocr_first():
+                yield from self.iter_ocr_first(window)
+                continue
+
+            found = {}
+            known_text = {}
+            for page_num in window:
+                if self.cancelled():
+                    return
+                page_text = self.text_layer(page_num)
+                customer_ref, matched_by = self.search(page_text) if page_text.strip() else (None, None)
+                if customer_ref:
+                    self.stats['text_layer'] += 1
+                    found[page_num] = PageResult(page_num, page_text, customer_ref, 'text', matched_by)
+                elif self.segmenter is not None and is_continuation(page_text):
+                    found[page_num] = PageResult(page_num, page_text, None, 'continuation')
+                elif self.mode == 'text':
+                    self.stats['text_layer'] += 1
+                    found[page_num] = PageResult(page_num, page_text, None, 'text')
+                else:
+                    known_text[page_num] = page_text
+
+            # Only pages without a reference in their text layer are rendered
+            ocr_results = self.iter_ocr(list(known_text), known_text)
+            try:
+                for page_num in window:
+                    result = found.get(page_num) or next(ocr_results, None)
+                    if result is None:
+                        return
+                    yield result
+            finally:
+                ocr_results.close()
+
+    def iter_ocr_first(self, pages):
+        # Hybrid mode once the document is known to be scanned: pages are
+        # OCR'd straight away, and the text layer is only read for pages
+        # where OCR found no reference
+        results = self.iter_ocr(pages)
+        try:
+            for result in results:
+                if result.customer_ref is None and result.source == 'ocr':
+                    page_text = self.text_layer(result.page_num)
+                    customer_ref, matched_by = self.search(page_text) if page_text.strip() else (None, None)
+                    if customer_ref:
+                        self.stats['text_layer'] += 1
+                        result = PageResult(result.page_num, page_text, customer_ref, 'text', matched_by)
+                yield result
+        finally:
+            results.close()
+
+    def cache_settings(self):
+        # Everything besides the page itself that affects the extracted text
+        # (and, for a forced tracking method, the cached reference)
+        rasterizer = self.rasterizer
+        region = 'auto' if self.region is None and self.region_learner else self.region
+        settings = f"{self.mode}|{rasterizer.dpi}|{rasterizer.grayscale}|{region}|{self.ocr_engine.config}"
+        if self.escalation is not None:
+            settings += f"|adaptive:{self.escalation.dpi}:{self.min_confidence}"
+        if self.detector.forced:
+            settings += f"|{self.detector.tracking}"
+        return settings
+
+    def cache_key(self, page_num):
+        try:
+            return page_content_hash(self.document.page(page_num), self.cache_settings())
+        except Exception as e:
+            self.log(f"Could not hash page {page_num+1} for the cache: {str(e)}")
+            return None
+
+    def iter_pages(self, start=0, stop=None):
+        # Generator handing PageResults to the matching stage in page order.
+        # Pages already in the cache skip extraction entirely; a cached
+        # reference is reused, and pages cached without one are searched
+        # again in case the mapping has changed since. With dedupe, a page
+        # whose content matches an earlier page's reuses that page's result.
+        if stop is None:
+            stop = self.document.page_count
+        results = self.iter_results(range(start, stop))
+        try:
+            for result in results:
+                self.detector.observe(result.matched_by, result.source, result.region)
+                if self.segmenter is not None:
+                    result = self.place(result)
+                yield result
+                self.document.release(result.page_num)
+        finally:
+            results.close()
+
+    def reusable(self, result):
+        # Whether a result can be reused for the same page content later:
+        # OCR failures are retried, and a continuation page's reference
+        # comes from the page before it
+        if result.source in ('fallback', 'continuation'):
+            return False
+        return self.segmenter is None or result.customer_ref is not None or not is_continuation(result.text)
+
+    def place(self, result):
+        # A continuation page takes the reference of its document's first page
+        lead_ref = self.segmenter.follows(result.customer_ref, result.source, result.text)
+        if lead_ref is None:
+            return result
+        self.stats['continuation'] += 1
+        return PageResult(result.page_num, result.text, lead_ref, 'continuation', 'continuation')
+
+    def iter_results(self, pages):
+        if self.cache is None and self.fingerprints is None:
+            yield from self.extract_pages(pages)
+            return
+
+        for window in chunk_pages(pages, self.window):
+            keys = {}
+            known = {}
+            copies = {}
+            first = {}
+            for page_num in window:
+                with timer(self.metrics, 'cache'):
+                    keys[page_num] = self.cache_key(page_num)
+                key = keys[page_num]
+                if self.fingerprints is not None and key:
+                    # Same content as an earlier page: reuse its result
+                    duplicate = self.fingerprints.duplicate_of(key)
+                    if duplicate:
+                        customer_ref, matched_by = duplicate
+                        known[page_num] = PageResult(page_num, '', customer_ref, 'duplicate', matched_by)
+                        continue
+                    if key in first:
+                        copies[page_num] = first[key]
+                        continue
+                    first[key] = page_num
+                if self.cache is None or not key:
+                    continue
+                with timer(self.metrics, 'cache'):
+                    hit = self.cache.get(key)
+                if hit:
+                    page_text, customer_ref, _ = hit
+                    self.stats['cache'] += 1
+                    matched_by = 'cache' if customer_ref else None
+                    if not customer_ref:
+                        customer_ref, matched_by = self.search(page_text)
+                    known[page_num] = PageResult(page_num, page_text, customer_ref, 'cache', matched_by)
+
+            results = self.extract_pages([page_num for page_num in window
+                                          if page_num not in known and page_num not in copies])
+            originals = set(copies.values())
+            earlier = {}
+            try:
+                for page_num in window:
+                    if self.cancelled():
+                        return
+                    key = keys[page_num]
+                    if page_num in copies:
+                        original = earlier[copies[page_num]]
+                        source = 'continuation' if original.source == 'continuation' else 'duplicate'
+                        result = PageResult(page_num, original.text, original.customer_ref, source,
+                                            original.matched_by, original.region)
+                    else:
+                        result = known.pop(page_num, None)
+                    if result is None:
+                        result = next(results, None)
+                        if result is None:
+                            return
+                        if self.cache is not None and key and self.reusable(result):
+                            with timer(self.metrics, 'cache'):
+                                self.cache.put(key, result.text, result.customer_ref, result.source)
+                    if result.source == 'duplicate':
+                        self.stats['duplicate'] += 1
+                    elif self.fingerprints is not None and self.reusable(result):
+                        self.fingerprints.remember(key, result.customer_ref, result.matched_by)
+                    if page_num in originals:
+                        earlier[page_num] = result
+                    yield result
+            finally:
+                results.close()
@@ -0,0 +1,88 @@
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+import PyPDF2
+from atomic import atomic_open
+
+
+class RouteWriter:
+    # Output stage: writes one PDF per route from the already-open source
+    # document. Pages are copied into each route's PdfWriter on the calling
+    # thread, so the source is parsed once and its reader is never used from
+    # two threads; add_page copies the objects a page needs, leaving the
+    # writer independent of the reader. Serialising and writing the files
+    # then runs on a thread pool. Each file is written under a temporary name
+    # in the output directory and renamed into place when complete, so a
+    # crash never leaves a half-written route PDF behind. At most max_pending
+    # routes are held in memory at once. add_pages takes (document, page)
+    # pairs, so a route can combine pages from several open documents.
+    def __init__(self, document, output_dir, workers=4, max_pending=None, log=None):
+        self.document = document
+        self.output_dir = output_dir
+        self.workers = max(1, workers)
+        self.pending = threading.BoundedSemaphore(max_pending or self.workers * 2)
+        self.log = log or (lambda message: None)
+        self.executor = None
+        self.futures = []
+        os.makedirs(output_dir, exist_ok=True)
+
+    def add(self, filename, pages):
+        # Queue pages (0-based) of the source to be written as filename
+        return self.add_pages(filename, [(self.document, page_num) for page_num in pages])
+
+    def add_pages(self, filename, pages):
+        # Queue (document, page) pairs to be written as filename, in order
+        self.pending.acquire()
+        try:
+            pdf_writer = PyPDF2.PdfWriter()
+            for document, page_num in pages:
+                pdf_writer.add_page(document.page(page_num))
+                # The writer has its own copy now
+                document.release(page_num)
+        except Exception:
+            self.pending.release()
+            raise
+
+        if self.executor is None:
+            self.executor = ThreadPoolExecutor(max_workers=self.workers)
+        output_path = os.path.join(self.output_dir, filename)
+        self.futures.append(self.executor.submit(self.write, pdf_writer, output_path))
+        return output_path
+
+    def write(self, pdf_writer, output_path):
+        try:
+            with atomic_open(output_path, 'wb', fsync=True) as output_file:
+                pdf_writer.write(output_file)
+            self.log(f"Created: {output_path}")
+            return output_path
+        finally:
+            # A PdfWriter and its objects reference each other, so left alone
+            # they wait for the cyclic garbage collector and several routes'
+            # page data can pile up; emptying its object table frees them now
+            objects = getattr(pdf_writer, '_objects', None)
+            if objects is not None:
+                objects.clear()
+            self.pending.release()
+
+    def close(self):
+        # Wait for every queued file; re-raises the first write error
+        if self.executor is None:
+            return []
+        try:
+            return [future.result() for future in self.futures]
+        finally:
+            self.executor.shutdown(wait=True)
+            self.executor = None
+            self.futures = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        elif self.executor is not None:
+            for future in self.futures:
+                future.cancel()
+            self.executor.shutdown(wait=True)
+            self.executor = None
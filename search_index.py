@@ -0,0 +1,38 @@
+class SearchIndex:
+    # Case-insensitive substring search over (ref, route) rows for the
+    # results table. Every row's text is broken into trigrams once; a
+    # search for three or more characters only checks the rows containing
+    # the rarest trigram of the term, shorter terms scan the lowered text.
+    # When the term extends the previous one (typing), only the previous
+    # matches are checked. Results are row numbers in mapping order.
+    def __init__(self, mapping):
+        self.rows = list(mapping.items())
+        self.text = [f"{ref}\0{route}".lower() for ref, route in self.rows]
+        self.trigrams = {}
+        for row, text in enumerate(self.text):
+            for gram in {text[i:i + 3] for i in range(len(text) - 2)}:
+                self.trigrams.setdefault(gram, []).append(row)
+        self.last_term = None
+        self.last_matches = None
+
+    def __len__(self):
+        return len(self.rows)
+
+    def candidates(self, term):
+        if self.last_term is not None and term.startswith(self.last_term):
+            return self.last_matches
+        if len(term) < 3:
+            return range(len(self.rows))
+        postings = [self.trigrams.get(term[i:i + 3], ()) for i in range(len(term) - 2)]
+        return min(postings, key=len)
+
+    def search(self, term):
+        term = term.lower()
+        if not term:
+            matches = range(len(self.rows))
+        else:
+            text = self.text
+            matches = [row for row in self.candidates(term) if term in text[row]]
+        self.last_term = term
+        self.last_matches = matches
+        return matches
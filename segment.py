@@ -0,0 +1,60 @@
+import re
+from PIL import Image
+from fingerprint import is_blank
+
+# "Page 2 of 3", "Page 2/3", "PAGE 2 OF 3"
+PAGE_MARKER = re.compile(r'\bPage\s*(\d{1,3})\s*(?:of|/)\s*(\d{1,3})\b', re.IGNORECASE)
+
+
+def page_marker(text):
+    # (page, total) from the first plausible "Page x of y" marker, or None
+    for match in PAGE_MARKER.finditer(text or ''):
+        number, total = int(match.group(1)), int(match.group(2))
+        if 1 <= number <= total:
+            return number, total
+    return None
+
+
+def is_continuation(text):
+    marker = page_marker(text)
+    return marker is not None and marker[0] > 1
+
+
+def band_is_empty(path, region):
+    # Whether a rendered page has no ink in the OCR region its document's
+    # references are read from: the visual signature of a continuation page
+    # without the letterhead
+    with Image.open(path) as image:
+        width, height = image.size
+        left, top, right, bottom = region
+        band = image.crop((int(left * width), int(top * height), int(right * width), int(bottom * height)))
+        return is_blank(band)
+
+
+class DocumentSegmenter:
+    # Groups consecutive pages of one PDF into documents, in page order. A
+    # page with a reference leads a document; the pages after it that carry
+    # a "Page x of y" marker with x > 1, or that the extractor flagged as
+    # continuations before classifying them, belong to it and take its
+    # reference. Blank pages (the backs of duplex scans) don't end a
+    # document; any other page without a reference does.
+    def __init__(self):
+        self.lead = None
+
+    def resume(self, pages):
+        # Picks the current document back up from the (customer_ref, source)
+        # of the pages an interrupted run already classified, in page order.
+        # A continuation page was recorded with its lead's reference.
+        for customer_ref, source in pages:
+            if source != 'blank':
+                self.lead = customer_ref
+
+    def follows(self, customer_ref, source, text):
+        # The reference this page inherits, or None if it isn't a
+        # continuation of the current document
+        if source == 'blank':
+            return None
+        if customer_ref is None and (source == 'continuation' or is_continuation(text)):
+            return self.lead
+        self.lead = customer_ref
+        return None
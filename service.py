@@ -0,0 +1,458 @@
+import os
+import json
+import time
+import uuid
+import queue
+import shutil
+import itertools
+import threading
+from collections import deque
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qs, unquote
+from pdf_engine import EXTRACTION_MODES
+from ocr import OcrPool, load_regions
+from format_detect import TRACKING_MODES
+from page_cache import PageCache
+from sorter import RouteSorter, SplitSettings
+
+# Lifecycle of a job
+JOB_STATES = ('queued', 'running', 'done', 'failed', 'cancelled')
+
+# Log lines kept per job for clients polling its status
+JOB_LOG_LINES = 500
+
+# Largest PDF accepted in one upload
+MAX_UPLOAD_BYTES = 500 * 1024 * 1024
+
+# Seconds a finished job's files are kept for its client to download
+# before the service removes it, and how often that's checked
+JOB_TTL = 24 * 3600
+EXPIRE_INTERVAL = 600
+
+
+def parse_flag(value):
+    return value.lower() in ('1', 'true', 'yes', 'on')
+
+
+# Split settings a client may choose per job, and how each is parsed from
+# the query string. OCR workers, backend and cache belong to the service.
+JOB_OPTIONS = {
+    'mode': str,
+    'region': str,
+    'tracking': str,
+    'fuzzy_edits': int,
+    'dpi': int,
+    'grayscale': parse_flag,
+    'adaptive': parse_flag,
+    'dedupe': parse_flag,
+    'segment': parse_flag,
+    'visual_segment': parse_flag,
+}
+
+
+def job_settings(base, options):
+    # A copy of the service's settings with a job's options applied.
+    # Raises ValueError for options a client can't set or values that
+    # don't make sense.
+    settings = SplitSettings()
+    settings.__dict__.update(base.__dict__)
+    for name, value in options.items():
+        if name not in JOB_OPTIONS:
+            raise ValueError(f"Unknown option: {name}")
+        setattr(settings, name, JOB_OPTIONS[name](value))
+    if settings.mode not in EXTRACTION_MODES:
+        raise ValueError(f"Unknown text source: {settings.mode}")
+    if settings.tracking not in TRACKING_MODES:
+        raise ValueError(f"Unknown tracking method: {settings.tracking}")
+    if settings.region != "auto" and settings.region not in load_regions():
+        raise ValueError(f"Unknown OCR region: {settings.region}")
+    if settings.fuzzy_edits not in (0, 1, 2):
+        raise ValueError("fuzzy_edits must be 0, 1 or 2")
+    if not 72 <= settings.dpi <= 600:
+        raise ValueError("dpi must be between 72 and 600")
+    return settings
+
+
+class Job:
+    # One PDF submitted to the service, its settings and how far it got.
+    # Log lines and progress are written by the thread running the job and
+    # read by request handlers, so they go through the lock.
+    def __init__(self, job_id, name, job_dir, priority, settings):
+        self.id = job_id
+        self.name = name
+        self.dir = job_dir
+        self.pdf_file = os.path.join(job_dir, 'input.pdf')
+        self.output_dir = os.path.join(job_dir, 'output')
+        self.priority = priority
+        self.settings = settings
+        self.status = 'queued'
+        self.created = time.time()
+        self.started = None
+        self.finished = None
+        self.page = 0
+        self.total_pages = 0
+        self.log_lines = deque(maxlen=JOB_LOG_LINES)
+        self.log_count = 0
+        self.summary = None
+        self.error = None
+        self.cancel_event = threading.Event()
+        self.lock = threading.Lock()
+
+    def log(self, message):
+        with self.lock:
+            for line in message.strip('\n').splitlines() or ['']:
+                self.log_lines.append(line)
+                self.log_count += 1
+
+    def progress(self, page_num, total_pages):
+        with self.lock:
+            self.page = page_num + 1
+            self.total_pages = total_pages
+
+    def files(self):
+        # Output files a client can download, by name
+        if self.summary is None:
+            return []
+        files = [details['file'] for details in self.summary['routes'].values()]
+        if self.summary.get('unassigned_file'):
+            files.append(self.summary['unassigned_file'])
+        return [os.path.basename(path) for path in files if path]
+
+    def describe(self, since=0):
+        # JSON-serialisable state of the job, with the log lines after the
+        # first `since` (as many of them as are still kept)
+        with self.lock:
+            kept_from = self.log_count - len(self.log_lines)
+            lines = list(self.log_lines)[max(0, since - kept_from):]
+            state = {
+                'id': self.id,
+                'name': self.name,
+                'status': self.status,
+                'priority': self.priority,
+                'created': self.created,
+                'started': self.started,
+                'finished': self.finished,
+                'page': self.page,
+                'total_pages': self.total_pages,
+                'error': self.error,
+                'log': lines,
+                'log_next': self.log_count,
+            }
+        if self.summary is not None:
+            summary = self.summary
+            state['summary'] = {
+                'total_pages': summary['total_pages'],
+                'cancelled': summary['cancelled'],
+                'routes': {route: {'file': os.path.basename(details['file']), 'pages': details['pages'],
+                                   'customers': details['customers']}
+                           for route, details in summary['routes'].items()},
+                'unassigned_pages': summary['unassigned_pages'],
+                'unassigned_file': os.path.basename(summary['unassigned_file'])
+                                   if summary.get('unassigned_file') else None,
+                'stats': summary['stats'],
+                'seconds': summary['metrics']['seconds'] if summary.get('metrics') else None,
+            }
+            state['files'] = self.files()
+        return state
+
+
+class SplitService:
+    # Runs split jobs for several workstations on one machine. Jobs wait in
+    # a priority queue (higher priority first, then in order of
+    # submission) and job_threads of them run at a time, each with its own
+    # RouteSorter. They all share one OCR worker pool, one page cache and
+    # the mapping in store, so a page OCR'd for one client is a cache hit
+    # for the next and the mapping only has to be kept up to date here.
+    # Each job's upload and output live in jobs_dir/<job id>/ until the job
+    # is deleted, or until job_ttl seconds after it finished if its client
+    # never collects it. Folders a previous run of the service left behind
+    # go once they're as old.
+    def __init__(self, store, settings=None, jobs_dir='data/jobs', job_threads=2, log=print, job_ttl=JOB_TTL):
+        self.store = store
+        self.settings = settings or SplitSettings(report_name=None, journal_name=None)
+        self.jobs_dir = jobs_dir
+        self.job_threads = max(1, job_threads)
+        self.log = log
+        self.ocr_pool = OcrPool(self.settings.ocr_workers, backend=self.settings.ocr_backend)
+        self.page_cache = PageCache(self.settings.cache_file) if self.settings.use_cache else None
+        self.queue = queue.PriorityQueue()
+        self.order = itertools.count()
+        self.jobs = {}
+        self.lock = threading.Lock()
+        self.threads = []
+        self.job_ttl = job_ttl
+        self.stopping = threading.Event()
+        self.expirer = None
+
+    def start(self):
+        os.makedirs(self.jobs_dir, exist_ok=True)
+        for _ in range(self.job_threads):
+            thread = threading.Thread(target=self.run_jobs, daemon=True)
+            thread.start()
+            self.threads.append(thread)
+        self.stopping.clear()
+        self.expirer = threading.Thread(target=self.expire_jobs, daemon=True)
+        self.expirer.start()
+
+    def expire_jobs(self):
+        while True:
+            self.expire()
+            if self.stopping.wait(min(EXPIRE_INTERVAL, self.job_ttl)):
+                return
+
+    def expire(self, now=None):
+        # Removes finished jobs older than job_ttl, and job folders no job
+        # knows about (from before a restart) that haven't changed for as
+        # long. Returns the ids removed.
+        now = time.time() if now is None else now
+        expired = [job.id for job in self.list_jobs()
+                   if job.finished is not None and now - job.finished > self.job_ttl]
+        for job_id in expired:
+            self.delete(job_id)
+        try:
+            names = os.listdir(self.jobs_dir)
+        except OSError:
+            names = []
+        for name in names:
+            path = os.path.join(self.jobs_dir, name)
+            if self.get(name) is not None or not os.path.isdir(path):
+                continue
+            try:
+                if now - os.path.getmtime(path) > self.job_ttl:
+                    shutil.rmtree(path, ignore_errors=True)
+                    expired.append(name)
+            except OSError:
+                pass
+        if expired:
+            self.log(f"Removed {len(expired)} expired job(s)")
+        return expired
+
+    def submit(self, data, name, priority=0, options=None):
+        # Queues a PDF (its bytes) and returns its Job. Raises ValueError for
+        # bad options or something that isn't a PDF.
+        if not data.startswith(b'%PDF-'):
+            raise ValueError("Upload is not a PDF")
+        settings = job_settings(self.settings, options or {})
+        job_id = uuid.uuid4().hex[:12]
+        job = Job(job_id, os.path.basename(name or 'upload.pdf'), os.path.join(self.jobs_dir, job_id),
+                  priority, settings)
+        os.makedirs(job.output_dir)
+        with open(job.pdf_file, 'wb') as f:
+            f.write(data)
+        with self.lock:
+            self.jobs[job_id] = job
+        self.queue.put((-priority, next(self.order), job_id))
+        self.log(f"Queued job {job_id} ({job.name}, priority {priority})")
+        return job
+
+    def get(self, job_id):
+        with self.lock:
+            return self.jobs.get(job_id)
+
+    def list_jobs(self):
+        with self.lock:
+            return list(self.jobs.values())
+
+    def counts(self):
+        counts = dict.fromkeys(JOB_STATES, 0)
+        for job in self.list_jobs():
+            counts[job.status] += 1
+        return counts
+
+    def delete(self, job_id):
+        # Cancels a queued or running job; a finished job is removed along
+        # with its files. Returns the job, or None if there's no such job.
+        job = self.get(job_id)
+        if job is None:
+            return None
+        if job.status in ('queued', 'running'):
+            job.cancel_event.set()
+            if job.status == 'queued':
+                job.status = 'cancelled'
+                job.finished = time.time()
+            return job
+        with self.lock:
+            self.jobs.pop(job_id, None)
+        shutil.rmtree(job.dir, ignore_errors=True)
+        return job
+
+    def run_jobs(self):
+        while True:
+            _, _, job_id = self.queue.get()
+            if job_id is None:
+                return
+            job = self.get(job_id)
+            if job is None or job.cancel_event.is_set():
+                continue
+            self.run(job)
+
+    def run(self, job):
+        job.status = 'running'
+        job.started = time.time()
+        self.log(f"Running job {job.id} ({job.name})")
+        sorter = RouteSorter(self.store, settings=job.settings, log=job.log, progress=job.progress,
+                             cancel_event=job.cancel_event, ocr_pool=self.ocr_pool, page_cache=self.page_cache)
+        try:
+            job.summary = sorter.split_pdf(job.pdf_file, job.output_dir)
+            job.status = 'cancelled' if job.summary['cancelled'] else 'done'
+        except Exception as e:
+            job.log(f"Error processing PDF: {str(e)}")
+            job.error = str(e)
+            job.status = 'failed'
+        finally:
+            sorter.close()
+            job.finished = time.time()
+        self.log(f"Job {job.id} {job.status} in {job.finished - job.started:.1f}s")
+
+    def shutdown(self):
+        # Cancels running jobs and stops the workers
+        self.stopping.set()
+        if self.expirer is not None:
+            self.expirer.join()
+            self.expirer = None
+        for job in self.list_jobs():
+            job.cancel_event.set()
+        for _ in self.threads:
+            self.queue.put((float('inf'), next(self.order), None))
+        for thread in self.threads:
+            thread.join()
+        self.threads = []
+        self.ocr_pool.shutdown()
+        if self.page_cache is not None:
+            self.page_cache.close()
+
+
+class ServiceHandler(BaseHTTPRequestHandler):
+    # JSON API over the service:
+    #   GET    /health                       queue counts and mapping size
+    #   GET    /jobs                         every job's state
+    #   POST   /jobs?name=&priority=&...     body: the PDF; options from JOB_OPTIONS
+    #   GET    /jobs/<id>?since=N            a job's state, log lines from N on
+    #   GET    /jobs/<id>/files/<name>       an output PDF
+    #   DELETE /jobs/<id>                    cancel, or remove a finished job
+    #   GET    /mapping, PUT /mapping        the ref -> route mapping as JSON
+    server_version = "TransportSorter/1.0"
+
+    @property
+    def service(self):
+        return self.server.service
+
+    def log_message(self, format, *args):
+        self.service.log(f"{self.address_string()} {format % args}")
+
+    def send_json(self, value, status=200):
+        body = json.dumps(value).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def send_error_json(self, status, message):
+        self.send_json({'error': message}, status)
+
+    def read_body(self):
+        length = int(self.headers.get('Content-Length') or 0)
+        if length > MAX_UPLOAD_BYTES:
+            raise ValueError("Upload is too large")
+        return self.rfile.read(length)
+
+    def route(self):
+        url = urlparse(self.path)
+        parts = [unquote(part) for part in url.path.strip('/').split('/') if part]
+        query = {name: values[-1] for name, values in parse_qs(url.query).items()}
+        return parts, query
+
+    def find_job(self, job_id):
+        job = self.service.get(job_id)
+        if job is None:
+            self.send_error_json(404, f"No such job: {job_id}")
+        return job
+
+    def do_GET(self):
+        parts, query = self.route()
+        if parts == ['health']:
+            self.send_json({'status': 'ok', 'jobs': self.service.counts(), 'mapping_entries': len(self.service.store)})
+        elif parts == ['jobs']:
+            self.send_json([job.describe(job.log_count) for job in self.service.list_jobs()])
+        elif parts == ['mapping']:
+            self.service.store.reload()
+            self.send_json(dict(self.service.store.mapping))
+        elif len(parts) == 2 and parts[0] == 'jobs':
+            job = self.find_job(parts[1])
+            if job is not None:
+                try:
+                    since = int(query.get('since', 0))
+                except ValueError:
+                    return self.send_error_json(400, "since must be a number")
+                self.send_json(job.describe(since))
+        elif len(parts) == 4 and parts[0] == 'jobs' and parts[2] == 'files':
+            job = self.find_job(parts[1])
+            if job is not None:
+                self.send_file(job, parts[3])
+        else:
+            self.send_error_json(404, "Not found")
+
+    def send_file(self, job, name):
+        # Only the job's own outputs, by name
+        if name not in job.files():
+            return self.send_error_json(404, f"No such file: {name}")
+        path = os.path.join(job.output_dir, name)
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/pdf')
+        self.send_header('Content-Length', str(os.path.getsize(path)))
+        self.end_headers()
+        with open(path, 'rb') as f:
+            shutil.copyfileobj(f, self.wfile)
+
+    def do_POST(self):
+        parts, query = self.route()
+        if parts != ['jobs']:
+            return self.send_error_json(404, "Not found")
+        name = query.pop('name', None)
+        try:
+            priority = int(query.pop('priority', 0))
+            job = self.service.submit(self.read_body(), name, priority, query)
+        except ValueError as e:
+            return self.send_error_json(400, str(e))
+        self.send_json(job.describe(), 201)
+
+    def do_PUT(self):
+        parts, _ = self.route()
+        if parts != ['mapping']:
+            return self.send_error_json(404, "Not found")
+        try:
+            mapping = json.loads(self.read_body())
+        except ValueError:
+            return self.send_error_json(400, "Mapping is not valid JSON")
+        if not isinstance(mapping, dict) or not all(isinstance(ref, str) and isinstance(route, str)
+                                                    for ref, route in mapping.items()):
+            return self.send_error_json(400, "Mapping must be a JSON object of customer ref -> route")
+        self.service.store.replace(mapping)
+        self.service.log(f"Mapping replaced: {len(mapping)} entries")
+        self.send_json({'status': 'ok', 'entries': len(mapping)})
+
+    def do_DELETE(self):
+        parts, _ = self.route()
+        if len(parts) != 2 or parts[0] != 'jobs':
+            return self.send_error_json(404, "Not found")
+        job = self.service.delete(parts[1])
+        if job is None:
+            return self.send_error_json(404, f"No such job: {parts[1]}")
+        self.send_json(job.describe())
+
+
+def serve(service, host='127.0.0.1', port=8765):
+    # Serves the API until interrupted, then stops the service
+    server = ThreadingHTTPServer((host, port), ServiceHandler)
+    server.daemon_threads = True
+    server.service = service
+    service.start()
+    service.log(f"Listening on http://{host}:{server.server_address[1]}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        service.shutdown()
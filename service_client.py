@@ -0,0 +1,147 @@
+import os
+import json
+import time
+import shutil
+import urllib.error
+import urllib.parse
+import urllib.request
+
+# Job states after which nothing changes
+FINISHED_STATES = ('done', 'failed', 'cancelled')
+
+
+class ServiceError(Exception):
+    # The service refused a request, or couldn't be reached
+    def __init__(self, message, status=None):
+        super().__init__(message)
+        self.status = status
+
+
+class ServiceClient:
+    # Talks to a split service (see service.py) at url, e.g.
+    # http://depot-server:8765. Jobs are submitted one PDF at a time and
+    # their route PDFs downloaded once they're done.
+    def __init__(self, url, timeout=60):
+        self.url = url.rstrip('/')
+        self.timeout = timeout
+
+    def open(self, method, path, data=None, content_type=None):
+        request = urllib.request.Request(self.url + path, data=data, method=method)
+        if content_type:
+            request.add_header('Content-Type', content_type)
+        try:
+            return urllib.request.urlopen(request, timeout=self.timeout)
+        except urllib.error.HTTPError as e:
+            try:
+                message = json.loads(e.read()).get('error') or str(e)
+            except ValueError:
+                message = str(e)
+            raise ServiceError(message, e.code) from None
+        except (urllib.error.URLError, OSError) as e:
+            raise ServiceError(f"Could not reach {self.url}: {getattr(e, 'reason', e)}") from None
+
+    def call(self, method, path, data=None, content_type=None):
+        with self.open(method, path, data, content_type) as response:
+            return json.loads(response.read())
+
+    def health(self):
+        return self.call('GET', '/health')
+
+    def submit(self, pdf_file, priority=0, **options):
+        # Uploads a PDF and returns the new job's state. options are the
+        # per-job split settings the service accepts (mode, tracking, ...).
+        query = {'name': os.path.basename(pdf_file), 'priority': priority}
+        for name, value in options.items():
+            query[name] = str(value).lower() if isinstance(value, bool) else value
+        with open(pdf_file, 'rb') as f:
+            data = f.read()
+        return self.call('POST', '/jobs?' + urllib.parse.urlencode(query), data, 'application/pdf')
+
+    def job(self, job_id, since=0):
+        return self.call('GET', f"/jobs/{job_id}?since={since}")
+
+    def jobs(self):
+        return self.call('GET', '/jobs')
+
+    def delete(self, job_id):
+        # Cancels a queued or running job, or removes a finished one and its
+        # files from the service
+        return self.call('DELETE', f"/jobs/{job_id}")
+
+    def wait(self, job_id, poll=1.0, log=None, progress=None, cancel_event=None):
+        # Polls a job until it finishes, passing its new log lines to
+        # log(message) and its progress to progress(page_num, total_pages).
+        # Setting cancel_event cancels the job on the service.
+        since = 0
+        cancel_sent = False
+        while True:
+            state = self.job(job_id, since)
+            since = state['log_next']
+            if log and state['log']:
+                log("\n".join(state['log']))
+            if progress and state['total_pages']:
+                progress(state['page'] - 1, state['total_pages'])
+            if state['status'] in FINISHED_STATES:
+                return state
+            if cancel_event is not None and cancel_event.is_set() and not cancel_sent:
+                self.delete(job_id)
+                cancel_sent = True
+            time.sleep(poll)
+
+    def download(self, state, output_dir):
+        # Fetches a finished job's output PDFs into output_dir. Returns their
+        # paths. Each file is written under a temporary name and renamed
+        # into place when complete.
+        os.makedirs(output_dir, exist_ok=True)
+        paths = []
+        for name in state.get('files', []):
+            path = os.path.join(output_dir, name)
+            temp_path = path + '.part'
+            with self.open('GET', f"/jobs/{state['id']}/files/{urllib.parse.quote(name)}") as response, \
+                    open(temp_path, 'wb') as f:
+                shutil.copyfileobj(response, f)
+            os.replace(temp_path, path)
+            paths.append(path)
+        return paths
+
+    def put_mapping(self, mapping):
+        # Replaces the service's ref -> route mapping
+        return self.call('PUT', '/mapping', json.dumps(mapping).encode('utf-8'), 'application/json')
+
+    def get_mapping(self):
+        return self.call('GET', '/mapping')
+
+
+def run_remote(client, pdf_files, output_dir, log, progress=None, cancel_event=None, priority=0, **options):
+    # Sorts PDFs on a service the way RouteSorter sorts them locally: one
+    # job per PDF, each PDF's route files downloaded into output_dir (into
+    # a subfolder per PDF when there are several). Returns the summary of
+    # each job, with the local paths of its files. Each job is removed from
+    # the service once it has finished, done or not.
+    summaries = []
+    for pdf_file in pdf_files:
+        job_dir = output_dir
+        if len(pdf_files) > 1:
+            job_dir = os.path.join(output_dir, os.path.splitext(os.path.basename(pdf_file))[0])
+        state = client.submit(pdf_file, priority, **options)
+        log(f"Submitted {os.path.basename(pdf_file)} to {client.url} as job {state['id']}")
+        try:
+            state = client.wait(state['id'], log=log, progress=progress, cancel_event=cancel_event)
+            if state['status'] == 'failed':
+                raise ServiceError(f"Job {state['id']} failed: {state['error']}")
+            summary = dict(state.get('summary') or {'cancelled': True})
+            summary['pdf'] = pdf_file
+            summary['output_dir'] = job_dir
+            summary['job'] = state['id']
+            if state['status'] == 'done':
+                summary['files'] = client.download(state, job_dir)
+                log(f"Downloaded {len(summary['files'])} files to {job_dir}")
+        finally:
+            # Finished jobs are removed whatever became of them, so their
+            # upload and outputs don't sit on the service
+            if state['status'] in FINISHED_STATES:
+                client.delete(state['id'])
+        summaries.append(summary)
+        if summary['cancelled']:
+            break
+    return summaries
@@ -0,0 +1,565 @@
+import os
+import time
+from contextlib import ExitStack
+from pdf_engine import EXTRACTION_STATS, PdfDocument, PageRasterizer, PageTextExtractor, timer
+from ocr import InlineOcr, OcrPool, RegionLearner, load_regions, resolve_backend
+from page_cache import PageCache
+from pdf_output import RouteWriter
+from matching import PATTERN_LABELS, RefMatcher, RouteIndex
+from format_detect import FormatDetector
+from metrics import RunMetrics, write_json_report, write_prometheus
+from journal import RunJournal, file_digest
+
+# Characters that are invalid in filenames
+INVALID_FILENAME_CHARS = ['\\', '/', ':', '*', '?', '"', '<', '>', '|']
+
+
+def route_filename(route):
+    # Create valid filename from route name - preserve exact route name
+    safe_route_name = route
+
+    # Only replace characters that are invalid in filenames
+    for char in INVALID_FILENAME_CHARS:
+        safe_route_name = safe_route_name.replace(char, '_')
+
+    # Ensure we have a valid filename
+    if not safe_route_name or safe_route_name.isspace():
+        safe_route_name = "Unknown_Route"
+
+    return f"{safe_route_name}.pdf"
+
+
+class SplitSettings:
+    # Extraction settings for a split run. The defaults are the app's.
+    # region is a name from load_regions() or "auto"; ocr_workers=None uses
+    # one worker per core. report_name is the run report written to the
+    # output directory (None for no report); prometheus_file, if set, gets
+    # the run's metrics in Prometheus textfile format. journal_name is the
+    # checkpoint journal kept in the output directory while a run is in
+    # progress (None for no journal); with resume off an existing journal is
+    # started over instead of resumed. page_budget caps the pages read or
+    # rendered ahead of the matching stage. tracking is one of
+    # format_detect.TRACKING_MODES; in "auto_detect" the layout of each PDF
+    # is taken from the first sample_pages pages with a reference.
+    # ocr_backend is one of ocr.OCR_BACKENDS. With adaptive set, pages are
+    # first OCR'd binarized at adaptive_dpi, and only those where that finds
+    # no reference, or one Tesseract is less than min_confidence (0-100) sure
+    # of, are OCR'd again at escalation_dpi. With dedupe set, repeated and
+    # rescanned copies of a page reuse the first copy's result and blank
+    # scanned pages are routed without OCR. With segment set, the later
+    # pages of a multi-page document follow its first page's route; with
+    # visual_segment as well, scanned pages with an empty OCR region count
+    # as later pages.
+    def __init__(self, mode='hybrid', region='auto', fuzzy_edits=0, dpi=200, chunk_size=10,
+                 render_threads=2, ocr_workers=None, grayscale=True, use_cache=True,
+                 cache_file='data/page_cache.sqlite', write_workers=4, report_name='run_report.json',
+                 prometheus_file=None, journal_name='.run_journal.jsonl', resume=True, page_budget=30,
+                 tracking='auto_detect', sample_pages=5, ocr_backend='auto', adaptive=False,
+                 adaptive_dpi=150, escalation_dpi=300, min_confidence=70, dedupe=True,
+                 segment=True, visual_segment=False):
+        self.mode = mode
+        self.region = region
+        self.fuzzy_edits = fuzzy_edits
+        self.dpi = dpi
+        self.chunk_size = chunk_size
+        self.render_threads = render_threads
+        self.ocr_workers = ocr_workers
+        self.grayscale = grayscale
+        self.use_cache = use_cache
+        self.cache_file = cache_file
+        self.write_workers = write_workers
+        self.report_name = report_name
+        self.prometheus_file = prometheus_file
+        self.journal_name = journal_name
+        self.resume = resume
+        self.page_budget = page_budget
+        self.tracking = tracking
+        self.sample_pages = sample_pages
+        self.ocr_backend = ocr_backend
+        self.adaptive = adaptive
+        self.adaptive_dpi = adaptive_dpi
+        self.escalation_dpi = escalation_dpi
+        self.min_confidence = min_confidence
+        self.dedupe = dedupe
+        self.segment = segment
+        self.visual_segment = visual_segment
+
+
+class SortedPages:
+    # One input PDF of a run and where its pages went: pages (0-based) by
+    # route, the route of each ref found, and the pages that matched no route
+    def __init__(self, pdf_file, document):
+        self.pdf_file = pdf_file
+        self.document = document
+        self.pages_by_route = {}
+        self.customer_routes = {}
+        self.unassigned_pages = []
+        self.resumed_pages = 0
+        self.stats = dict.fromkeys(EXTRACTION_STATS, 0)
+        self.journal = None
+
+    def add(self, page_num, customer_ref, route):
+        if route is None:
+            self.unassigned_pages.append(page_num)
+            return
+        self.customer_routes[customer_ref] = route
+        self.pages_by_route.setdefault(route, []).append(page_num)
+
+    def page_numbers(self, pages, with_pdf=False):
+        # 1-based page numbers for the summary, tagged with the PDF in a batch
+        if with_pdf:
+            return [{'pdf': self.pdf_file, 'page': page_num + 1} for page_num in pages]
+        return [page_num + 1 for page_num in pages]
+
+
+class RouteSorter:
+    # Splits PDFs into one PDF per route using the mapping in store (a
+    # MappingStore). Nothing here touches Tkinter: progress goes to the
+    # log(message) and progress(page_num, total_pages) callbacks and
+    # cancel_event is checked between pages, so the app and the command line
+    # share this pipeline. A service running several sorters at once hands
+    # them one ocr_pool and page_cache, which stay open when they finish.
+    def __init__(self, store, settings=None, log=print, progress=None, cancel_event=None, ocr_pool=None,
+                 page_cache=None):
+        self.store = store
+        self.settings = settings or SplitSettings()
+        self.log = log
+        self.progress = progress
+        self.cancel_event = cancel_event
+        self.regions = load_regions()
+
+        # Reference matcher and route index for the current mapping, built
+        # on first use and rebuilt only when the mapping changes
+        self.matcher = None
+        self.matcher_version = None
+        self.route_index = None
+        self.route_index_key = None
+
+        # Per-page extraction results kept across runs
+        self.page_cache = None
+        self.shared_page_cache = page_cache
+        self.ocr_pool = ocr_pool
+
+        # Timings and counters of the current run
+        self.metrics = None
+
+    def get_page_cache(self):
+        if self.shared_page_cache is not None:
+            return self.shared_page_cache
+        if self.page_cache is None:
+            self.page_cache = PageCache(self.settings.cache_file)
+        return self.page_cache
+
+    def get_matcher(self):
+        if self.matcher is None or self.matcher_version != self.store.version:
+            self.matcher = RefMatcher(self.store.mapping.keys())
+            self.matcher_version = self.store.version
+        return self.matcher
+
+    def get_route_index(self, max_distance):
+        key = (self.store.version, max_distance)
+        if self.route_index is None or self.route_index_key != key:
+            self.route_index = RouteIndex(self.store.mapping, max_distance=max_distance)
+            self.route_index_key = key
+        return self.route_index
+
+    def find_customer_ref(self, text, patterns=None, strict=False):
+        with timer(self.metrics, 'match'):
+            ref, found_by = self.get_matcher().find(text, patterns, strict)
+        if ref:
+            self.log(f"{PATTERN_LABELS[found_by]}: {ref}")
+        return ref, found_by
+
+    def load_customer_data(self):
+        # Customer data (maps customer refs to routes), re-read only if the
+        # snapshot changed since the last run
+        self.store.reload()
+        if not self.store.exists():
+            raise FileNotFoundError("No customer data found. Please process an Excel file first.")
+        customer_data = self.store.mapping
+
+        self.log(f"Loaded customer data with {len(customer_data)} entries")
+        self.log("Sample customer data entries:")
+        for ref, route in list(customer_data.items())[:5]:  # Show first 5 entries
+            self.log(f"  {ref} -> {route}")
+        return customer_data
+
+    def open_journal(self, pdf_file, output_dir, index=None):
+        # The checkpoint journal for this PDF, mapping and settings, with any
+        # pages an interrupted earlier run already classified loaded. Each
+        # PDF of a batch gets its own, numbered by its place in the batch.
+        settings = self.settings
+        if not settings.journal_name:
+            return None
+        key = {
+            'pdf': file_digest(pdf_file),
+            'mapping': self.store.digest,
+            'mode': settings.mode,
+            'region': settings.region,
+            'fuzzy_edits': settings.fuzzy_edits,
+            'tracking': settings.tracking,
+            'dpi': settings.dpi,
+            'grayscale': settings.grayscale,
+            'adaptive': [settings.adaptive_dpi, settings.escalation_dpi, settings.min_confidence]
+                        if settings.adaptive else False,
+            'dedupe': settings.dedupe,
+            'segment': settings.segment,
+            'visual_segment': settings.visual_segment,
+        }
+        name = settings.journal_name
+        if index is not None:
+            stem, ext = os.path.splitext(name)
+            name = f"{stem}.{index+1}{ext}"
+        journal = RunJournal(os.path.join(output_dir, name), key)
+        if settings.resume:
+            journal.load()
+        journal.start(settings.resume)
+        return journal
+
+    def cancelled(self):
+        return self.cancel_event is not None and self.cancel_event.is_set()
+
+    def split_pdf(self, pdf_file, output_dir):
+        # Returns a summary dict of the run; output PDFs are only written if
+        # the run wasn't cancelled
+        return self.sort_documents([pdf_file], output_dir, batch=False)
+
+    def split_batch(self, pdf_files, output_dir):
+        # Sorts several PDFs in one run: the mapping, matcher, route index,
+        # OCR workers and page cache are set up once for all of them, and one
+        # combined PDF is written per route with pages in input order, then
+        # page order. Page numbers in the summary come with the PDF they're
+        # from.
+        return self.sort_documents(list(pdf_files), output_dir, batch=True)
+
+    def sort_documents(self, pdf_files, output_dir, batch):
+        customer_data = self.load_customer_data()
+        settings = self.settings
+        metrics = self.metrics = RunMetrics()
+
+        # Normalized and OCR-tolerant lookup for refs that aren't an exact key
+        route_index = self.get_route_index(settings.fuzzy_edits)
+
+        self.log("\nStarting PDF processing...")
+
+        # Read and parse each PDF once; every page is extracted from, and
+        # written out of, these documents
+        with ExitStack() as stack:
+            ocr_pool = self.ocr_pool or stack.enter_context(OcrPool(settings.ocr_workers, backend=settings.ocr_backend))
+            docs = [SortedPages(pdf_file, stack.enter_context(PdfDocument(pdf_file))) for pdf_file in pdf_files]
+            total_pages = sum(doc.document.page_count for doc in docs)
+            if batch:
+                self.log(f"Batch of {len(docs)} PDFs with {total_pages} pages")
+            else:
+                self.log(f"PDF has {total_pages} pages")
+            if settings.mode != 'text':
+                self.log(f"OCR backend: {resolve_backend(settings.ocr_backend)}")
+
+            # The header band learnt on one manifest carries over to the next
+            region_learner = RegionLearner() if settings.region == "auto" else None
+            try:
+                offset = 0
+                for index, doc in enumerate(docs):
+                    if self.cancelled():
+                        break
+                    doc.journal = self.open_journal(doc.pdf_file, output_dir, index if batch else None)
+                    self.resume_document(doc)
+                    if batch:
+                        self.log(f"\nSorting {os.path.basename(doc.pdf_file)} ({doc.document.page_count} pages)")
+                    self.classify_document(doc, ocr_pool, customer_data, route_index, region_learner,
+                                           offset, total_pages, batch)
+                    offset += doc.document.page_count
+
+                summary = self.build_summary(docs, output_dir, total_pages, batch)
+                if summary['cancelled']:
+                    self.log("\nProcessing cancelled, no output PDFs were written")
+                    if any(doc.journal is not None for doc in docs):
+                        self.log("Progress is saved; process the same PDF into the same folder to resume")
+                    self.finish_report(summary, metrics)
+                    return summary
+
+                for doc in docs:
+                    if doc.journal is not None and not doc.journal.classified:
+                        doc.journal.mark_classified()
+
+                self.write_routes(docs, output_dir, summary, batch)
+            finally:
+                for doc in docs:
+                    if doc.journal is not None:
+                        doc.journal.close()
+
+        for doc in docs:
+            if doc.journal is not None:
+                doc.journal.discard()
+        self.finish_report(summary, metrics)
+        self.log_summary(summary, summary['stats'])
+        return summary
+
+    def resume_document(self, doc):
+        # Pages an interrupted earlier run classified go back where they were
+        journal = doc.journal
+        if journal is None or not journal.entries:
+            return
+        doc.resumed_pages = journal.resume_point()
+        for page_num in range(doc.resumed_pages):
+            entry = journal.entries[page_num]
+            doc.add(page_num, entry['customer_ref'], entry['route'])
+        name = os.path.basename(doc.pdf_file)
+        if journal.classified or doc.resumed_pages >= doc.document.page_count:
+            self.log(f"Resuming: all {doc.resumed_pages} pages of {name} already classified")
+        else:
+            self.log(f"Resuming: {doc.resumed_pages} pages of {name} already classified, "
+                     f"continuing from page {doc.resumed_pages+1}")
+        self.metrics.count('journal.resumed', doc.resumed_pages)
+
+    def classify_document(self, doc, ocr_pool, customer_data, route_index, region_learner, offset, total_pages,
+                          batch):
+        # Routes the pages of one document that aren't classified yet.
+        # offset is where its pages start in the run, for progress.
+        settings = self.settings
+        metrics = self.metrics
+        document = doc.document
+        journal = doc.journal
+
+        rasterizer = PageRasterizer(
+            doc.pdf_file,
+            dpi=settings.adaptive_dpi if settings.adaptive else settings.dpi,
+            grayscale=settings.grayscale,
+            thread_count=settings.render_threads,
+            chunk_size=settings.chunk_size,
+            log=self.log,
+            metrics=metrics
+        )
+        escalation = None
+        if settings.adaptive:
+            escalation = PageRasterizer(
+                doc.pdf_file,
+                dpi=settings.escalation_dpi,
+                grayscale=settings.grayscale,
+                thread_count=settings.render_threads,
+                chunk_size=settings.chunk_size,
+                log=self.log,
+                metrics=metrics
+            )
+        # A single worker of our own is no faster than OCR'ing in this process.
+        # A pool handed over by a service always gets the OCR though: jobs run
+        # on several threads, and an in-process Tesseract engine isn't safe
+        # to share between them.
+        ocr_engine = ocr_pool
+        if self.ocr_pool is None and ocr_pool.workers == 1:
+            ocr_engine = InlineOcr(backend=settings.ocr_backend)
+        extractor = PageTextExtractor(
+            document,
+            mode=settings.mode,
+            find_ref=self.find_customer_ref,
+            rasterizer=rasterizer,
+            ocr_pool=ocr_engine,
+            region=self.regions.get(settings.region),
+            region_learner=region_learner,
+            cache=self.get_page_cache() if settings.use_cache else None,
+            cancel_event=self.cancel_event,
+            log=self.log,
+            metrics=metrics,
+            page_budget=settings.page_budget,
+            detector=FormatDetector(settings.tracking, settings.sample_pages, log=self.log),
+            escalation=escalation,
+            min_confidence=settings.min_confidence,
+            dedupe=settings.dedupe,
+            segment=settings.segment,
+            visual_segment=settings.visual_segment
+        )
+        # A resumed run picks up the document the last classified page was in
+        if extractor.segmenter is not None and journal is not None and doc.resumed_pages:
+            extractor.segmenter.resume((journal.entries[page_num]['customer_ref'], journal.entries[page_num]['source'])
+                                       for page_num in range(doc.resumed_pages))
+
+        # Process each page as the extractor streams it
+        page_clock = time.perf_counter()
+        pages_read = 0
+        for result in extractor.iter_pages(start=doc.resumed_pages):
+            i = result.page_num
+            pages_read += 1
+            if self.progress:
+                self.progress(offset + i, total_pages)
+            self.log(f"\nProcessing page {i+1}...")
+
+            # Customer reference found by the extractor in the page text
+            customer_ref = result.customer_ref
+            route = None
+            lookup = 'no_ref'
+
+            if customer_ref:
+                if result.source == 'continuation':
+                    self.log(f"Page {i+1} continues the document of customer {customer_ref}")
+                else:
+                    self.log(f"Found customer reference: {customer_ref} on page {i+1}")
+
+                # Check if customer reference exists in our database
+                if customer_ref in customer_data:
+                    route = customer_data[customer_ref]
+                    lookup = 'exact'
+                    self.log(f"Customer {customer_ref} belongs to route: {route}")
+                else:
+                    self.log(f"Customer {customer_ref} not found in database, checking for close matches...")
+
+                    # Normalized exact match first, then OCR misreads of a known ref
+                    with timer(metrics, 'match'):
+                        match = route_index.lookup(customer_ref)
+                    if match:
+                        db_ref, route, distance = match
+                        lookup = 'normalized' if distance == 0 else 'fuzzy'
+                        if distance == 0:
+                            self.log(f"Exact match found: {customer_ref} = {db_ref} -> {route}")
+                        else:
+                            self.log(f"Close match found: {customer_ref} ~ {db_ref} "
+                                     f"(edit distance {distance}) -> {route}")
+                    else:
+                        lookup = 'unmatched'
+                        self.log(f"No exact match found for customer {customer_ref}")
+            else:
+                self.log(f"No customer reference found on page {i+1}")
+
+            # Add the page to its route, or to the unassigned pages
+            doc.add(i, customer_ref, route)
+
+            # Refs read back from the cache weren't searched for this run
+            matched_by = result.matched_by if customer_ref else None
+            if journal is not None:
+                journal.record(i, result.source, customer_ref, route, lookup)
+            now = time.perf_counter()
+            metrics.page(i, now - page_clock, result.source, customer_ref, matched_by, route, lookup,
+                         pdf=doc.pdf_file if batch else None)
+            page_clock = now
+            metrics.count(f"source.{result.source}")
+            metrics.count(f"lookup.{lookup}")
+            if matched_by:
+                metrics.count(f"pattern.{matched_by}")
+
+        doc.stats = dict(extractor.stats)
+        metrics.count('cache.hits', extractor.stats['cache'])
+        if extractor.cache is not None:
+            metrics.count('cache.misses', pages_read - extractor.stats['cache'])
+        metrics.count('fallbacks', extractor.stats['fallback'])
+
+    def build_summary(self, docs, output_dir, total_pages, batch):
+        stats = {}
+        for doc in docs:
+            for name, value in doc.stats.items():
+                stats[name] = stats.get(name, 0) + value
+        summary = {
+            'pdf': [doc.pdf_file for doc in docs] if batch else docs[0].pdf_file,
+            'output_dir': output_dir,
+            'total_pages': total_pages,
+            'cancelled': self.cancelled(),
+            'routes': {},
+            'unassigned_pages': [],
+            'unassigned_file': None,
+            'resumed_pages': sum(doc.resumed_pages for doc in docs),
+            'stats': stats,
+        }
+        for doc in docs:
+            summary['unassigned_pages'].extend(doc.page_numbers(doc.unassigned_pages, batch))
+        if batch:
+            summary['documents'] = [{
+                'pdf': doc.pdf_file,
+                'total_pages': doc.document.page_count,
+                'unassigned_pages': [page_num + 1 for page_num in doc.unassigned_pages],
+                'resumed_pages': doc.resumed_pages,
+                'stats': doc.stats,
+            } for doc in docs]
+        return summary
+
+    def write_routes(self, docs, output_dir, summary, batch):
+        # Create PDF for each route (with route name as filename), all from
+        # the documents that are already open. A route's pages keep the order
+        # of the inputs, then of the pages within each.
+        self.log("\nCreating output PDFs by route:")
+
+        routes = {}
+        for doc in docs:
+            for route in doc.pages_by_route:
+                routes.setdefault(route, [])
+            for ref, route in doc.customer_routes.items():
+                if ref not in routes[route]:
+                    routes[route].append(ref)
+
+        with timer(self.metrics, 'write'), \
+                RouteWriter(None, output_dir, workers=self.settings.write_workers, log=self.log) as writer:
+            for route, customers in routes.items():
+                pages = [(doc.document, page_num) for doc in docs for page_num in doc.pages_by_route.get(route, [])]
+                self.log(f"Creating PDF for route '{route}' with {len(pages)} pages: "
+                         f"{os.path.join(output_dir, route_filename(route))}")
+                output_path = writer.add_pages(route_filename(route), pages)
+
+                summary['routes'][route] = {
+                    'file': output_path,
+                    'pages': [number for doc in docs
+                              for number in doc.page_numbers(doc.pages_by_route.get(route, []), batch)],
+                    'customers': customers,
+                }
+
+            # Create PDF for unassigned pages
+            unassigned = [(doc.document, page_num) for doc in docs for page_num in doc.unassigned_pages]
+            if unassigned:
+                self.log(f"\nCreating PDF for {len(unassigned)} unassigned pages")
+                summary['unassigned_file'] = writer.add_pages("Unassigned_Pages.pdf", unassigned)
+
+    def finish_report(self, summary, metrics):
+        # Adds the run report to the summary and writes it out
+        metrics.finish()
+        summary['metrics'] = metrics.report(summary)
+        settings = self.settings
+        try:
+            if settings.report_name:
+                report_path = os.path.join(summary['output_dir'], settings.report_name)
+                write_json_report(summary['metrics'], report_path)
+                summary['report_file'] = report_path
+            if settings.prometheus_file:
+                write_prometheus([summary['metrics']], settings.prometheus_file)
+        except OSError as e:
+            self.log(f"Could not write the run report: {str(e)}")
+
+    def log_summary(self, summary, stats):
+        routes = summary['routes']
+        self.log("\nProcessing Summary:")
+        self.log(f"Total pages: {summary['total_pages']}")
+        self.log(f"Routes created: {len(routes)}")
+        self.log(f"Customer references found and matched: {sum(len(r['customers']) for r in routes.values())}")
+        self.log(f"Pages assigned to routes: {sum(len(r['pages']) for r in routes.values())}")
+        self.log(f"Unassigned pages: {len(summary['unassigned_pages'])}")
+        self.log(f"Pages read from text layer: {stats['text_layer']}")
+        self.log(f"Pages OCR'd: {stats['ocr']} "
+                 f"({stats['region']} from the OCR region, "
+                 f"{stats['full_page']} needing a full-page pass)")
+        if stats['escalated']:
+            self.log(f"Pages escalated to high-resolution OCR: {stats['escalated']}")
+        if stats['duplicate'] or stats['blank']:
+            self.log(f"Duplicate pages reusing an earlier result: {stats['duplicate']}, "
+                     f"blank pages skipped: {stats['blank']}")
+        if stats['continuation']:
+            self.log(f"Continuation pages following their document's route: {stats['continuation']}")
+        self.log(f"Pages where OCR failed or was unavailable: {stats['fallback']}")
+        self.log(f"Pages served from cache: {stats['cache']}")
+
+        report = summary.get('metrics')
+        if report:
+            self.log(f"Processing time: {report['seconds']:.1f}s ({report['pages_per_second'] or 0:.1f} pages/s)")
+            self.log("Time by stage: " + ", ".join(
+                f"{stage} {seconds:.2f}s" for stage, seconds in report['stage_seconds'].items()))
+            if summary.get('report_file'):
+                self.log(f"Run report: {summary['report_file']}")
+
+        if routes:
+            self.log("\nRoute details:")
+            for route, details in routes.items():
+                customer_list = details['customers']
+                self.log(f"  Route '{route}': {len(details['pages'])} pages, {len(customer_list)} customers")
+                for customer in customer_list[:5]:  # Show max 5 customers per route
+                    self.log(f"    - {customer}")
+                if len(customer_list) > 5:
+                    self.log(f"    - ... and {len(customer_list)-5} more customers")
+
+    def close(self):
+        if self.page_cache is not None:
+            self.page_cache.close()
+            self.page_cache = None
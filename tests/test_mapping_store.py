@@ -0,0 +1,28 @@
+from mapping_store import MappingStore
+
+
+def test_update_applies_a_diff(tmp_path):
+    store = MappingStore(str(tmp_path / 'mapping.sqlite'))
+    store.replace({'CR1': 'ROUTE A', 'CR2': 'ROUTE B'})
+    added, changed, removed = store.update({'CR1': 'ROUTE C', 'CR3': 'ROUTE A'})
+    assert (added, changed, removed) == ({'CR3': 'ROUTE A'}, {'CR1': 'ROUTE C'}, ['CR2'])
+    assert dict(MappingStore(store.path).items()) == {'CR1': 'ROUTE C', 'CR3': 'ROUTE A'}
+
+
+def test_updates_from_two_stores_on_one_snapshot(tmp_path):
+    path = str(tmp_path / 'mapping.sqlite')
+    first = MappingStore(path)
+    first.replace({'CR1': 'ROUTE A'})
+    second = MappingStore(path)
+
+    # Each store's in-memory mapping is stale once the other has written
+    first.update({'CR2': 'ROUTE B'}, remove_missing=False)
+    added, changed, removed = second.update({'CR2': 'ROUTE C', 'CR3': 'ROUTE A'}, remove_missing=False)
+    assert (added, changed, removed) == ({'CR3': 'ROUTE A'}, {'CR2': 'ROUTE C'}, [])
+
+    added, changed, removed = first.update({'CR1': 'ROUTE A', 'CR2': 'ROUTE C'})
+    assert (added, changed, removed) == ({}, {}, ['CR3'])
+    assert dict(first.items()) == {'CR1': 'ROUTE A', 'CR2': 'ROUTE C'}
+    second.reload()
+    assert dict(second.items()) == dict(first.items())
+    assert dict(MappingStore(path).items()) == dict(first.items())
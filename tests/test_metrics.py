@@ -0,0 +1,15 @@
+import os
+import stat
+from metrics import write_atomic, write_json_report
+
+
+def test_reports_respect_the_umask(tmp_path):
+    umask = os.umask(0o022)
+    try:
+        write_json_report({'pages': 3}, str(tmp_path / 'run_report.json'))
+        write_atomic(str(tmp_path / 'metrics' / 'transport_sorter.prom'), "transport_sorter_pages_total 3\n")
+    finally:
+        os.umask(umask)
+    assert stat.S_IMODE((tmp_path / 'run_report.json').stat().st_mode) == 0o644
+    assert stat.S_IMODE((tmp_path / 'metrics' / 'transport_sorter.prom').stat().st_mode) == 0o644
+    assert sorted(os.listdir(tmp_path / 'metrics')) == ['transport_sorter.prom']
@@ -0,0 +1,54 @@
+import pytest
+import pytesseract
+from PIL import Image
+from ocr import BrokenProcessPool, OcrPool, TesseractNotFoundError, ref_confidence
+
+
+def test_confidence_of_the_word_holding_the_ref():
+    words = [('Customer', 96.0), ('Ref.', 91.0), ('CR00124', 88.0), ('24', 12.0), ('00', 30.0)]
+    assert ref_confidence('CR00124', words) == 88.0
+
+
+def test_confidence_of_a_ref_split_across_words():
+    words = [('Ref:', 95.0), ('24', 10.0), ('cr', 80.0), ('00124', 64.0), ('Page', 90.0)]
+    assert ref_confidence('CR00124', words) == 64.0
+
+
+def test_no_confidence_when_the_ref_is_not_among_the_words():
+    words = [('CR', 80.0), ('Total', 90.0), ('00124', 20.0), ('24', 15.0)]
+    assert ref_confidence('CR00124', words) is None
+    assert ref_confidence('CR00124', [('CR00124', -1.0)]) is None
+
+
+@pytest.fixture
+def page_image(tmp_path):
+    path = str(tmp_path / 'page.png')
+    Image.new('L', (200, 100), 255).save(path)
+    return path
+
+
+def test_missing_tesseract_comes_back_from_a_worker(page_image, monkeypatch):
+    monkeypatch.setattr(pytesseract.pytesseract, 'tesseract_cmd', '/nonexistent/tesseract')
+    with OcrPool(2, backend='subprocess') as pool:
+        for _ in range(2):
+            with pytest.raises(TesseractNotFoundError):
+                pool.submit(page_image).result()
+
+
+def test_pool_replaces_a_broken_executor(page_image, monkeypatch):
+    monkeypatch.setattr(pytesseract.pytesseract, 'tesseract_cmd', '/nonexistent/tesseract')
+    with OcrPool(1, backend='subprocess') as pool:
+        job = pool.submit(page_image)
+        with pytest.raises(TesseractNotFoundError):
+            job.result()
+        for process in list(pool.executor._processes.values()):
+            process.kill()
+            process.join()
+        # Depending on when the executor notices, this job fails with it
+        # or already goes to a new one
+        try:
+            pool.submit(page_image).result()
+        except (BrokenProcessPool, TesseractNotFoundError):
+            pass
+        with pytest.raises(TesseractNotFoundError):
+            pool.submit(page_image).result()
@@ -0,0 +1,94 @@
+import os
+import threading
+from http.server import ThreadingHTTPServer
+import pytest
+from PyPDF2 import PdfReader
+from helpers import make_pdf, make_store
+from service import ServiceHandler, SplitService
+from service_client import ServiceClient, ServiceError, run_remote
+from sorter import SplitSettings
+
+
+@pytest.fixture
+def service(tmp_path):
+    # A text-layer only configuration, so no OCR tools are needed
+    store = make_store(tmp_path, {'CR00001': 'ROUTE A', 'CR00002': 'ROUTE B'})
+    settings = SplitSettings(mode='text', use_cache=False, report_name=None, journal_name=None, ocr_workers=1)
+    return SplitService(store, settings, jobs_dir=str(tmp_path / 'jobs'), job_threads=1, log=lambda message: None)
+
+
+@pytest.fixture
+def client(service):
+    # The service on an ephemeral port
+    server = ThreadingHTTPServer(('127.0.0.1', 0), ServiceHandler)
+    server.daemon_threads = True
+    server.service = service
+    service.start()
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    try:
+        yield ServiceClient(f"http://127.0.0.1:{server.server_address[1]}", timeout=10)
+    finally:
+        server.shutdown()
+        server.server_close()
+        service.shutdown()
+
+
+def page_texts(path):
+    return [page.extract_text() for page in PdfReader(path).pages]
+
+
+def test_run_remote_downloads_the_route_files(client, tmp_path):
+    pdf = str(tmp_path / 'manifest.pdf')
+    make_pdf(pdf, [["Customer Ref. CR00001"], ["Customer Ref. CR00002"], ["Customer Ref. CR00001"]])
+    output_dir = str(tmp_path / 'out')
+
+    summaries = run_remote(client, [pdf], output_dir, log=lambda message: None)
+
+    assert len(summaries) == 1
+    summary = summaries[0]
+    assert not summary['cancelled']
+    files = {os.path.basename(path): path for path in summary['files']}
+    assert sorted(files) == ['ROUTE A.pdf', 'ROUTE B.pdf']
+    assert all(os.path.dirname(path) == output_dir for path in files.values())
+    assert ['CR00001' in text for text in page_texts(files['ROUTE A.pdf'])] == [True, True]
+    assert ['CR00002' in text for text in page_texts(files['ROUTE B.pdf'])] == [True]
+    # The job is removed from the service once its files are downloaded
+    assert client.jobs() == []
+
+
+def test_invalid_options_are_refused(client, tmp_path):
+    pdf = str(tmp_path / 'manifest.pdf')
+    make_pdf(pdf, [["Customer Ref. CR00001"]])
+    with pytest.raises(ServiceError) as error:
+        client.submit(pdf, mode='sideways')
+    assert error.value.status == 400
+    with pytest.raises(ServiceError) as error:
+        client.submit(pdf, output_dir='/tmp')
+    assert error.value.status == 400
+
+
+def test_failed_jobs_are_removed_from_the_service(client, tmp_path):
+    pdf = str(tmp_path / 'broken.pdf')
+    with open(pdf, 'wb') as f:
+        f.write(b'%PDF-1.4\nnot really a PDF\n')
+    with pytest.raises(ServiceError, match='failed'):
+        run_remote(client, [pdf], str(tmp_path / 'out'), log=lambda message: None)
+    assert client.jobs() == []
+    assert os.listdir(tmp_path / 'jobs') == []
+
+
+def test_finished_jobs_expire(service, tmp_path):
+    pdf = str(tmp_path / 'manifest.pdf')
+    make_pdf(pdf, [["Customer Ref. CR00001"]])
+    with open(pdf, 'rb') as f:
+        job = service.submit(f.read(), 'manifest.pdf')
+    orphan = tmp_path / 'jobs' / 'left-behind'
+    orphan.mkdir()
+    service.run(job)
+    assert job.status == 'done'
+
+    assert service.expire(now=job.finished + 60) == []
+    assert sorted(service.expire(now=job.finished + service.job_ttl + 60)) == sorted([job.id, 'left-behind'])
+    assert service.get(job.id) is None
+    assert os.listdir(tmp_path / 'jobs') == []
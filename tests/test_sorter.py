@@ -0,0 +1,91 @@
+import os
+import stat
+import threading
+import sorter as sorter_module
+from helpers import make_pdf, make_store
+from ocr import InlineOcr, OcrPool
+from sorter import RouteSorter, SplitSettings
+
+MAPPING = {'CR00001': 'ROUTE A', 'CR00002': 'ROUTE B'}
+
+PAGES = [
+    ["Invoice", "Customer Ref. CR00001", "Page 1 of 3"],
+    ["Items continued", "Page 2 of 3"],
+    ["Totals", "Page 3 of 3"],
+    ["Invoice", "Customer Ref. CR00002", "Page 1 of 1"],
+]
+
+
+def settings(**options):
+    return SplitSettings(mode='text', use_cache=False, report_name=None, write_workers=1, **options)
+
+
+def routes(summary):
+    return {route: details['pages'] for route, details in summary['routes'].items()}
+
+
+def test_continuation_pages_follow_their_document(tmp_path):
+    pdf = str(tmp_path / 'manifest.pdf')
+    make_pdf(pdf, PAGES)
+    sorter = RouteSorter(make_store(tmp_path, MAPPING), settings=settings(journal_name=None), log=lambda message: None)
+    summary = sorter.split_pdf(pdf, str(tmp_path / 'out'))
+    assert routes(summary) == {'ROUTE A': [1, 2, 3], 'ROUTE B': [4]}
+    assert summary['unassigned_pages'] == []
+
+
+def test_resumed_run_continues_the_open_document(tmp_path):
+    pdf = str(tmp_path / 'manifest.pdf')
+    make_pdf(pdf, PAGES)
+    output_dir = str(tmp_path / 'out')
+    store = make_store(tmp_path, MAPPING)
+
+    # Cancelled once the first page is classified
+    cancel_event = threading.Event()
+    sorter = RouteSorter(store, settings=settings(), log=lambda message: None,
+                         progress=lambda page_num, total_pages: page_num == 1 and cancel_event.set(),
+                         cancel_event=cancel_event)
+    summary = sorter.split_pdf(pdf, output_dir)
+    assert summary['cancelled']
+
+    sorter = RouteSorter(store, settings=settings(), log=lambda message: None)
+    summary = sorter.split_pdf(pdf, output_dir)
+    assert 0 < summary['resumed_pages'] < 3
+    assert routes(summary) == {'ROUTE A': [1, 2, 3], 'ROUTE B': [4]}
+    assert summary['unassigned_pages'] == []
+
+
+def test_route_files_respect_the_umask(tmp_path):
+    pdf = str(tmp_path / 'manifest.pdf')
+    make_pdf(pdf, PAGES)
+    output_dir = tmp_path / 'out'
+    umask = os.umask(0o022)
+    try:
+        sorter = RouteSorter(make_store(tmp_path, MAPPING), settings=settings(journal_name=None),
+                             log=lambda message: None)
+        sorter.split_pdf(pdf, str(output_dir))
+    finally:
+        os.umask(umask)
+    modes = {path.name: stat.S_IMODE(path.stat().st_mode) for path in output_dir.iterdir()}
+    assert modes == {'ROUTE A.pdf': 0o644, 'ROUTE B.pdf': 0o644}
+
+
+def test_a_shared_pool_is_used_even_with_one_worker(tmp_path, monkeypatch):
+    # Service jobs run on several threads, so they mustn't OCR in-process
+    pdf = str(tmp_path / 'manifest.pdf')
+    make_pdf(pdf, PAGES)
+    engines = []
+    extractor = sorter_module.PageTextExtractor
+
+    def record(*args, **kwargs):
+        engines.append(kwargs['ocr_pool'])
+        return extractor(*args, **kwargs)
+
+    monkeypatch.setattr(sorter_module, 'PageTextExtractor', record)
+    store = make_store(tmp_path, MAPPING)
+    with OcrPool(1) as pool:
+        RouteSorter(store, settings=settings(journal_name=None), log=lambda message: None,
+                    ocr_pool=pool).split_pdf(pdf, str(tmp_path / 'shared'))
+    RouteSorter(store, settings=settings(journal_name=None, ocr_workers=1),
+                log=lambda message: None).split_pdf(pdf, str(tmp_path / 'own'))
+    assert engines[0] is pool
+    assert isinstance(engines[1], InlineOcr)